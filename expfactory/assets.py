@@ -0,0 +1,369 @@
+'''
+assets.py: part of expfactory package
+Functions to bundle and compress static files for batteries
+
+'''
+
+from expfactory.experiment import get_file_hash
+from expfactory.utils import run_parallel, save_json_atomic
+import threading
+import hashlib
+import json
+import gzip
+import io
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Each folder with precompressed variants records the sha256 of the file each variant was compressed from
+compressed_manifest = ".expfactory-compressed.json"
+manifest_lock = threading.Lock()
+
+compressible_extensions = ["html","js","css","json","svg","txt","tsv","csv","xml","map","ico","ttf","otf","eot"]
+
+
+def get_bundle_dir(battery_dest):
+    '''get_bundle_dir
+    return the folder that bundles are written to in a battery
+    :param battery_dest: full path to battery destination folder
+    '''
+    return "%s/static/bundles" %(battery_dest)
+
+
+def get_script_path(script,exp_id,repo_type="experiments"):
+    '''get_script_path
+    return the path of a script in a config.json "run" list, relative to the battery base, or None
+    for an external (http/https) script
+    :param script: the script as listed in "run"
+    :param exp_id: the experiment unique id
+    :param repo_type: the kind of task (experiments, surveys, games)
+    '''
+    if re.search("^http",script):
+        return None
+    if len(script.split("/")) == 1:
+        return "static/%s/%s/%s" %(repo_type,exp_id,script)
+    return script
+
+
+def get_repo_type(experiment):
+    repo_type = "experiments"
+    if experiment["template"] == "survey":
+        repo_type = "surveys"
+    elif experiment["template"] == "phaser":
+        repo_type = "games"
+    return repo_type
+
+
+def rewrite_css_urls(css,css_path,bundle_path):
+    '''rewrite_css_urls
+    rewrite relative url() references in a stylesheet so they resolve from the bundle folder
+    :param css: the stylesheet content
+    :param css_path: path of the stylesheet, relative to the battery base
+    :param bundle_path: path of the bundle folder, relative to the battery base
+    '''
+    def rewrite(match):
+        url = match.group(2).strip()
+        if re.search("^(/|#|data:|https?:)",url) or url == "":
+            return match.group(0)
+        new_url = os.path.relpath(os.path.join(os.path.dirname(css_path),url),bundle_path)
+        return "url(%s%s%s)" %(match.group(1),new_url.replace(os.sep,"/"),match.group(1))
+    return re.sub(r"""url\(\s*(['"]?)([^'")]*)\1\s*\)""",rewrite,css)
+
+
+def write_bundle(battery_dest,name,paths,ext):
+    '''write_bundle
+    concatenate files into a content-hashed bundle [name].[hash].[ext] in the bundle folder, and
+    return the bundle path relative to the battery base. A bundle with the same content is not written again.
+    :param battery_dest: full path to battery destination folder
+    :param name: the name of the bundle
+    :param paths: the files to concatenate, in order, relative to the battery base
+    :param ext: one of js or css
+    '''
+    bundle_path = os.path.relpath(get_bundle_dir(battery_dest),battery_dest)
+    contents = []
+    for path in paths:
+        with open("%s/%s" %(battery_dest,path),"r") as filey:
+            content = filey.read()
+        if ext == "css":
+            content = rewrite_css_urls(content,path,bundle_path)
+        contents.append("/* %s */\n%s" %(path,content))
+
+    # Scripts are separated with a semicolon, in case a file does not end its last statement
+    if ext == "js":
+        bundle = "\n;\n".join(contents)
+    else:
+        bundle = "\n".join(contents)
+
+    bundle_hash = hashlib.sha256(bundle.encode("utf-8")).hexdigest()[0:12]
+    bundle_file = "%s/%s.%s.%s" %(bundle_path,name,bundle_hash,ext)
+    output_file = "%s/%s" %(battery_dest,bundle_file)
+    if not os.path.exists(output_file):
+        if not os.path.exists(get_bundle_dir(battery_dest)):
+            os.makedirs(get_bundle_dir(battery_dest))
+        with open(output_file,"w") as filey:
+            filey.write(bundle)
+    return bundle_file
+
+
+def get_tag(path,ext,url_prefix=""):
+    '''get_tag
+    return a <script> or <link> tag for a path. Paths relative to the battery base get the url_prefix.
+    '''
+    if not re.search("^http",path):
+        path = "%s%s" %(url_prefix,path)
+    if ext == "js":
+        return "<script src='%s'></script>" %(path)
+    return "<link rel='stylesheet' type='text/css' href='%s'>" %(path)
+
+
+def bundle_static(valid_experiments,battery_dest,url_prefix=""):
+    '''bundle_static
+    concatenate the scripts and styles of a battery into content-hashed bundles, and return the <script> and
+    <link> tags to load them, to use in place of battery.get_load_static. Libraries shared between experiments
+    (files outside the experiment folders, eg jspsych plugins) are deduplicated into one "shared" bundle, loaded
+    first. Each experiment then gets a bundle with its own files, in the order of its config.json "run" list.
+    External (http/https) scripts and files missing from the battery are not bundled, and keep their own tags.
+    :param valid_experiments: a BatteryPlan, or any list of loaded config.json (dict), already moved into the battery
+    :param battery_dest: full path to battery destination folder
+    :param url_prefix: prefix to put before paths, in case of custom deployment
+    '''
+    shared = {"js":[],"css":[]}
+    external = {"js":[],"css":[]}
+    experiment_files = []
+
+    for experiment in valid_experiments:
+        tag = experiment["exp_id"]
+        repo_type = get_repo_type(experiment)
+        files = {"js":[],"css":[]}
+        for script in experiment["run"]:
+            ext = script.split(".")[-1]
+            if ext not in ["js","css"]:
+                continue
+            path = get_script_path(script,tag,repo_type)
+            if path == None:
+                if get_tag(script,ext) not in external[ext]:
+                    external[ext].append(get_tag(script,ext))
+            elif not os.path.exists("%s/%s" %(battery_dest,path)):
+                if get_tag(path,ext,url_prefix) not in external[ext]:
+                    print("%s: %s not found in battery, will not be bundled." %(tag,script))
+                    external[ext].append(get_tag(path,ext,url_prefix))
+            elif len(script.split("/")) == 1:
+                files[ext].append(path)
+            elif path not in shared[ext]:
+                shared[ext].append(path)
+        experiment_files.append((tag,files))
+
+    # Shared libraries first, then external scripts, then each experiment
+    bundles = {"js":[],"css":[]}
+    for ext in ["js","css"]:
+        if len(shared[ext]) > 0:
+            bundles[ext].append(get_tag(write_bundle(battery_dest,"shared",shared[ext],ext),ext,url_prefix))
+        bundles[ext] = bundles[ext] + external[ext]
+        for tag,files in experiment_files:
+            if len(files[ext]) > 0:
+                bundle_tag = get_tag(write_bundle(battery_dest,tag,files[ext],ext),ext,url_prefix)
+                if bundle_tag not in bundles[ext]:
+                    bundles[ext].append(bundle_tag)
+
+    clean_bundles(battery_dest,bundles["js"] + bundles["css"])
+    return "\n".join(bundles["js"] + bundles["css"])
+
+
+def clean_bundles(battery_dest,tags):
+    '''clean_bundles
+    remove bundles from a previous build that are no longer referenced
+    :param battery_dest: full path to battery destination folder
+    :param tags: the <script> and <link> tags of the current build
+    '''
+    bundle_dir = get_bundle_dir(battery_dest)
+    if not os.path.exists(bundle_dir):
+        return
+    current = "\n".join(tags)
+    for bundle_file in os.listdir(bundle_dir):
+        if "bundles/%s'" %(bundle_file) not in current:
+            os.remove("%s/%s" %(bundle_dir,bundle_file))
+
+
+def get_compress_encodings():
+    '''get_compress_encodings
+    return the compressed variants that can be written: gz, and br if the brotli module is installed
+    '''
+    if brotli == None:
+        return ["gz"]
+    return ["gz","br"]
+
+
+def compress_assets(folder,min_size=1024,workers=4,encodings=None,extensions=None):
+    '''compress_assets
+    write precompressed .gz (and .br) siblings for compressible files in a battery folder, for static
+    servers to send as is (eg, nginx gzip_static). A variant is only written when it does not exist
+    or was compressed from different content than the file has now (see is_variant_current), and is given
+    the modification time of the file. Files that compression did not make smaller are recorded, and skipped
+    until their content changes. Symbolic links are not followed, so files outside of the folder
+    (eg, experiments added with the symlink strategy) are left alone.
+    :param folder: full path to battery or web folder
+    :param min_size: files smaller than this many bytes are not compressed (default 1024)
+    :param workers: number of threads to compress with
+    :param encodings: a list with "gz" and/or "br". If None, all available are used, see get_compress_encodings
+    :param extensions: a list of file extensions to compress. If None, compressible_extensions is used
+    '''
+    if encodings == None:
+        encodings = get_compress_encodings()
+    elif "br" in encodings and brotli == None:
+        print("brotli module is not installed, will not write .br files.")
+        encodings = [x for x in encodings if x != "br"]
+    if extensions == None:
+        extensions = compressible_extensions
+
+    tasks = []
+    manifests = dict()
+    for root, dirnames, filenames in os.walk(folder):
+        for filename in filenames:
+            source = os.path.join(root,filename)
+            if filename.split(".")[-1].lower() not in extensions or os.path.islink(source):
+                continue
+            if filename == compressed_manifest or os.path.getsize(source) < min_size:
+                continue
+            if root not in manifests:
+                manifests[root] = load_compressed_manifest(root)
+            source_hash = get_file_hash(source)
+            for encoding in encodings:
+                if is_variant_current(source,encoding,source_hash=source_hash,manifest=manifests[root]):
+                    continue
+                # A file that did not get smaller is not compressed again until it changes
+                if manifests[root].get("%s.%s" %(filename,encoding)) == {"not_smaller":source_hash}:
+                    continue
+                tasks.append((source,encoding,manifests[root]))
+
+    written = [x for x in run_parallel(compress_file_task,tasks,workers=workers) if x != None]
+    for root in set([os.path.dirname(x[0]) for x in tasks]):
+        save_compressed_manifest(root,manifests[root])
+    print("Wrote %s compressed files in %s" %(len(written),folder))
+    return written
+
+
+def load_compressed_manifest(directory):
+    '''load_compressed_manifest
+    return the record of precompressed variants in a folder, {variant filename:sha256 of the file it was
+    compressed from}. A file that compression did not make smaller has {"not_smaller":sha256} instead,
+    and no variant. If it does not exist or cannot be read, an empty record is returned
+    :param directory: full path to the folder with the variants
+    '''
+    manifest_file = "%s/%s" %(directory,compressed_manifest)
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file,"r") as filey:
+                return json.load(filey)
+        except (IOError,ValueError):
+            print("Cannot read %s, variants will be compressed again." %(manifest_file))
+    return dict()
+
+
+def save_compressed_manifest(directory,manifest):
+    '''save_compressed_manifest
+    write the record of precompressed variants in a folder, see load_compressed_manifest
+    :param directory: full path to the folder with the variants
+    :param manifest: the record, as returned by load_compressed_manifest
+    '''
+    manifest_file = "%s/%s" %(directory,compressed_manifest)
+    try:
+        save_json_atomic(manifest_file,manifest)
+    except (IOError,OSError) as e:
+        print("Cannot write %s: %s" %(manifest_file,e))
+
+
+def is_variant_current(source,encoding,source_hash=None,manifest=None,cache=None):
+    '''is_variant_current
+    return True if source.[encoding] exists and was compressed from the content source has now. Content
+    is compared by hash, as modification times are kept by copies and can be equal on filesystems with
+    coarse timestamps, even when the file has changed.
+    :param source: full path to the file
+    :param encoding: one of gz or br
+    :param source_hash: the sha256 of source, if already known
+    :param manifest: the record of variants for the folder of source. If None, it is loaded
+    :param cache: a dictionary of file hashes to look up and update, see experiment.get_file_hash
+    '''
+    variant = "%s.%s" %(source,encoding)
+    if not os.path.exists(variant):
+        return False
+    if manifest == None:
+        manifest = load_compressed_manifest(os.path.dirname(source))
+    recorded = manifest.get(os.path.basename(variant))
+    if recorded == None:
+        return False
+    if source_hash == None:
+        source_hash = get_file_hash(source,cache=cache)
+    return recorded == source_hash
+
+
+def compress_file_task(task):
+    '''compress_file_task
+    a task for compress_assets, to compress one file
+    :param task: a tuple with (source,encoding,manifest)
+    '''
+    source,encoding,manifest = task
+    return compress_file(source,encoding,manifest=manifest)
+
+
+def compress_file(source,encoding="gz",manifest=None):
+    '''compress_file
+    write source.gz or source.br, record the hash of source for it, and return its path. Nothing is written
+    (and None is returned) if compression does not make the file smaller, and that is recorded instead.
+    :param source: full path to file to compress
+    :param encoding: one of gz or br
+    :param manifest: the record of variants for the folder of source, to update (the caller saves it).
+                     If None, the record saved in the folder is updated
+    '''
+    stat = os.stat(source)
+    with open(source,"rb") as filey:
+        content = filey.read()
+    entry = hashlib.sha256(content).hexdigest()
+
+    if encoding == "br":
+        compressed = brotli.compress(content)
+    else:
+        output = io.BytesIO()
+        gzipped = gzip.GzipFile(filename="",mode="wb",fileobj=output,compresslevel=9,mtime=int(stat.st_mtime))
+        gzipped.write(content)
+        gzipped.close()
+        compressed = output.getvalue()
+    # A stale variant is removed, so it is not served in place of the file
+    variant = "%s.%s" %(source,encoding)
+    if len(compressed) >= len(content):
+        if os.path.exists(variant):
+            os.remove(variant)
+        entry = {"not_smaller":entry}
+        variant = None
+    else:
+        tmp_file = "%s.tmp" %(variant)
+        with open(tmp_file,"wb") as filey:
+            filey.write(compressed)
+        os.utime(tmp_file,(stat.st_atime,stat.st_mtime))
+        os.rename(tmp_file,variant)
+    record_variant(source,encoding,entry,manifest)
+    return variant
+
+
+def record_variant(source,encoding,entry,manifest=None):
+    '''record_variant
+    record the hash of the file a variant was compressed from, see load_compressed_manifest
+    :param source: full path to the compressed file
+    :param encoding: one of gz or br
+    :param entry: the sha256 of the content of source that was compressed, or {"not_smaller":sha256}
+    :param manifest: the record of variants to update. If None, the record saved in the folder is updated
+    '''
+    directory = os.path.dirname(os.path.abspath(source))
+    name = "%s.%s" %(os.path.basename(source),encoding)
+    with manifest_lock:
+        saved = manifest
+        if saved == None:
+            saved = load_compressed_manifest(directory)
+        if saved.get(name) == entry:
+            return
+        saved[name] = entry
+        if manifest == None:
+            save_compressed_manifest(directory,saved)
@@ -3,29 +3,46 @@ battery.py: part of expfactory package
 Functions to generate batteries
 
 '''
-from expfactory.vm import custom_battery_download, get_jspsych_init, get_stylejs
-from expfactory.experiment import get_experiments, load_experiment
+from expfactory.vm import custom_battery_download, get_cache_dir, get_jspsych_init, get_stylejs, get_results_post
+from expfactory.experiment import get_experiments, load_experiment, get_experiment_hash
+from expfactory.assets import bundle_static, compress_assets
 from expfactory.utils import copy_directory, get_template, \
-     sub_template, get_installdir, save_template
+     sub_template, get_installdir, save_template, link_directory, \
+     save_template_if_changed, save_json_atomic, get_compiled_template, \
+     sub_templates
 import tempfile
+import hashlib
 import shutil
 import uuid
+import json
 import os
 import re
 
 
 def generate_base(battery_dest,tasks=None,experiment_repo=None,survey_repo=None,game_repo=None,
-                  add_experiments=True,add_surveys=True,add_games=True,battery_repo=None,warning=True):
+                  add_experiments=True,add_surveys=True,add_games=True,battery_repo=None,warning=True,update=False):
     '''generate_base returns a folder with downloaded experiments, surveys, and battery, either specified by the user or a temporary directory, to be used by generate_local and generate (for psiturk)
-    :param battery_dest: [required] is the output folder for your battery. This folder MUST NOT EXIST.
+    :param battery_dest: [required] is the output folder for your battery. This folder MUST NOT EXIST, unless update is True.
     :param battery_repo: location of psiturk-battery repo to use as a template. If not specified, will be downloaded to a temporary directory
     :param experiment_repo: location of a expfactory-experiments repo to check for valid experiments. If not specified, will be downloaded to a temporary directory
     :param survey_repo: location of a expfactory-surveys repo to check for valid surveys. If not specified, will be downloaded to a temporary directory
     :param tasks: a list of experiments and surveys, meaning the "exp_id" variable in the config.json, to include. This variable also conincides with the tasks folder name.
     :param warning: show warnings when validating experiments (default True)
+    :param update: if True and battery_dest exists, keep it when the battery template is unchanged, see update_battery_skeleton.
+                   If battery_dest exists but is not a battery made with update, None is returned
     '''
-    if experiment_repo == None or battery_repo == None or survey_repo == None or game_repo == None:
-        tmpdir = custom_battery_download()
+    # Only the repos not given are downloaded, with only the folders of the tasks
+    repos = []
+    if battery_repo == None:
+        repos.append("battery")
+    if experiment_repo == None and add_experiments == True:
+        repos.append("experiments")
+    if survey_repo == None and add_surveys == True:
+        repos.append("surveys")
+    if game_repo == None and add_games == True:
+        repos.append("games")
+    if len(repos) > 0:
+        tmpdir = custom_battery_download(repos=repos,tasks=tasks)
         if experiment_repo == None:
             experiment_repo = "%s/experiments" %(tmpdir)     
         if battery_repo == None:
@@ -37,16 +54,20 @@ def generate_base(battery_dest,tasks=None,experiment_repo=None,survey_repo=None,
 
 
     # Copy battery skeleton to destination
-    copy_directory(battery_repo,battery_dest)
+    if update == True:
+        if update_battery_skeleton(battery_repo,battery_dest) == False:
+            return None
+    else:
+        copy_directory(battery_repo,battery_dest)
     valid_experiments = []
     valid_surveys = []
     valid_games = []
     if add_experiments == True:
-        valid_experiments = get_experiments(experiment_repo,warning=warning)
+        valid_experiments = get_experiments(experiment_repo,warning=warning,index=True)
     if add_surveys == True:
-        valid_surveys = get_experiments(survey_repo,warning=warning,repo_type="surveys")
+        valid_surveys = get_experiments(survey_repo,warning=warning,repo_type="surveys",index=True)
     if add_games == True:
-        valid_games = get_experiments(game_repo,warning=warning,repo_type="games")
+        valid_games = get_experiments(game_repo,warning=warning,repo_type="games",index=True)
 
     # If the user wants to select a subset
     if tasks != None:
@@ -64,7 +85,8 @@ def generate_base(battery_dest,tasks=None,experiment_repo=None,survey_repo=None,
 
     return base
 
-def generate_local(battery_dest=None,subject_id=None,battery_repo=None,experiment_repo=None,experiments=None,warning=True,time=30):
+def generate_local(battery_dest=None,subject_id=None,battery_repo=None,experiment_repo=None,experiments=None,warning=True,time=30,
+                   link_strategy="copy",update=False,bundle=False,compress=False,deployment="local"):
     '''generate_local deploys a local battery
     will create a battery from a template and list of experiments
     :param battery_dest: is the output folder for your battery. This folder MUST NOT EXIST. If not specified, a temp directory will be used
@@ -73,20 +95,30 @@ def generate_local(battery_dest=None,subject_id=None,battery_repo=None,experimen
     :param experiments: a list of experiments, meaning the "exp_id" variable in the config.json, to include. This variable also conincides with the experiment folder name.
     :param subject_id: The subject id to embed in the experiment, and the name of the results file. If none is provided, a unique ID will be generated.
     :param time: Maximum amount of time for battery to endure, to select experiments
+    :param link_strategy: how to add experiment folders to the battery, one of "copy" (default), "hardlink", "reflink" or "symlink". See utils.link_directory
+    :param update: if True, battery_dest may exist, and only new or changed experiments are copied into it (see template_experiments)
+    :param bundle: if True, concatenate experiment scripts and styles into bundles, see assets.bundle_static
+    :param compress: if True, write precompressed .gz (and .br) variants of static files, see assets.compress_assets
+    :param deployment: how the battery saves data at the end: local (default) downloads a csv in the browser, and
+                       local-server POSTs it to the server that runs the battery (see webserver.py)
     '''
     if battery_dest == None:
         battery_dest = tempfile.mkdtemp()
         shutil.rmtree(battery_dest)
 
-    # We can only generate a battery to a folder that does not exist, to be safe
-    if not os.path.exists(battery_dest):
+    # We can only generate a battery to a folder that does not exist, to be safe, unless updating
+    if update == True or not os.path.exists(battery_dest):
 
         base = generate_base(battery_dest=battery_dest,
                              tasks=experiments,
                              experiment_repo=experiment_repo,
                              battery_repo=battery_repo,
                              warning=warning,
-                             add_surveys=False)
+                             add_surveys=False,
+                             add_games=False,
+                             update=update)
+        if base == None:
+            return None
 
         # We will output a local battery template (without psiturk) 
         template_exp = "%s/templates/localbattery.html" %get_installdir()
@@ -98,7 +130,8 @@ def generate_local(battery_dest=None,subject_id=None,battery_repo=None,experimen
 
         # Add custom variable "subject ID" to the battery - will be added to data
         custom_variables = dict()
-        custom_variables["exp"] = [("[SUB_SUBJECT_ID_SUB]",subject_id)]
+        custom_variables["exp"] = [("[SUB_SUBJECT_ID_SUB]",subject_id),
+                                   ("[SUB_SAVEDATA_SUB]",get_battery_save(subject_id,deployment))]
         custom_variables["load"] = [("[SUB_TOTALTIME_SUB]",time)]
 
         # Fill in templates with the experiments
@@ -107,13 +140,86 @@ def generate_local(battery_dest=None,subject_id=None,battery_repo=None,experimen
                              valid_experiments=base["experiments"],
                              template_exp=template_exp,
                              template_exp_output=template_exp_output,
-                             custom_variables=custom_variables)
+                             custom_variables=custom_variables,
+                             link_strategy=link_strategy,
+                             update=update,
+                             bundle=bundle)
+
+        if compress == True:
+            compress_assets(battery_dest)
         return battery_dest    
     else:
         print("Folder exists at %s, cannot generate." %(battery_dest))
 
 
-def generate(battery_dest=None,battery_repo=None,experiment_repo=None,experiments=None,config=None,make_config=True,warning=True,time=30):
+def generate_local_batch(subject_ids,battery_dest=None,battery_repo=None,experiment_repo=None,experiments=None,warning=True,time=30,
+                         link_strategy="copy",update=False,bundle=False,compress=False,deployment="local"):
+    '''generate_local_batch deploys a local battery for many subjects
+    the battery (static files and experiments) is generated once, and each subject gets a small entry page,
+    [subject_id].html, next to index.html. index.html is given a unique id, as with generate_local
+    :param subject_ids: a list of subject ids. Each must be a valid file name (letters, numbers, and - _ .)
+    :param battery_dest: is the output folder for your battery. This folder MUST NOT EXIST, unless update is True. If not specified, a temp directory will be used
+    :param battery_repo: location of psiturk-battery repo to use as a template. If not specified, will be downloaded to a temporary directory
+    :param experiment_repo: location of a expfactory-experiments repo to check for valid experiments. If not specified, will be downloaded to a temporary directory
+    :param experiments: a list of experiments, meaning the "exp_id" variable in the config.json, to include.
+    :param time: Maximum amount of time for battery to endure, to select experiments
+    :param link_strategy: how to add experiment folders to the battery, see generate_local
+    :param update: if True, battery_dest may exist, and only changed experiments and entry pages are rewritten. Entry pages
+                   for subjects not in subject_ids are removed (subjects are recorded in the battery state, see get_battery_state_file)
+    :param bundle: if True, concatenate experiment scripts and styles into bundles, see generate_local
+    :param compress: if True, write precompressed .gz (and .br) variants of static files, see generate_local
+    :param deployment: how the battery saves data, local (default) or local-server, see generate_local
+    '''
+    if isinstance(subject_ids,str):
+        subject_ids = [subject_ids]
+    valid_ids = []
+    for subject_id in subject_ids:
+        if not re.match("^[A-Za-z0-9_.-]+$",subject_id) or subject_id in ["index","."]:
+            print("Subject id %s is not a valid file name, skipping." %(subject_id))
+        elif subject_id not in valid_ids:
+            valid_ids.append(subject_id)
+
+    # The subject id placeholder is left in index.html, to fill in for each subject
+    battery_dest = generate_local(battery_dest=battery_dest,
+                                  subject_id="[SUB_SUBJECT_ID_SUB]",
+                                  battery_repo=battery_repo,
+                                  experiment_repo=experiment_repo,
+                                  experiments=experiments,
+                                  warning=warning,
+                                  time=time,
+                                  link_strategy=link_strategy,
+                                  update=update,
+                                  bundle=bundle,
+                                  deployment=deployment)
+    if battery_dest == None:
+        return None
+
+    index_file = "%s/index.html" %(battery_dest)
+    with open(index_file,"r") as filey:
+        template = filey.read()
+    for subject_id in valid_ids:
+        subject_page = sub_template(template,"[SUB_SUBJECT_ID_SUB]",subject_id)
+        save_template_if_changed("%s/%s.html" %(battery_dest,subject_id),subject_page)
+    save_template(index_file,sub_template(template,"[SUB_SUBJECT_ID_SUB]",str(uuid.uuid4())))
+
+    # Entry pages of subjects from a previous update that are not in subject_ids are removed
+    state = load_battery_state(battery_dest)
+    for subject_id in state["subjects"]:
+        if subject_id in valid_ids:
+            continue
+        for subject_page in ["%s/%s.html%s" %(battery_dest,subject_id,x) for x in ["",".gz",".br"]]:
+            if os.path.exists(subject_page):
+                os.remove(subject_page)
+    state["subjects"] = valid_ids
+    save_battery_state(battery_dest,state)
+    print("Generated entry pages for %s subjects." %(len(valid_ids)))
+    if compress == True:
+        compress_assets(battery_dest)
+    return battery_dest
+
+
+def generate(battery_dest=None,battery_repo=None,experiment_repo=None,experiments=None,config=None,make_config=True,warning=True,time=30,
+             link_strategy="copy",update=False,bundle=False,compress=False):
     '''generate
     will create a battery from a template and list of experiments
     :param battery_dest: is the output folder for your battery. This folder MUST NOT EXIST. If not specified, a temp folder is created
@@ -124,20 +230,30 @@ def generate(battery_dest=None,battery_repo=None,experiment_repo=None,experiment
     :param make_config: A boolean (default True) to control generation of the config. If there is a config generated before calling this function, this should be set to False.
     :param warning: Show config.json warnings when validating experiments. Default is True
     :param time: maximum amount of time for battery to endure (default 30 minutes) to select experiments
+    :param link_strategy: how to add experiment folders to the battery, one of "copy" (default), "hardlink", "reflink" or "symlink". See utils.link_directory
+    :param update: if True, battery_dest may exist, and only new or changed experiments are copied into it (see template_experiments)
+    :param bundle: if True, concatenate experiment scripts and styles into bundles, see assets.bundle_static
+    :param compress: if True, write precompressed .gz (and .br) variants of static files, see assets.compress_assets
+    :param deployment: how the battery saves data at the end: local (default) downloads a csv in the browser, and
+                       local-server POSTs it to the server that runs the battery (see webserver.py)
     '''
     if battery_dest == None:
         battery_dest = tempfile.mkdtemp()
         shutil.rmtree(battery_dest)
 
-    # We can only generate a battery to a folder that does not exist, to be safe
-    if not os.path.exists(battery_dest):
+    # We can only generate a battery to a folder that does not exist, to be safe, unless updating
+    if update == True or not os.path.exists(battery_dest):
 
         base = generate_base(battery_dest=battery_dest,
                              tasks=experiments,
                              experiment_repo=experiment_repo,
                              battery_repo=battery_repo,
                              warning=warning,
-                             add_surveys=False)
+                             add_surveys=False,
+                             add_games=False,
+                             update=update)
+        if base == None:
+            return None
 
         custom_variables = dict()
         custom_variables["load"] = [("[SUB_TOTALTIME_SUB]",time)]
@@ -146,7 +262,10 @@ def generate(battery_dest=None,battery_repo=None,experiment_repo=None,experiment
         template_experiments(battery_dest=battery_dest,
                              battery_repo=base["battery_repo"],
                              valid_experiments=base["experiments"],
-                             custom_variables=custom_variables)
+                             custom_variables=custom_variables,
+                             link_strategy=link_strategy,
+                             update=update,
+                             bundle=bundle)
 
         # Generte config
         if make_config:
@@ -154,13 +273,15 @@ def generate(battery_dest=None,battery_repo=None,experiment_repo=None,experiment
                 config = dict()
             generate_config(battery_dest,config)
 
+        if compress == True:
+            compress_assets(battery_dest)
         return battery_dest
     else:
         print("Folder exists at %s, cannot generate." %(battery_dest))
 
         
 def template_experiments(battery_dest,battery_repo,valid_experiments,template_load=None,template_exp=None,
-                         template_exp_output=None,custom_variables=None):
+                         template_exp_output=None,custom_variables=None,link_strategy="copy",update=False,bundle=False):
     '''template_experiments:
     For each valid experiment, copies the entire folder into the battery destination directory, and generates templates with appropriate paths to run them
     :param battery_dest: full path to destination folder of battery
@@ -170,6 +291,9 @@ def template_experiments(battery_dest,battery_repo,valid_experiments,template_lo
     :param template_exp: the exp.html template file that runs load_experiment.js. If not specified, the psiturk file from the battery repo is used.
     :param template_exp_output: The output file for template_exp. if not specified, the default psiturk templates/exp.html is used
     :param custom_variables: A dictionary of custom variables to add to templates. Keys should either be "exp" or "load", and values should be tuples with the first index the thing to sub (eg, [SUB_THIS_SUB]) and the second the substitition to make.
+    :param link_strategy: how to add experiment folders to the battery, see move_experiments
+    :param update: if True, only copy experiments that are new or changed since the last update of battery_dest, and remove experiments no longer in valid_experiments. Templates are only rewritten when their content changes.
+    :param bundle: if True, scripts and styles are concatenated into hashed bundles in static/bundles, and exp.html loads the bundles instead of each file (see assets.bundle_static)
     '''
     # Generate run template, make substitutions
     if template_load == None:
@@ -178,35 +302,44 @@ def template_experiments(battery_dest,battery_repo,valid_experiments,template_lo
         template_exp = "%s/templates/exp.html" %(battery_repo)
     if template_exp_output == None:
         template_exp_output = "%s/templates/exp.html" %(battery_dest)
-    load_template = get_template(template_load)
-    exp_template = get_template(template_exp)
-    valid_experiments = move_experiments(valid_experiments,battery_dest)
-    loadstatic = get_load_static(valid_experiments) 
-    concatjs = get_concat_js(valid_experiments) 
-    timingjs = get_timing_js(valid_experiments)
-    load_template = sub_template(load_template,"[SUB_EXPERIMENTCONCAT_SUB]",concatjs)
-    exp_template = sub_template(exp_template,"[SUB_EXPERIMENTSTATIC_SUB]",loadstatic)
-    load_template = sub_template(load_template,"[SUB_EXPERIMENTTIMES_SUB]",str(timingjs)) 
+    if update == True:
+        valid_experiments = update_experiments(valid_experiments,battery_dest,link_strategy=link_strategy)
+    else:
+        valid_experiments = move_experiments(valid_experiments,battery_dest,link_strategy=link_strategy)
+
+    # Each config.json is read once, and shared by the generators below
+    plan = BatteryPlan(valid_experiments)
+    if bundle == True:
+        loadstatic = bundle_static(plan,battery_dest)
+    else:
+        loadstatic = get_load_static(plan)
+    concatjs = get_concat_js(plan) 
+    timingjs = get_timing_js(plan)
+    load_substitutions = [("[SUB_EXPERIMENTCONCAT_SUB]",concatjs),
+                          ("[SUB_EXPERIMENTTIMES_SUB]",str(timingjs))]
+    exp_substitutions = [("[SUB_EXPERIMENTSTATIC_SUB]",loadstatic)]
 
     # Add custom user variables
     if custom_variables != None:
         if "exp" in custom_variables:
-            exp_template = add_custom_variables(custom_variables["exp"],exp_template)
+            exp_substitutions = exp_substitutions + [(x[0],str(x[1])) for x in custom_variables["exp"]]
         if "load" in custom_variables:
-            load_template = add_custom_variables(custom_variables["load"],load_template)
+            load_substitutions = load_substitutions + [(x[0],str(x[1])) for x in custom_variables["load"]]
+
+    # Each template is rendered in a single pass
+    load_template = get_compiled_template(template_load,[x[0] for x in load_substitutions])
+    load_template = load_template.render(load_substitutions)
+    exp_template = get_compiled_template(template_exp,[x[0] for x in exp_substitutions])
+    exp_template = exp_template.render(exp_substitutions)
 
     # load experiment scripts
     if not os.path.exists("%s/static/js" %(battery_dest)):
         os.mkdir("%s/static/js" %(battery_dest))
     template_output = "%s/static/js/load_experiments.js" %(battery_dest)
-    filey = open(template_output,'w')
-    filey.writelines(load_template)
-    filey.close()    
+    save_template_if_changed(template_output,load_template)
 
     # exp.html template
-    filey = open(template_exp_output,'w')
-    filey.writelines(exp_template)
-    filey.close()    
+    save_template_if_changed(template_exp_output,exp_template)
 
 
 def add_custom_variables(custom_variables,template):
@@ -214,29 +347,181 @@ def add_custom_variables(custom_variables,template):
     :param custom_variables: a list of tuples (see description above)
     :param template: an open file to replace "tag" with "substitute"
     '''
-    for custom_var in custom_variables:
-        template = sub_template(template,custom_var[0],str(custom_var[1]))
-    return template
+    return sub_templates(template,[(x[0],str(x[1])) for x in custom_variables])
 
-def move_experiments(valid_experiments,battery_dest,repo_type="experiments"):
+def move_experiments(valid_experiments,battery_dest,repo_type="experiments",link_strategy="copy"):
     '''move_experiments
     Moves valid experiments into the experiments folder in battery repo
     :param valid_experiments: a list of full paths to valid experiments
     :param battery_dest: full path to battery destination folder
     :param repo_type: the kind of task to move (default is experiments)
+    :param link_strategy: one of "copy" (default), "hardlink", "reflink" or "symlink". Links avoid duplicating experiment media, but hard and symbolic links share files with the source repo. Falls back to copying where a link cannot be made. See utils.link_directory
     '''
 
     moved_experiments = []
     for valid_experiment in valid_experiments:
         try:
             experiment_folder = os.path.basename(valid_experiment)
-            copy_directory(valid_experiment,"%s/static/%s/%s" %(battery_dest,repo_type,experiment_folder))
+            link_directory(valid_experiment,"%s/static/%s/%s" %(battery_dest,repo_type,experiment_folder),strategy=link_strategy)
             moved_experiments.append(valid_experiment)
         except:
            print("Cannot move %s, will not be added." %(valid_experiment))
     return moved_experiments
 
 
+# INCREMENTAL UPDATES ##########################################################
+
+def get_battery_state_file(battery_dest):
+    '''get_battery_state_file
+    return the path to the file that records the content hashes of what was last put in a battery. It is kept
+    in the cache (see vm.get_cache_dir), keyed by the full path of the battery, and not in the battery folder,
+    which is served as is (the state lists the subject ids of the battery)
+    :param battery_dest: full path to battery destination folder
+    '''
+    key = hashlib.sha256(os.path.abspath(battery_dest).encode("utf-8")).hexdigest()[0:16]
+    return os.path.join(get_cache_dir(),"batteries","%s.json" %(key))
+
+
+def get_legacy_state_file(battery_dest):
+    '''get_legacy_state_file
+    return the path to the state file of batteries updated by older versions, in the battery folder
+    '''
+    return "%s/.expfactory-battery.json" %(battery_dest)
+
+
+def get_battery_id(battery_dest):
+    '''get_battery_id
+    return the random id written to a battery folder by an update (in .expfactory-battery-id), or None if
+    there is none. A state is only used for the folder it was saved for, not for another folder at the same path
+    :param battery_dest: full path to battery destination folder
+    '''
+    id_file = "%s/.expfactory-battery-id" %(battery_dest)
+    if not os.path.exists(id_file):
+        return None
+    with open(id_file,"r") as filey:
+        return filey.read().strip()
+
+
+def load_battery_state(battery_dest):
+    '''load_battery_state
+    load the state of a battery written by an update, an empty state if there is none. The "folder" of
+    the state is None if battery_dest was not made (or last updated) by an update
+    :param battery_dest: full path to battery destination folder
+    '''
+    state = {"battery":None,"experiments":dict(),"hashes":dict(),"subjects":[],"folder":None}
+    folder_id = get_battery_id(battery_dest)
+    for state_file in [get_battery_state_file(battery_dest),get_legacy_state_file(battery_dest)]:
+        if os.path.exists(state_file):
+            try:
+                with open(state_file,"r") as filey:
+                    saved = json.load(filey)
+            except (IOError,ValueError):
+                print("Cannot read %s, battery will be rebuilt." %(state_file))
+                continue
+            # The state file of an older version is in, and so belongs to, the battery folder
+            if state_file == get_legacy_state_file(battery_dest):
+                saved["folder"] = str(uuid.uuid4())
+                state.update(saved)
+                break
+            if folder_id != None and saved.get("folder") == folder_id:
+                state.update(saved)
+                break
+    return state
+
+
+def save_battery_state(battery_dest,state):
+    '''save_battery_state
+    save the state of a battery in the cache, see get_battery_state_file. A state file left in the
+    battery folder by an older version is removed
+    :param battery_dest: full path to battery destination folder
+    :param state: the state, as returned by load_battery_state
+    '''
+    state_file = get_battery_state_file(battery_dest)
+    if not os.path.exists(os.path.dirname(state_file)):
+        os.makedirs(os.path.dirname(state_file))
+    folder_id = get_battery_id(battery_dest)
+    if folder_id == None:
+        folder_id = state.get("folder") or str(uuid.uuid4())
+        with open("%s/.expfactory-battery-id" %(battery_dest),"w") as filey:
+            filey.write(folder_id)
+    state["folder"] = folder_id
+    save_json_atomic(state_file,state)
+    if os.path.exists(get_legacy_state_file(battery_dest)):
+        os.remove(get_legacy_state_file(battery_dest))
+
+
+def remove_folder(folder):
+    '''remove_folder
+    remove a folder, or a symbolic link to one (see move_experiments with link_strategy="symlink")
+    '''
+    if os.path.islink(folder):
+        os.unlink(folder)
+    elif os.path.exists(folder):
+        shutil.rmtree(folder)
+
+
+def update_battery_skeleton(battery_repo,battery_dest):
+    '''update_battery_skeleton
+    copy the battery skeleton to battery_dest, and return True. If battery_dest exists and was last updated from
+    a battery repo with the same content hash, it is kept as is. Otherwise it is removed and copied again. A folder
+    that exists but was not made by an update (it has no battery state, see load_battery_state) is not touched,
+    and False is returned.
+    :param battery_repo: full path to psiturk-battery repo template
+    :param battery_dest: full path to battery destination folder
+    '''
+    state = load_battery_state(battery_dest)
+    battery_hash = get_experiment_hash(battery_repo,cache=state["hashes"])[0]
+    if os.path.exists(battery_dest):
+        if state["folder"] == None:
+            print("Folder exists at %s and is not a battery made with --update, cannot generate." %(battery_dest))
+            return False
+        if state["battery"] == battery_hash:
+            return True
+        print("Battery template has changed, rebuilding %s" %(battery_dest))
+        shutil.rmtree(battery_dest)
+    copy_directory(battery_repo,battery_dest)
+    save_battery_state(battery_dest,{"battery":battery_hash,"experiments":dict(),"hashes":state["hashes"],"subjects":[]})
+    return True
+
+
+def update_experiments(valid_experiments,battery_dest,repo_type="experiments",link_strategy="copy"):
+    '''update_experiments
+    like move_experiments, but for a battery that already exists: experiments whose content hash
+    (see experiment.get_experiment_hash) is unchanged since the last update are left in place, new or
+    changed experiments are moved in, and experiments not in valid_experiments are removed.
+    :param valid_experiments: a list of full paths to valid experiments
+    :param battery_dest: full path to battery destination folder
+    :param repo_type: the kind of task to move (default is experiments)
+    :param link_strategy: see move_experiments
+    '''
+    state = load_battery_state(battery_dest)
+    experiment_dir = "%s/static/%s" %(battery_dest,repo_type)
+    names = [os.path.basename(x) for x in valid_experiments]
+
+    # Remove experiments that are no longer in the battery
+    if os.path.exists(experiment_dir):
+        for name in os.listdir(experiment_dir):
+            if name not in names:
+                remove_folder("%s/%s" %(experiment_dir,name))
+
+    hashes = dict()
+    changed = []
+    for valid_experiment,name in zip(valid_experiments,names):
+        hashes[name] = get_experiment_hash(valid_experiment,cache=state["hashes"])[0]
+        dest = "%s/%s" %(experiment_dir,name)
+        if state["experiments"].get(name) != hashes[name] or not os.path.lexists(dest):
+            remove_folder(dest)
+            changed.append(valid_experiment)
+
+    print("Updating %s of %s %s" %(len(changed),len(valid_experiments),repo_type))
+    moved = move_experiments(changed,battery_dest,repo_type=repo_type,link_strategy=link_strategy)
+    updated_experiments = [x for x in valid_experiments if x not in changed or x in moved]
+
+    state["experiments"] = dict([(os.path.basename(x),hashes[os.path.basename(x)]) for x in updated_experiments])
+    save_battery_state(battery_dest,state)
+    return updated_experiments
+
+
 def generate_config(battery_dest,fields):
     '''generate_config
     takes a dictionary, and for matching fields, substitues and prints to "config.txt" in a specified battery directory
@@ -275,35 +560,93 @@ def get_config():
     return config
 
 
+class BatteryPlan(object):
+    '''BatteryPlan
+    The experiments of a battery, with each config.json loaded once. The functions that generate
+    battery javascript and html accept a BatteryPlan in place of a list of experiment folders, so
+    a battery build reads each config.json a single time.
+    :param valid_experiments: a list of full paths to valid experiment folders, OR loaded config.json (dict)
+    :param configs: a list of already loaded config.json (eg, from get_experiments with load=True), in the same order as valid_experiments
+    '''
+    def __init__(self,valid_experiments,configs=None):
+        self.folders = []
+        self.experiments = []
+        if isinstance(valid_experiments,str):
+            valid_experiments = [valid_experiments]
+        for e in range(len(valid_experiments)):
+            valid_experiment = valid_experiments[e]
+            if isinstance(valid_experiment,dict):
+                self.folders.append(None)
+                self.experiments.append(valid_experiment)
+                continue
+            if configs != None:
+                experiment = configs[e]
+            else:
+                experiment = load_experiment(valid_experiment)
+            if isinstance(experiment,list):
+                experiment = experiment[0]
+            self.folders.append(valid_experiment)
+            self.experiments.append(experiment)
+
+    def __iter__(self):
+        return iter(self.experiments)
+
+    def __len__(self):
+        return len(self.experiments)
+
+    def get_exp_ids(self):
+        return [str(experiment["exp_id"]) for experiment in self.experiments]
+
+
+def get_battery_plan(valid_experiments):
+    '''get_battery_plan
+    return valid_experiments if it is already a BatteryPlan, otherwise load one
+    :param valid_experiments: a BatteryPlan, or a list of full paths to valid experiments
+    '''
+    if isinstance(valid_experiments,BatteryPlan):
+        return valid_experiments
+    return BatteryPlan(valid_experiments)
+
+
 def get_load_static(valid_experiments,url_prefix="",unique=True):
     '''get_load_static
     return the scripts and styles as <link> and <script> to embed in a page directly
+    :param valid_experiments: a BatteryPlan, or a list of full paths to valid experiments
     :param unique: return only unique scripts [default=True]
     '''
     loadstring = ""
-    for valid_experiment in valid_experiments:
-        experiment = load_experiment(valid_experiment)
-        css,js = get_stylejs(experiment,url_prefix=url_prefix)
+    for experiment in get_battery_plan(valid_experiments):
+        css,js = get_stylejs([experiment],url_prefix=url_prefix)
         loadstring = "%s%s%s" %(loadstring,js,css)        
     if unique == True:
         scripts = loadstring.split("\n")
-        scripts_index = list(set(scripts, return_index=True))[1]
         # This ensures that scripts are loaded in same order as specified in config.json
-        unique_scripts = [scripts[idx] for idx in sorted(scripts_index)]
+        seen = set()
+        unique_scripts = []
+        for script in scripts:
+            if script not in seen:
+                seen.add(script)
+                unique_scripts.append(script)
         loadstring = "\n".join(unique_scripts)
     return loadstring
 
+def get_battery_save(subject_id,deployment="local"):
+    '''get_battery_save
+    return javascript for a local battery to save its data when it finishes
+    :param subject_id: the subject id, used for the name of the results file
+    :param deployment: local (default) to download a csv in the browser, or local-server to POST to the server
+    '''
+    if deployment == "local-server":
+        return get_results_post('"%s"' %(subject_id),'"battery"').replace("\n","\n                        ")
+    return "jsPsych.data.localSave('%s.csv', 'csv');" %(subject_id)
+
 def get_experiment_run(valid_experiments,deployment="local"):
     '''get_experiment_run
     returns a dictionary of experiment run code (right now just jspsych init objects)
-    :param valid_experiments: full path to valid experiments folders, OR a loaded config.json (dict)
+    :param valid_experiments: a BatteryPlan, full path to valid experiments folders, OR a loaded config.json (dict)
     '''
     runs = dict()
-    for valid_experiment in valid_experiments:
-        if not isinstance(valid_experiment,dict):
-            experiment = load_experiment(valid_experiment)[0]
-        else:
-            experiment = valid_experiment
+    for experiment in get_battery_plan(valid_experiments):
         tag = str(experiment["exp_id"])
         if experiment["template"] == "jspsych":
             runcode = get_jspsych_init(experiment,deployment=deployment)
@@ -314,7 +657,7 @@ def get_experiment_run(valid_experiments,deployment="local"):
 def get_load_js(valid_experiments,url_prefix=""):
     '''get_load_js
     Return javascript to load list of valid experiments, based on psiturk.json
-    :param valid_experiments: a list of full paths to valid experiments to include
+    :param valid_experiments: a BatteryPlan, or a list of full paths to valid experiments to include
 
     ..note::
         Format is:
@@ -333,8 +676,7 @@ def get_load_js(valid_experiments,url_prefix=""):
 
     '''
     loadstring = "\n"
-    for valid_experiment in valid_experiments:
-        experiment = load_experiment(valid_experiment)[0]
+    for experiment in get_battery_plan(valid_experiments):
         tag = str(experiment["exp_id"])
         loadstring = '%scase "%s":\n' %(loadstring,tag)
         for script in experiment["run"]:
@@ -352,7 +694,7 @@ def get_load_js(valid_experiments,url_prefix=""):
 def get_concat_js(valid_experiments):
     '''get_concat_js
     Return javascript concat section for valid experiments, based on psiturk.json
-    :param valid_experiments: full paths to valid experiments to include
+    :param valid_experiments: a BatteryPlan, or full paths to valid experiments to include
 
     ..note::
 
@@ -367,8 +709,7 @@ def get_concat_js(valid_experiments):
 
     '''
     concatjs = "\n"
-    for valid_experiment in valid_experiments:
-        experiment = load_experiment(valid_experiment)[0]
+    for experiment in get_battery_plan(valid_experiments):
         tag = str(experiment["exp_id"])
         concatjs = '%scase "%s":\n' %(concatjs,tag)
         concatjs = '%s      experiments = experiments.concat(%s_experiment)\n' %(concatjs,tag)
@@ -378,7 +719,7 @@ def get_concat_js(valid_experiments):
 def get_timing_js(valid_experiments):
     '''get_timing_js
     Produce string (json / dictionary) of experiment timings
-    :param valid_experiments: a list of full paths to valid experiments to include
+    :param valid_experiments: a BatteryPlan, or a list of full paths to valid experiments to include
 
     ..note::
 
@@ -389,7 +730,6 @@ def get_timing_js(valid_experiments):
     
     '''
     timingjs = []
-    for valid_experiment in valid_experiments:
-        experiment = load_experiment(valid_experiment)[0]
+    for experiment in get_battery_plan(valid_experiments):
         timingjs.append({"name":str(experiment["exp_id"]),"time":experiment["time"]})
     return timingjs
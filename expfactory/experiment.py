@@ -4,13 +4,25 @@ Functions to work with javascript experiments
 
 '''
 
-from expfactory.utils import find_directories, remove_unicode_dict
+from expfactory.utils import find_directories, remove_unicode_dict, run_parallel, save_json_atomic
 from glob import glob
-import filecmp
+import threading
+import hashlib
 import json
 import re
 import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Version of the validated manifest format, see get_index_file
+INDEX_VERSION = 2
+
+# Held while the manifest is updated, along with a lock file for other processes, see update_index
+index_lock = threading.Lock()
 
 def get_validation_fields():
     '''get_validation_fields
@@ -41,12 +53,18 @@ def get_validation_fields():
             ("deployment_variables",0,str),
             ("template",1,str)]
 
-def notvalid(reason):
-    print(reason)
+def notvalid(reason,messages=None):
+    if messages == None:
+        print(reason)
+    else:
+        messages.append(reason)
     return False
 
-def dowarning(reason):
-    print(reason)
+def dowarning(reason,messages=None):
+    if messages == None:
+        print(reason)
+    else:
+        messages.append(reason)
 
 def get_valid_templates():
     return ['jspsych','survey','phaser','custom']
@@ -68,10 +86,11 @@ def get_acceptable_values(package_name):
     return acceptable_values[package_name]
 
 
-def validate(experiment_folder=None,warning=True):
+def validate(experiment_folder=None,warning=True,messages=None):
     '''validate
     :param experiment_folder: full path to experiment folder with config.json
     :param warning: issue a warning for empty fields with level 2 (warning)
+    :param messages: a list to append validation messages to. If None (default) messages are printed
 
     ..note::
 
@@ -86,16 +105,19 @@ def validate(experiment_folder=None,warning=True):
     if experiment_folder==None:
         experiment_folder=os.path.abspath(os.getcwd())
 
+    if not os.path.exists("%s/config.json" %(experiment_folder)):
+        return notvalid("%s is not an experiment." %(experiment_folder),messages)
+
     try:
         meta = load_experiment(experiment_folder)
         if meta == False:
-            return notvalid("%s is not an experiment." %(experiment_folder))
+            return notvalid("%s is not an experiment." %(experiment_folder),messages)
         experiment_name = os.path.basename(experiment_folder)
     except:
-        return notvalid("%s: config.json is not loadable." %(experiment_folder))
+        return notvalid("%s: config.json is not loadable." %(experiment_folder),messages)
 
     if len(meta)>1:
-        return notvalid("%s: config.json has length > 1, not valid." %(experiment_folder))
+        return notvalid("%s: config.json has length > 1, not valid." %(experiment_folder),messages)
     fields = get_validation_fields()
     valid_templates = get_valid_templates()
 
@@ -103,151 +125,361 @@ def validate(experiment_folder=None,warning=True):
 
         # Field must be in the keys if required
         if field not in meta[0].keys() and value == 1:
-            return notvalid("%s: config.json is missing required field %s" %(experiment_name,field))
+            return notvalid("%s: config.json is missing required field %s" %(experiment_name,field),messages)
         else:
             if value == 2:
                 if warning == True:
-                    dowarning("WARNING: config.json is missing field %s: %s" %(field,experiment_name))
+                    dowarning("WARNING: config.json is missing field %s: %s" %(field,experiment_name),messages)
 
         if field == "exp_id":
             # Tag must correspond with folder name
             if meta[0][field] != experiment_name:
-                return notvalid("%s: exp_id parameter %s does not match folder name." %(experiment_name,meta[0][field]))
+                return notvalid("%s: exp_id parameter %s does not match folder name." %(experiment_name,meta[0][field]),messages)
 
             # name cannot have special characters, only _ and letters/numbers
             if not re.match("^[a-z0-9_]*$", meta[0][field]): 
-                return notvalid("%s: exp_id parameter %s has invalid characters, only lowercase [a-z],[0-9], and _ allowed." %(experiment_name,meta[0][field]))
+                return notvalid("%s: exp_id parameter %s has invalid characters, only lowercase [a-z],[0-9], and _ allowed." %(experiment_name,meta[0][field]),messages)
 
         # Check if experiment is production ready
         if field == "publish":
             if meta[0][field] == "False":
-                return notvalid("%s: config.json specifies not production ready." %experiment_name)
+                return notvalid("%s: config.json specifies not production ready." %experiment_name,messages)
 
         # Run must be a list of strings
         if field == "run":
             # Is it a list?
             if not isinstance(meta[0][field],ftype):
-                return notvalid("%s: field %s must be %s" %(experiment_name,field,ftype))
+                return notvalid("%s: field %s must be %s" %(experiment_name,field,ftype),messages)
             # Is an experiment.js defined
             # Is each script in the list a string?
             for script in meta[0][field]:
                 # If we have a single file, is it in the experiment folder?
                 if len(script.split("/")) == 1:
                     if not os.path.exists("%s/%s" %(experiment_folder,script)):
-                        return notvalid("%s: %s is specified in config.json but missing." %(experiment_name,script))
+                        return notvalid("%s: %s is specified in config.json but missing." %(experiment_name,script),messages)
                 # Do we have an external script? It must be https
                 if re.search("http",script) and not re.search("https",script):
-                    return notvalid("%s: external script %s must be https." %(experiment_name,script))
+                    return notvalid("%s: external script %s must be https." %(experiment_name,script),messages)
                 
 
         # Below is for required parameters
         if value == 1:
             if meta[0][field] == "":
-                return notvalid("%s: config.json must be defined for field %s" %(experiment_name,field))
+                return notvalid("%s: config.json must be defined for field %s" %(experiment_name,field),messages)
             # Field value must have minimum of value entries
             if not isinstance(meta[0][field],list):
                 tocheck = [meta[0][field]]
             else:
                 tocheck = meta[0][field]
             if len(tocheck) < value:
-                return notvalid("%s: config.json must have >= %s for field %s" %(experiment_name,value,field))
+                return notvalid("%s: config.json must have >= %s for field %s" %(experiment_name,value,field),messages)
         
         # Below is for warning parameters
         elif value == 2:
             if meta[0][field] == "":
                 if warning == True:
-                    dowarning("WARNING: config.json is missing value for field %s: %s" %(field,experiment_name))
+                    dowarning("WARNING: config.json is missing value for field %s: %s" %(field,experiment_name),messages)
 
         # Check the experiment template, currently valid are jspsych and survey
         if field == "template":
             if meta[0][field] not in valid_templates:
-                return notvalid("%s: we currently only support %s experiments." %(experiment_name,",".join(valid_templates)))
+                return notvalid("%s: we currently only support %s experiments." %(experiment_name,",".join(valid_templates)),messages)
 
             # Jspsych javascript experiment
             if meta[0][field] == "jspsych":
                 if "run" in meta[0]:
                     if "experiment.js" not in meta[0]["run"]:
-                        return notvalid("%s: experiment.js is not defined in run" %(experiment_name))
+                        return notvalid("%s: experiment.js is not defined in run" %(experiment_name),messages)
                 else:
-                    return notvalid("%s: config.json is missing required field run" %(experiment_name))
+                    return notvalid("%s: config.json is missing required field run" %(experiment_name),messages)
 
             # Material Design light survey
             elif meta[0][field] == "survey":
                 if not os.path.exists("%s/survey.tsv" %(experiment_folder)):
-                    return notvalid("%s: required survey.tsv for template survey not found." %(experiment_name))
+                    return notvalid("%s: required survey.tsv for template survey not found." %(experiment_name),messages)
 
             # Phaser game
             elif meta[0][field] == "phaser":
                 if not os.path.exists("%s/Run.js" %(experiment_folder)):
-                    return notvalid("%s: required Run.js main game file not found." %(experiment_name))
+                    return notvalid("%s: required Run.js main game file not found." %(experiment_name),messages)
                 if "run" not in meta[0]["deployment_variables"]:
-                    return notvalid("%s: 'run' (code) is required in deployment_variables" %(experiment_name))
+                    return notvalid("%s: 'run' (code) is required in deployment_variables" %(experiment_name),messages)
 
         # Validation for deployment_variables
         if field == "deployment_variables":
             if "deployment_variables" in meta[0]:
                 if "jspsych_init" in meta[0][field]:
-                    check_acceptable_variables(experiment_name,meta[0][field],"jspsych","jspsych_init")
+                    check_acceptable_variables(experiment_name,meta[0][field],"jspsych","jspsych_init",messages)
                     
                 elif "survey" in meta[0][field]:
-                    check_acceptable_variables(experiment_name,meta[0][field],"survey","material_design")
+                    check_acceptable_variables(experiment_name,meta[0][field],"survey","material_design",messages)
 
     return True
 
 
-def check_acceptable_variables(experiment_name,field_dict,template,field_dict_key):
+def check_acceptable_variables(experiment_name,field_dict,template,field_dict_key,messages=None):
     '''check_acceptable_variables takes a field (eg, meta[0][field]) that has a dictionary, and some template key (eg, jspsych) and makes sure the keys of the dictionary are within the allowable for the template type (the key).
     :param experiment_name: the name of the experiment
     :param field_dict: the field value from the config.json, a dictionary
     :param field_dict_key: a key to look up in the field_dict, which should contain a dictionary of {"key":"value"} variables
     :param template: the key name, for looking up acceptable values using get_acceptable_values
+    :param messages: a list to append validation messages to. If None (default) messages are printed
     '''
     acceptable_values = get_acceptable_values(template)
     for acceptable_var,acceptable_val in field_dict[field_dict_key].items():
         if acceptable_var not in acceptable_values:
-            return notvalid("%s: %s is not an acceptable value for %s." %(experiment_name,acceptable_var,field_dict_key))
+            return notvalid("%s: %s is not an acceptable value for %s." %(experiment_name,acceptable_var,field_dict_key),messages)
 
         # Jspsych specific validation
         if template == "jspsych":
             # Variables that must be boolean
             if acceptable_var in ["show_progress_bar","fullscreen","skip_load_check"]:
-                check_boolean(experiment_name,acceptable_val,acceptable_var)      
+                check_boolean(experiment_name,acceptable_val,acceptable_var,messages)      
 
             # Variables that must be numeric
             if acceptable_var in ["default_iti","max_load_time"]:
                 if isinstance(acceptable_val,str) or isinstance(acceptable_val,bool):
-                    return notvalid("%s: %s is not an acceptable value for %s in %s. Must be numeric." %(experiment_name,acceptable_val,acceptable_var,field_dict_key))
+                    return notvalid("%s: %s is not an acceptable value for %s in %s. Must be numeric." %(experiment_name,acceptable_val,acceptable_var,field_dict_key),messages)
 
         elif template == "survey":
             # Variables that must be boolean
             if acceptable_var in ["show_progress_bar","fullscreen","skip_load_check"]:
-                check_boolean(experiment_name,acceptable_val,acceptable_var)         
+                check_boolean(experiment_name,acceptable_val,acceptable_var,messages)         
 
-def check_boolean(experiment_name,value,variable_name):
+def check_boolean(experiment_name,value,variable_name,messages=None):
     '''check_boolean checks if a value is boolean
     :param experiment_name: the name of the experiment
     :param value: the value to check
     :param variable_name: the name of the variable (the key being indexed in the dictionary)
+    :param messages: a list to append validation messages to. If None (default) messages are printed
     '''
     if value not in [True,False]:
-        return notvalid("%s: %s is not an acceptable value for %s. Must be true/false." %(experiment_name,value,varialbe_name))
+        return notvalid("%s: %s is not an acceptable value for %s. Must be true/false." %(experiment_name,value,variable_name),messages)
 
 
-def get_experiments(experiment_repo, load=False, warning=True, repo_type="experiments"):
+def get_experiments(experiment_repo, load=False, warning=True, repo_type="experiments", workers=None, index=False):
     '''get_experiments
     return loaded json for all valid experiments from an experiment folder
     :param experiment_repo: full path to the experiments repo
     :param load: if True, returns a list of loaded config.json objects. If False (default) returns the paths to the experiments
     :param repo_type: tells the user what kind of task is being parsed, default is "experiments," but can also be "surveys" when called by get_surveys
+    :param workers: number of threads to validate experiment folders with. If None (default) folders are validated one at a time
+    :param index: if True, use (and update) the validated manifest saved in the repo (see get_index_file), revalidating only experiments with changed files. Default is False
     '''
-    experiments = find_directories(experiment_repo)
-    valid_experiments = [e for e in experiments if validate(e,warning)]
+    experiments = sorted(find_directories(experiment_repo))
+    if index == True:
+        results = validate_experiments_index(experiment_repo,experiments,workers=workers)
+    else:
+        results = validate_experiments(experiments,warning=warning,workers=workers)
+
+    valid_experiments = []
+    configs = []
+    for result in results:
+        experiment,valid,messages = result[0:3]
+        for message in messages:
+            if warning == True or not message.startswith("WARNING"):
+                print(message)
+        if valid == True:
+            valid_experiments.append(experiment)
+            if index == True:
+                configs.append([result[3]])
+
     print("Found %s valid %s" %(len(valid_experiments),repo_type))
     if load == True:
+        if index == True:
+            return configs
         valid_experiments = load_experiments(valid_experiments)
     return valid_experiments
 
 
+def validate_experiments(experiment_folders,warning=True,workers=None):
+    '''validate_experiments
+    validate a list of experiment folders, optionally in parallel, returning a list of
+    (experiment_folder,valid,messages) in the same order as experiment_folders
+    :param experiment_folders: a list of full paths to experiment folders
+    :param warning: collect warnings for empty fields with level 2 (warning)
+    :param workers: number of threads to validate with. If None or 1, folders are validated one at a time
+    '''
+    tasks = [(experiment_folder,warning) for experiment_folder in experiment_folders]
+    return run_parallel(validate_experiment_task,tasks,workers=workers)
+
+
+def validate_experiment_task(task):
+    '''validate_experiment_task
+    worker for validate_experiments, validates one folder and collects messages instead of printing
+    :param task: a tuple (experiment_folder,warning)
+    '''
+    experiment_folder,warning = task
+    messages = []
+    valid = validate(experiment_folder,warning=warning,messages=messages)
+    return (experiment_folder,valid,messages)
+
+
+# VALIDATED MANIFEST ###########################################################
+
+def get_index_file(experiment_repo):
+    '''get_index_file
+    return the path to the validated manifest for an experiment repo, saved in the repo base
+    :param experiment_repo: full path to the experiments (or surveys, games) repo
+    '''
+    return "%s/.expfactory-index.json" %(os.path.abspath(experiment_repo))
+
+
+def load_index(experiment_repo):
+    '''load_index
+    load the validated manifest for an experiment repo. If it does not exist, cannot be read, or was
+    written by a different version of the manifest format, an empty manifest is returned
+    :param experiment_repo: full path to the experiments repo
+    '''
+    index = {"version":INDEX_VERSION,"experiments":dict(),"hashes":dict()}
+    index_file = get_index_file(experiment_repo)
+    if os.path.exists(index_file):
+        try:
+            with open(index_file,"r") as filey:
+                saved = json.load(filey)
+            if saved.get("version") == INDEX_VERSION:
+                index.update(saved)
+        except (IOError,ValueError):
+            print("Cannot read %s, experiments will be revalidated." %(index_file))
+    return index
+
+
+def save_index(experiment_repo,index):
+    '''save_index
+    write the validated manifest for an experiment repo. The file is written to a temporary
+    file first and then renamed, so readers never see a partial manifest.
+    :param experiment_repo: full path to the experiments repo
+    :param index: the manifest, as returned by load_index
+    '''
+    index_file = get_index_file(experiment_repo)
+    try:
+        save_json_atomic(index_file,index)
+    except (IOError,OSError) as e:
+        print("Cannot write %s: %s" %(index_file,e))
+
+
+def update_index(experiment_repo,update):
+    '''update_index
+    load the manifest for an experiment repo, change it with update(index), and save it, holding a lock
+    so that concurrent updates (eg, validation and file hashes) are merged instead of overwriting each other.
+    If update returns False, nothing changed and the manifest is not saved. Returns the updated manifest.
+    :param experiment_repo: full path to the experiments repo
+    :param update: a function that changes the manifest in place
+    '''
+    index_file = get_index_file(experiment_repo)
+    with index_lock:
+        lockfile = None
+        if fcntl != None:
+            try:
+                lockfile = open("%s.lock" %(index_file),"a")
+                fcntl.flock(lockfile.fileno(),fcntl.LOCK_EX)
+            except (IOError,OSError):
+                if lockfile != None:
+                    lockfile.close()
+                lockfile = None
+        try:
+            index = load_index(experiment_repo)
+            if update(index) != False:
+                save_index(experiment_repo,index)
+            return index
+        finally:
+            if lockfile != None:
+                fcntl.flock(lockfile.fileno(),fcntl.LOCK_UN)
+                lockfile.close()
+
+
+def get_file_fingerprint(filename):
+    '''get_file_fingerprint
+    return [mtime,size,ctime,inode] for a file, or None if the file does not exist. The ctime and inode
+    change when a file is replaced or copied over, even if its mtime and size are preserved (eg, copy2)
+    '''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_mtime,stat.st_size,stat.st_ctime,stat.st_ino]
+
+
+def get_fingerprints(experiment_folder):
+    '''get_fingerprints
+    return a dictionary of fingerprints (see get_file_fingerprint) for every file that validation
+    of an experiment folder depends on: the config.json, files named in "run," and template files
+    :param experiment_folder: full path to the experiment folder
+    '''
+    filenames = ["config.json","survey.tsv","Run.js"]
+    try:
+        with open("%s/config.json" %(experiment_folder),"r") as filey:
+            meta = json.load(filey)
+        filenames = filenames + [x for x in meta[0]["run"] if len(x.split("/")) == 1]
+    except:
+        pass
+    fingerprints = dict()
+    for filename in filenames:
+        fingerprints[filename] = get_file_fingerprint("%s/%s" %(experiment_folder,filename))
+    return fingerprints
+
+
+def is_index_current(experiment_folder,entry):
+    '''is_index_current
+    returns True if none of the files recorded for an experiment in the manifest have changed
+    :param experiment_folder: full path to the experiment folder
+    :param entry: the manifest entry for the experiment
+    '''
+    if entry == None or "files" not in entry:
+        return False
+    for filename,fingerprint in entry["files"].items():
+        if get_file_fingerprint("%s/%s" %(experiment_folder,filename)) != fingerprint:
+            return False
+    return True
+
+
+def index_experiment_task(experiment_folder):
+    '''index_experiment_task
+    worker for validate_experiments_index, returns a new manifest entry for an experiment folder.
+    Fingerprints are taken before validation, so a file changed during validation is caught next time.
+    :param experiment_folder: full path to the experiment folder
+    '''
+    fingerprints = get_fingerprints(experiment_folder)
+    messages = []
+    valid = validate(experiment_folder,warning=True,messages=messages)
+    config = None
+    if valid == True:
+        config = load_experiment(experiment_folder)[0]
+    return {"valid":valid,"messages":messages,"config":config,"files":fingerprints}
+
+
+def validate_experiments_index(experiment_repo,experiment_folders,workers=None):
+    '''validate_experiments_index
+    validate experiment folders using the manifest saved in the experiment repo. Only experiments with
+    changed files (or new experiments) are revalidated, and the manifest is updated. Returns a list of
+    (experiment_folder,valid,messages,config) in the same order as experiment_folders
+    :param experiment_repo: full path to the experiments repo
+    :param experiment_folders: a list of full paths to experiment folders in the repo
+    :param workers: number of threads to validate changed experiments with
+    '''
+    entries = load_index(experiment_repo)["experiments"]
+    names = [os.path.basename(x) for x in experiment_folders]
+    stale = [x for x,name in zip(experiment_folders,names) if not is_index_current(x,entries.get(name))]
+    removed = [name for name in entries if name not in names]
+    validated = dict(zip([os.path.basename(x) for x in stale],run_parallel(index_experiment_task,stale,workers=workers)))
+
+    for name in removed:
+        del entries[name]
+    entries.update(validated)
+
+    # Merge with the saved manifest, which may have changed during validation
+    def merge_entries(index):
+        for name in removed:
+            index["experiments"].pop(name,None)
+        index["experiments"].update(validated)
+
+    if len(stale) > 0 or len(removed) > 0:
+        update_index(experiment_repo,merge_entries)
+
+    return [(x,entries[name]["valid"],entries[name]["messages"],entries[name]["config"])
+            for x,name in zip(experiment_folders,names)]
+
+
 def load_experiments(experiment_folders):
     '''load_experiments
     a wrapper for load_experiment to read multiple experiments
@@ -280,38 +512,177 @@ def load_experiment(experiment_folder):
         print("Problem reading config.json, %s" %(e))
         raise
 
-def find_changed(new_repo,comparison_repo,return_experiments=True,repo_type="experiments"):
-    '''find_changed returns a list of changed files or experiments between two repos
+# CONTENT HASHES ###############################################################
+
+def get_file_hash(filename,cache=None,cache_key=None):
+    '''get_file_hash
+    return the sha256 hex digest of a file. If a cache dictionary is provided, a file whose fingerprint
+    matches the cached entry is not read again
+    :param filename: full path to the file
+    :param cache: a dictionary of {cache_key:fingerprint + [hash]} to look up and update, see get_file_fingerprint
+    :param cache_key: the key for the file in the cache, defaults to filename
+    '''
+    if cache_key == None:
+        cache_key = filename
+    fingerprint = get_file_fingerprint(filename)
+    if cache != None:
+        cached = cache.get(cache_key)
+        if cached != None and cached[:-1] == fingerprint:
+            return cached[-1]
+    sha = hashlib.sha256()
+    with open(filename,"rb") as filey:
+        for chunk in iter(lambda: filey.read(1024*1024),b""):
+            sha.update(chunk)
+    file_hash = sha.hexdigest()
+    if cache != None:
+        cache[cache_key] = fingerprint + [file_hash]
+    return file_hash
+
+
+def get_experiment_hash(experiment_folder,cache=None):
+    '''get_experiment_hash
+    return a Merkle hash for an experiment folder, a hash of the sorted (relative path, file hash) pairs,
+    along with a dictionary of the file hashes. Two folders with the same hash have identical content.
+    :param experiment_folder: full path to the experiment folder
+    :param cache: a dictionary of file hashes, see get_file_hash. Keys are "[folder]/[relative path]"
+    '''
+    experiment_folder = os.path.abspath(experiment_folder)
+    name = os.path.basename(experiment_folder)
+    file_hashes = dict()
+    for root, dirnames, filenames in os.walk(experiment_folder):
+        for filename in filenames:
+            fullpath = os.path.join(root,filename)
+            relpath = os.path.relpath(fullpath,experiment_folder).replace(os.sep,"/")
+            file_hashes[relpath] = get_file_hash(fullpath,cache=cache,cache_key="%s/%s" %(name,relpath))
+    sha = hashlib.sha256()
+    for relpath in sorted(file_hashes):
+        sha.update(("%s\0%s\n" %(relpath,file_hashes[relpath])).encode("utf-8"))
+    return sha.hexdigest(),file_hashes
+
+
+def get_repo_hashes(experiment_repo,experiment_folders=None,cache=True,workers=None):
+    '''get_repo_hashes
+    return a dictionary {folder name: {"hash":Merkle hash,"files":{relative path:hash}}} for experiment
+    folders in a repo. File hashes are cached in the repo manifest (see get_index_file), so only new
+    or modified files are read.
+    :param experiment_repo: full path to the experiments repo
+    :param experiment_folders: the experiment folders to hash. If None, all folders in the repo are used
+    :param cache: use and update the file hash cache in the repo manifest (default True)
+    :param workers: number of threads to hash experiment folders with
+    '''
+    if experiment_folders == None:
+        experiment_folders = find_directories(experiment_repo)
+    names = [os.path.basename(x) for x in experiment_folders]
+
+    # Group cached file hashes by experiment folder
+    index = None
+    folder_caches = dict([(name,dict()) for name in names])
+    if cache == True:
+        index = load_index(experiment_repo)
+        for cache_key,cached in index["hashes"].items():
+            name = cache_key.split("/")[0]
+            if name in folder_caches:
+                folder_caches[name][cache_key] = cached
+
+    tasks = [(x,folder_caches[name]) for x,name in zip(experiment_folders,names)]
+    hashes = dict(zip(names,run_parallel(hash_experiment_task,tasks,workers=workers)))
+
+    # Only keep cached hashes for files that still exist in hashed folders
+    if cache == True:
+        cached = dict()
+        for name in names:
+            for relpath in hashes[name]["files"]:
+                cache_key = "%s/%s" %(name,relpath)
+                cached[cache_key] = folder_caches[name][cache_key]
+
+        # Merge with the saved manifest, which may have changed while hashing
+        def merge_hashes(index):
+            updated = dict([(k,v) for k,v in index["hashes"].items() if k.split("/")[0] not in folder_caches])
+            updated.update(cached)
+            if updated == index["hashes"]:
+                return False
+            index["hashes"] = updated
+
+        update_index(experiment_repo,merge_hashes)
+    return hashes
+
+
+def hash_experiment_task(task):
+    '''hash_experiment_task
+    worker for get_repo_hashes, returns {"hash":Merkle hash,"files":file hashes} for one experiment folder
+    :param task: a tuple (experiment_folder,cache)
+    '''
+    experiment_folder,cache = task
+    experiment_hash,file_hashes = get_experiment_hash(experiment_folder,cache=cache)
+    return {"hash":experiment_hash,"files":file_hashes}
+
+
+def save_snapshot(experiment_repo,snapshot_file,experiment_folders=None):
+    '''save_snapshot
+    save the Merkle hashes of an experiment repo to a snapshot file, to later compare against with find_changed
+    :param experiment_repo: full path to the experiments repo
+    :param snapshot_file: the output json file
+    :param experiment_folders: the experiment folders to include. If None, all folders in the repo are used
+    '''
+    snapshot = {"version":INDEX_VERSION,
+                "experiments":get_repo_hashes(experiment_repo,experiment_folders)}
+    with open(snapshot_file,"w") as filey:
+        filey.write(json.dumps(snapshot,sort_keys=True,indent=4,separators=(',', ': ')))
+    return snapshot
+
+
+def load_snapshot(snapshot_file):
+    '''load_snapshot
+    load the experiment hashes from a snapshot file saved with save_snapshot
+    :param snapshot_file: the snapshot json file
+    '''
+    with open(snapshot_file,"r") as filey:
+        snapshot = json.load(filey)
+    return snapshot["experiments"]
+
+
+def find_changed(new_repo,comparison_repo,return_experiments=True,repo_type="experiments",cache=True,cache_comparison=False):
+    '''find_changed returns a list of changed files or experiments between two repos, comparing
+    Merkle hashes of experiment folders (see get_experiment_hash) so that unchanged experiments are never compared file by file
     :param new_repo: the updated repo - any new files, or changed files, will be returned
-    :param comparison_repo: the old repo to compare against. A file changed or missing in this repo in the new_repo indicates it should be tested
+    :param comparison_repo: the old repo to compare against, or a snapshot file saved with save_snapshot. A file changed or missing in this repo in the new_repo indicates it should be tested
     :param return_experiments: return experiment folders. Default is True. If False, will return complete file list
+    :param cache: cache file hashes in the manifest of new_repo (default True)
+    :param cache_comparison: cache file hashes in the manifest of comparison_repo. Default is False, so a checkout
+                             that is only compared against is not written to
     ''' 
     # First find all experiment folders in current repo
     experiment_folders = get_experiments(new_repo,load=False,warning=False,repo_type=repo_type)
-    file_list = []
-    # Find all files
-    for experiment_folder in experiment_folders:
-        for root, dirnames, filenames in os.walk(experiment_folder):
-            for filename in filenames:
-                file_list.append(os.path.join(root, filename))
-    # Compare against master
-    changed_files = []
-    for contender_file in file_list:
-        old_file = contender_file.replace("%s/expfactory-%s" %(os.environ["HOME"],repo_type),comparison_repo)
-        # If the old file exists, check if it's changed
-        if os.path.exists(old_file):
-            if not filecmp.cmp(old_file,contender_file):
-                changed_files.append(contender_file)
-        # If it doesn't exist, we check
-        else:
-            changed_files.append(contender_file)
+    new_hashes = get_repo_hashes(new_repo,experiment_folders,cache=cache)
 
-    # Find differences with compare
-    print("Found files changed: %s" %(",".join(changed_files)))
+    # Compare against the snapshot, or the same experiments in the comparison repo
+    if os.path.isfile(comparison_repo):
+        old_hashes = load_snapshot(comparison_repo)
+    else:
+        comparison_folders = ["%s/%s" %(comparison_repo,x) for x in new_hashes]
+        comparison_folders = [x for x in comparison_folders if os.path.isdir(x)]
+        old_hashes = get_repo_hashes(comparison_repo,comparison_folders,cache=cache_comparison)
+
+    changed_experiments = [x for x in experiment_folders
+                           if os.path.basename(x) not in old_hashes
+                           or old_hashes[os.path.basename(x)]["hash"] != new_hashes[os.path.basename(x)]["hash"]]
 
     if return_experiments == True:
-        return list(set([os.path.dirname(x.strip("\n")) for x in changed_files if os.path.dirname(x.strip("\n")) != ""]))
-  
+        print("Found %s changed: %s" %(repo_type,",".join([os.path.basename(x) for x in changed_experiments])))
+        return changed_experiments
+
+    # Only changed experiments are compared file by file
+    changed_files = []
+    for experiment_folder in changed_experiments:
+        name = os.path.basename(experiment_folder)
+        old_files = dict()
+        if name in old_hashes:
+            old_files = old_hashes[name]["files"]
+        for relpath,file_hash in sorted(new_hashes[name]["files"].items()):
+            if old_files.get(relpath) != file_hash:
+                changed_files.append("%s/%s" %(experiment_folder,relpath))
+
+    print("Found files changed: %s" %(",".join(changed_files)))
     return changed_files
 
 
@@ -5,7 +5,7 @@ graph.py: part of expfactory
 Functions to work with ontology graphs
 
 '''
-from expfactory.utils import get_installdir, get_template, sub_template
+from expfactory.utils import get_installdir, get_compiled_template
 import re
 import sys
 import json
@@ -317,11 +317,11 @@ def make_tree_from_triples(triples,output_html=False,meta_data=None,delim="\t",p
         concept_lookup["all_experiments"] = orphan_experiment_nodes.keys()
 
         # Plug everything into the template
-        template = get_template("%s/templates/experiments_categories.html" %get_installdir())
-        template = sub_template(template,"[[SUB_LOOKUP_SUB]]",str(concept_lookup))
-        template = sub_template(template,"[[SUB_EXPERIMENTS_SUB]]",html_experiments)
-        template = sub_template(template,"[[SUB_NAVIGATION_SUB]]",html_snippet)           
-        graph = template        
+        substitutions = {"[[SUB_LOOKUP_SUB]]":str(concept_lookup),
+                         "[[SUB_EXPERIMENTS_SUB]]":html_experiments,
+                         "[[SUB_NAVIGATION_SUB]]":html_snippet}
+        template = get_compiled_template("%s/templates/experiments_categories.html" %get_installdir(),substitutions.keys())
+        graph = template.render(substitutions)
     return graph
 
 
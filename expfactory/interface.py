@@ -3,10 +3,18 @@ from expfactory.vm import custom_battery_download, add_custom_logo, generate_dat
 from expfactory.experiment import validate, load_experiment, get_experiments, make_lookup
 from expfactory.utils import copy_directory, get_installdir, sub_template
 from expfactory.battery import generate, generate_config
-from flask import Flask, render_template, request
+from expfactory.jobs import JobQueue
+from expfactory.workspace import WorkspaceManager
+from flask import Flask, Response, render_template, request, jsonify, send_file, url_for
 from flask_restful import Resource, Api
-from werkzeug import secure_filename
+try:
+    from werkzeug import secure_filename
+except ImportError:
+    from werkzeug.utils import secure_filename
 import webbrowser
+import threading
+import hashlib
+import json
 import tempfile
 import shutil
 import random
@@ -18,20 +26,127 @@ class EFServer(Flask):
     def __init__(self, *args, **kwargs):
             super(EFServer, self).__init__(*args, **kwargs)
 
-            # download repo on start of application
+            # repos are downloaded in the background (see start_loading), so the server can answer right away.
+            # tmpdir is a catalog that is only read from: each build gets its own workspace over it
             self.tmpdir = tempfile.mkdtemp()
-            custom_battery_download(tmpdir=self.tmpdir)
-            self.experiments = get_experiments("%s/experiments" %self.tmpdir,load=True,warning=False)
-            self.experiment_lookup = make_lookup(self.experiments,"exp_id")
+            self.workspaces = WorkspaceManager(self.tmpdir)
+            self.experiments = []
+            self.experiment_lookup = dict()
+            self.status = "loading"
+            self.error = None
+            self.loader = None
+            self.lock = threading.Lock()
+
+            # serialized responses of the experiments API, see get_experiments_page
+            self.pages = dict()
+
+            # battery builds run as jobs, see expfactory.jobs
+            self.jobs = JobQueue()
+
+    def start_loading(self,retry=False):
+        '''start_loading
+        download repos and load experiments in a background thread, if not already started
+        :param retry: if True, start again if the last loading failed
+        '''
+        with self.lock:
+            if self.loader == None or (retry == True and self.status == "error"):
+                self.status = "loading"
+                self.error = None
+                self.loader = threading.Thread(target=self.load)
+                self.loader.daemon = True
+                self.loader.start()
+        return self.loader
+
+    def load(self):
+        '''load
+        download repos and load experiments, setting status to "ready", or to "error" if this fails
+        '''
+        try:
+            custom_battery_download(tmpdir=self.tmpdir,repos=["experiments","battery","surveys","games","vm"])
+            experiments = get_experiments("%s/experiments" %self.tmpdir,load=True,warning=False,index=True)
+            self.experiment_lookup = make_lookup(experiments,"exp_id")
+            self.experiments = experiments
+            self.status = "ready"
+
+            # The response with all experiments is ready for the first request
+            self.get_experiments_page(dict())
+        except Exception as error:
+            print("Error loading experiments: %s" %(error))
+            self.error = str(error)
+            self.status = "error"
+
+    def is_ready(self):
+        return self.status == "ready"
+
+    def get_experiments_page(self,args):
+        '''get_experiments_page
+        return a dictionary with the serialized body, etag and headers of a response of the experiments API.
+        Responses are cached for each set of query parameters until experiments are loaded again.
+        :param args: the request arguments, see apiExperiments
+        '''
+        key = get_page_args(args)
+        page = self.pages.get(key)
+        if page != None and page["experiments"] is self.experiments:
+            return page
+
+        page_args = dict(key)
+        experiments = filter_experiments(self.experiments,
+                                         template=page_args.get("template"),
+                                         cognitive_atlas_task_id=page_args.get("cognitive_atlas_task_id"),
+                                         max_time=page_args.get("max_time"))
+        headers = {"X-Total-Count":str(len(experiments))}
+        if "page" in page_args:
+            number,per_page = page_args["page"],page_args["per_page"]
+            links = []
+            if number * per_page < len(experiments):
+                links.append((number + 1,"next"))
+            if number > 1:
+                links.append((number - 1,"prev"))
+            query = dict([x for x in key if x[0] != "page"])
+            if len(links) > 0:
+                headers["Link"] = ", ".join(['<%s>; rel="%s"' %(url_for("experiments",page=x,**query),rel) for x,rel in links])
+            experiments = experiments[(number - 1) * per_page:number * per_page]
+        if "fields" in page_args:
+            fields = page_args["fields"].split(",")
+            experiments = [[dict([(x,e[0][x]) for x in fields if x in e[0]])] for e in experiments]
+
+        body = json.dumps(experiments)
+        page = {"experiments":self.experiments,
+                "body":body,
+                "etag":hashlib.sha1(body.encode("utf-8")).hexdigest(),
+                "headers":headers}
+        with self.lock:
+            if len(self.pages) >= 256:
+                self.pages = dict()
+            self.pages[key] = page
+        return page
 
 # API VIEWS #########################################################
 class apiExperiments(Resource):
     '''apiExperiments
-    Main view for REST API to display all available experiments
+    Main view for REST API to display all available experiments. Query parameters:
+    template, cognitive_atlas_task_id: only experiments with these values (comma separated for many)
+    max_time: only experiments that take at most this many minutes
+    fields: comma separated fields of the config.json to return (default is all)
+    page, per_page: return one page of experiments. The total is in the X-Total-Count header, and
+                    links to other pages in the Link header
+    Responses have an ETag, and If-None-Match is answered with 304 Not Modified.
     '''
     def get(self):
-        experiment_json = app.experiments
-        return experiment_json
+        if not app.is_ready():
+            return {"status":app.status},503
+        try:
+            page = app.get_experiments_page(request.args)
+        except ValueError as error:
+            return {"message":str(error)},400
+        if page["etag"] in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(page["body"],mimetype="application/json")
+        response.set_etag(page["etag"])
+        for header,value in page["headers"].items():
+            response.headers[header] = value
+        return response
 
 class apiExperimentSingle(Resource):
     '''apiExperimentSingle
@@ -39,11 +154,65 @@ class apiExperimentSingle(Resource):
     :param exp_id: exp_id for experiment to preview
     '''
     def get(self, exp_id):
+        if not app.is_ready():
+            return {"status":app.status},503
+        if exp_id not in app.experiment_lookup:
+            return {"message":"There is no experiment %s" %(exp_id)},404
         return {exp_id: app.experiment_lookup[exp_id]}
 
+def get_page_args(args):
+    '''get_page_args
+    check and normalize the query parameters of the experiments API (see apiExperiments), returning a
+    tuple of (name,value) sorted by name, to use as a cache key. Raises ValueError for an invalid value.
+    :param args: the request arguments (dict)
+    '''
+    page_args = dict()
+    for arg in ["template","cognitive_atlas_task_id","fields"]:
+        if args.get(arg):
+            page_args[arg] = ",".join(sorted(set(args.get(arg).split(","))))
+    if args.get("max_time"):
+        try:
+            page_args["max_time"] = float(args.get("max_time"))
+        except ValueError:
+            raise ValueError("max_time must be a number")
+    if args.get("page") or args.get("per_page"):
+        for arg,default in [("page",1),("per_page",50)]:
+            try:
+                page_args[arg] = int(args.get(arg,default))
+            except ValueError:
+                raise ValueError("%s must be a number" %(arg))
+            if page_args[arg] < 1:
+                raise ValueError("%s must be at least 1" %(arg))
+    return tuple(sorted(page_args.items()))
+
+def filter_experiments(experiments,template=None,cognitive_atlas_task_id=None,max_time=None):
+    '''filter_experiments
+    return the experiments (loaded config.json) that match all of the filters given
+    :param experiments: a list of loaded config.json
+    :param template: a comma separated list of templates
+    :param cognitive_atlas_task_id: a comma separated list of cognitive atlas task ids
+    :param max_time: the maximum time of an experiment, in minutes
+    '''
+    if template != None:
+        template = template.split(",")
+        experiments = [x for x in experiments if x[0].get("template") in template]
+    if cognitive_atlas_task_id != None:
+        cognitive_atlas_task_id = cognitive_atlas_task_id.split(",")
+        experiments = [x for x in experiments if x[0].get("cognitive_atlas_task_id") in cognitive_atlas_task_id]
+    if max_time != None:
+        keep = []
+        for experiment in experiments:
+            try:
+                if float(experiment[0].get("time")) <= max_time:
+                    keep.append(experiment)
+            except (TypeError,ValueError):
+                pass
+        experiments = keep
+    return experiments
+
 app = EFServer(__name__)
 api = Api(app)    
-api.add_resource(apiExperiments,'/experiments')
+api.add_resource(apiExperiments,'/experiments',endpoint="experiments")
 api.add_resource(apiExperimentSingle,'/experiments/<string:exp_id>')
 
 
@@ -66,6 +235,21 @@ def get_field(request,fields,value):
         fields[value] = request.form[value]
     return fields
 
+# Repos are loaded on the first request, if the server was not started with start
+@app.before_request
+def load_repos():
+    app.start_loading()
+
+# Readiness of the server: 200 when experiments are loaded, 503 before
+@app.route('/ready')
+def ready():
+    response = jsonify({"status":app.status,
+                        "experiments":len(app.experiments),
+                        "error":app.error})
+    if not app.is_ready():
+        response.status_code = 503
+    return response
+
 # Home screen for user to select what they want
 @app.route('/')
 def home():
@@ -76,12 +260,17 @@ def home():
 # Step 0: User is presented with base interface
 @app.route('/battery')
 def battery():
+    if not app.is_ready():
+        app.start_loading(retry=True)
+        return render_template('battery.html',status=app.status,error=app.error)
     return render_template('battery.html')
 
 # STEP 1: Validation of user input for battery
 @app.route('/battery/validate',methods=['POST'])
 def validate():
     logo = None
+    if not app.is_ready():
+        return render_template('battery.html',status=app.status,error=app.error)
     if request.method == 'POST':
         fields = dict()
         for field,value in request.form.items():
@@ -108,19 +297,29 @@ def validate():
             else: 
                 fields["database_url"] = generate_database_url(template="mysql")       
         
+        # Each user gets a workspace, handed to the build job in step 2. Workspaces of jobs that were
+        # never downloaded are released when the job expires
+        app.workspaces.expire()
+        app.jobs.expire()
+
         # LOCAL FOLDER #####################################################
         if fields["deploychoice"] == "folder":
+            workspace = app.workspaces.create(["battery"])
 
             # Copy the custom logo
             if "file" in request.files and allowed_file(request.files["file"]):
                 logo = secure_filename(request.files["file"])
-                add_custom_logo(battery_repo="%s/battery" %(app.tmpdir),logo=logo)
+                workspace.unshare("battery/img/logo.png")
+                add_custom_logo(battery_repo="%s/battery" %(workspace.path),logo=logo)
     
             # Generate battery folder with config file with parameters
-            generate_config("%s/battery" %(app.tmpdir),fields)
+            workspace.unshare("battery/config.txt")
+            generate_config("%s/battery" %(workspace.path),fields)
 
         else: 
-            prepare_vm(battery_dest=app.tmpdir,fields=fields,vm_type=fields["deploychoice"])
+            workspace = app.workspaces.create(["vm"])
+            prepare_vm(battery_dest=workspace.path,fields=fields,vm_repo="%s/vm" %(workspace.path),
+                       vm_type=fields["deploychoice"])
 
         # Get valid experiments to present to user
         valid_experiments = [{"exp_id":e[0]["exp_id"],"name":e[0]["name"]} for e in app.experiments]
@@ -128,61 +327,118 @@ def validate():
         return render_template('experiments.html',
                                 experiments=str(valid_experiments),
                                 this_many=len(valid_experiments),
-                                deploychoice=fields["deploychoice"])
+                                deploychoice=fields["deploychoice"],
+                                workspace=workspace.id)
 
     return render_template('battery.html')
 
-# STEP 2: User must select experiments
+# STEP 2: User must select experiments, and the battery is built as a job
 @app.route('/battery/select',methods=['POST'])
 def select():
+    if not app.is_ready():
+        return render_template('battery.html',status=app.status,error=app.error)
     if request.method == 'POST':
         fields = dict()
+        workspace = None
         for field,value in request.form.items():
             if field == "deploychoice":
                 deploychoice = value
+            elif field == "workspace":
+                workspace = app.workspaces.get(value)
             else:
                 fields[field] = value
 
+        # The workspace is gone if it expired, or if its job was forgotten
+        if workspace == None:
+            return render_template('battery.html')
+
         # Retrieve experiment folders 
         valid_experiments = app.experiments
         experiments =  [x[0]["exp_id"] for x in valid_experiments]
         selected_experiments = [x for x in fields.values() if x in experiments]
-        experiment_folders = ["%s/experiments/%s" %(app.tmpdir,x) for x in selected_experiments]
-
-        # Option 1: A folder on the local machine
-        if deploychoice == "folder":
 
-            # Add to the battery
-            generate(battery_dest="%s/expfactory-battery"%app.tmpdir,
-                     battery_repo="%s/battery"%app.tmpdir,
-                     experiment_repo="%s/experiments"%app.tmpdir,
-                     experiments=experiment_folders,
-                     make_config=False,
-                     warning=False)
-
-            battery_dest = "%s/expfactory-battery" %(app.tmpdir)
-
-        # Option 2 or 3: Virtual machine (vagrant) or cloud (aws)
-        else:
-            specify_experiments(battery_dest=app.tmpdir,experiments=selected_experiments)
-            battery_dest = app.tmpdir 
-
-        # Clean up
-        clean_up("%s/experiments"%(app.tmpdir))
-        clean_up("%s/battery"%(app.tmpdir))
-        clean_up("%s/vm"%(app.tmpdir))        
-
-        return render_template('complete.html',battery_dest=battery_dest)
+        # The job takes over the reference to the workspace, and releases it when forgotten: after its
+        # battery is downloaded, or when it expires. If the form is sent again, the same job is returned
+        with app.lock:
+            job = app.jobs.get(workspace.job)
+            if job == None:
+                job = app.jobs.submit(build_battery,deploychoice,selected_experiments,workspace)
+                job.cleanup = workspace.release
+                workspace.job = job.id
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify({"job_id":job.id,"status":url_for('job_status',job_id=job.id)}),202
+        return render_template('complete.html',job_id=job.id)
+
+# STEP 3: User checks on the battery build, and downloads it when finished
+@app.route('/battery/jobs/<job_id>')
+def job_status(job_id):
+    job = app.jobs.get(job_id)
+    if job == None:
+        return jsonify({"error":"There is no job %s" %(job_id)}),404
+    status = job.to_dict()
+    if job.status == "finished":
+        status["battery_dest"] = job.result["battery_dest"]
+        status["download"] = url_for('job_download',job_id=job.id)
+    return jsonify(status)
+
+@app.route('/battery/jobs/<job_id>/download')
+def job_download(job_id):
+    job = app.jobs.get(job_id)
+    if job == None or job.status != "finished":
+        return jsonify({"error":"Job %s has no battery to download" %(job_id)}),404
+
+    # The job, and its workspace, are removed once the battery is sent (close callbacks
+    # are skipped for passthrough responses, so the file is streamed through the response)
+    response = send_file(job.result["artifact"],as_attachment=True)
+    response.direct_passthrough = False
+    response.call_on_close(lambda: app.jobs.forget(job_id))
+    return response
+
+def build_battery(job,deploychoice,selected_experiments,workspace):
+    '''build_battery
+    a job to generate a battery folder, or a Vagrantfile, with the selected experiments. Returns a dictionary
+    with the battery_dest, and an artifact to download (a zip of the battery folder, or the Vagrantfile)
+    :param job: the running job, see expfactory.jobs
+    :param deploychoice: one of "folder", "vagrant" or "aws"
+    :param selected_experiments: a list of exp_ids
+    :param workspace: the workspace to build in, see expfactory.workspace
+    '''
+    experiment_folders = ["%s/experiments/%s" %(app.tmpdir,x) for x in selected_experiments]
+
+    # Option 1: A folder on the local machine
+    if deploychoice == "folder":
+
+        # Add to the battery. Experiments are hard linked from the catalog, they are not written to
+        job.set_progress("Generating battery with %s experiments" %(len(experiment_folders)))
+        battery_dest = "%s/expfactory-battery" %(workspace.path)
+        generate(battery_dest=battery_dest,
+                 battery_repo="%s/battery"%workspace.path,
+                 experiment_repo="%s/experiments"%app.tmpdir,
+                 experiments=experiment_folders,
+                 make_config=False,
+                 warning=False,
+                 link_strategy="hardlink")
+
+        job.set_progress("Packaging battery")
+        artifact = shutil.make_archive(battery_dest,"zip",battery_dest)
+
+    # Option 2 or 3: Virtual machine (vagrant) or cloud (aws)
+    else:
+        job.set_progress("Writing Vagrantfile")
+        specify_experiments(battery_dest=workspace.path,experiments=selected_experiments)
+        battery_dest = workspace.path
+        artifact = "%s/Vagrantfile" %(workspace.path)
+
+    return {"battery_dest":battery_dest,"artifact":artifact}
 
-def clean_up(dirpath):
-    if os.path.exists(dirpath):
-        shutil.rmtree(dirpath)
-    
 # This is how the command line version will run
 def start(port=8088):
     if port==None:
         port=8088
     print("Nobody ever comes in... nobody ever comes out...")
+    # With the debug reloader, the server runs in a child process, and only it loads the repos
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        app.start_loading()
     webbrowser.open("http://localhost:%s" %(port))
     app.run(host="0.0.0.0",debug=True,port=port)
     
@@ -0,0 +1,155 @@
+'''
+jobs.py: part of expfactory package
+Functions to run battery builds in the background, and check on their status
+
+'''
+
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import uuid
+
+
+class Job(object):
+    '''Job
+    a function to run in the background. The function is called with the job as its first argument, so it can
+    report progress with job.set_progress. Its return value is kept as the job result. If job.cleanup is set to
+    a function, it is called when the JobQueue forgets the job (eg, to remove files the job made), see JobQueue.forget
+    :param func: the function to run
+    :param args: arguments for the function, after the job
+    :param kwargs: keyword arguments for the function
+    '''
+    def __init__(self,func,args=None,kwargs=None):
+        self.id = str(uuid.uuid4())
+        self.func = func
+        self.args = args or []
+        self.kwargs = kwargs or dict()
+        self.status = "queued"
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cleanup = None
+
+    def set_progress(self,progress):
+        '''set_progress
+        report progress of the job, a short message (eg, "Copying experiments")
+        '''
+        self.progress = progress
+
+    def run(self):
+        '''run
+        run the job function, setting status to "running", and then "finished" or "failed"
+        '''
+        self.status = "running"
+        self.started = time.time()
+        try:
+            self.result = self.func(self,*self.args,**self.kwargs)
+            status = "finished"
+        except Exception as error:
+            print("Job %s failed: %s" %(self.id,error))
+            self.error = str(error)
+            status = "failed"
+        # A done job always has its finished time, see JobQueue.forget_jobs
+        self.finished = time.time()
+        self.status = status
+        return self
+
+    def to_dict(self):
+        return {"id":self.id,
+                "status":self.status,
+                "progress":self.progress,
+                "error":self.error,
+                "created":self.created,
+                "started":self.started,
+                "finished":self.finished}
+
+
+class ThreadBackend(object):
+    '''ThreadBackend
+    the default job backend, a pool of threads in this process. Any object with a submit(job) method,
+    that eventually calls job.run(), can be used as a backend for a JobQueue.
+    :param workers: number of jobs to run at the same time (default 2)
+    '''
+    def __init__(self,workers=2):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self,job):
+        # The pool is made on first use, so creating a backend is free
+        with self.lock:
+            if self.pool == None:
+                self.pool = ThreadPool(self.workers)
+        self.pool.apply_async(job.run)
+
+
+class JobQueue(object):
+    '''JobQueue
+    keeps track of jobs, and sends them to a backend to run
+    :param backend: the backend to run jobs, see ThreadBackend. If None, a ThreadBackend with workers is used
+    :param workers: number of jobs to run at the same time, for the default backend
+    :param max_jobs: number of jobs to keep. When there are more, the oldest done (finished or failed) are forgotten
+    :param max_age: seconds to keep a done job after it finished (default one hour). If None, done jobs are kept
+                    until there are more than max_jobs
+    '''
+    def __init__(self,backend=None,workers=2,max_jobs=100,max_age=3600):
+        if backend == None:
+            backend = ThreadBackend(workers=workers)
+        self.backend = backend
+        self.max_jobs = max_jobs
+        self.max_age = max_age
+        self.jobs = dict()
+        self.lock = threading.Lock()
+
+    def submit(self,func,*args,**kwargs):
+        '''submit
+        add a job to run func(job,*args,**kwargs), and return the job
+        '''
+        job = Job(func,args=args,kwargs=kwargs)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.forget_jobs()
+        self.backend.submit(job)
+        return job
+
+    def get(self,job_id):
+        '''get
+        return a job by its id, or None if there is no such job
+        '''
+        return self.jobs.get(job_id)
+
+    def forget(self,job_id):
+        '''forget
+        forget a job, and call its cleanup (eg, once its result was downloaded). Returns the job, or None if
+        there is no such job
+        '''
+        with self.lock:
+            job = self.jobs.pop(job_id,None)
+        if job != None and job.cleanup != None:
+            job.cleanup()
+        return job
+
+    def expire(self):
+        '''expire
+        forget done jobs that finished more than max_age seconds ago, see forget_jobs
+        '''
+        with self.lock:
+            self.forget_jobs()
+
+    def forget_jobs(self):
+        '''forget_jobs
+        forget done jobs older than max_age, and then the oldest done jobs while there are more than max_jobs.
+        Must be called with the lock held
+        '''
+        done = [x for x in self.jobs.values() if x.status in ["finished","failed"]]
+        done.sort(key=lambda x: x.finished)
+        now = time.time()
+        while len(done) > 0 and (len(self.jobs) > self.max_jobs or
+                                 (self.max_age != None and now - done[0].finished > self.max_age)):
+            job = done.pop(0)
+            del self.jobs[job.id]
+            if job.cleanup != None:
+                job.cleanup()
@@ -0,0 +1,141 @@
+'''
+results.py: part of expfactory package
+Functions to collect results sent to the local server
+
+'''
+
+from threading import Thread
+import threading
+import json
+import os
+import re
+
+
+def is_valid_name(name):
+    '''is_valid_name
+    return True if a subject or experiment id can be used as a file name (letters, numbers, and - _ .)
+    '''
+    try:
+        return re.match(r"^[A-Za-z0-9_.-]+\Z",name) != None and name not in [".",".."]
+    except TypeError:
+        return False
+
+
+class ResultStore(object):
+    '''ResultStore
+    an append-only store of trial data, with one JSON line per trial in [folder]/[subject]/[exp_id].jsonl.
+    Trials are added to a buffer, and written in batches: when the buffer has batch_size trials, or every
+    flush_interval seconds. A batch is one write (and one fsync) per file, however many requests it holds.
+    :param folder: the folder to write results to, made if it does not exist
+    :param batch_size: number of buffered trials that triggers a flush (default 1000)
+    :param flush_interval: seconds between flushes of the buffer in a background thread. If None, the buffer is
+                           only written when full, or with flush() and close()
+    :param fsync: if True (default), files are synced to disk after each batch
+    '''
+    def __init__(self,folder,batch_size=1000,flush_interval=1.0,fsync=True):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = None
+        if flush_interval != None:
+            self.thread = Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self,subject,exp_id,data):
+        '''add
+        add trial data to the buffer, and return the number of trials added. A ValueError is raised for
+        an invalid subject, exp_id or data, and nothing is added.
+        :param subject: the subject id
+        :param exp_id: the experiment id. A trial with its own exp_id (eg, from a battery) is stored with that experiment
+        :param data: a trial (dict), or a list of trials, as from jsPsych.data.getData()
+        '''
+        if isinstance(data,dict):
+            data = [data]
+        if not isinstance(data,list):
+            raise ValueError("data must be a trial or a list of trials")
+        if not is_valid_name(subject):
+            raise ValueError("invalid subject %s" %(subject))
+
+        rows = []
+        for trial in data:
+            if not isinstance(trial,dict):
+                raise ValueError("each trial must be an object")
+            trial_exp_id = trial.get("exp_id",exp_id)
+            if not is_valid_name(trial_exp_id):
+                raise ValueError("invalid exp_id %s" %(trial_exp_id))
+            rows.append((subject,trial_exp_id,json.dumps(trial,sort_keys=True)))
+
+        with self.lock:
+            self.buffer.extend(rows)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+        return len(rows)
+
+    def flush(self):
+        '''flush
+        write the buffer, and return the number of trials written. If writing a file fails, its trials
+        are put back in the buffer, to write with the next flush.
+        '''
+        with self.write_lock:
+            with self.lock:
+                rows,self.buffer = self.buffer,[]
+            if len(rows) == 0:
+                return 0
+
+            # Group trials by file, keeping the order they were added
+            partitions = []
+            lines = dict()
+            for subject,exp_id,line in rows:
+                if (subject,exp_id) not in lines:
+                    partitions.append((subject,exp_id))
+                    lines[(subject,exp_id)] = []
+                lines[(subject,exp_id)].append(line)
+
+            written = 0
+            for p in range(len(partitions)):
+                subject,exp_id = partitions[p]
+                try:
+                    self.write_lines(subject,exp_id,lines[(subject,exp_id)])
+                except Exception:
+                    unwritten = set(partitions[p:])
+                    failed = [x for x in rows if (x[0],x[1]) in unwritten]
+                    with self.lock:
+                        self.buffer = failed + self.buffer
+                    raise
+                written += len(lines[(subject,exp_id)])
+            return written
+
+    def write_lines(self,subject,exp_id,lines):
+        subject_folder = os.path.join(self.folder,subject)
+        if not os.path.exists(subject_folder):
+            os.makedirs(subject_folder)
+        with open(os.path.join(subject_folder,"%s.jsonl" %(exp_id)),"a") as filey:
+            filey.write("%s\n" %("\n".join(lines)))
+            filey.flush()
+            if self.fsync == True:
+                os.fsync(filey.fileno())
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                print("Error writing results, will try again: %s" %(error))
+
+    def close(self):
+        '''close
+        stop the background thread, and write what is left in the buffer
+        '''
+        self.closed.set()
+        if self.thread != None:
+            self.thread.join()
+        return self.flush()
@@ -0,0 +1,215 @@
+'''
+scoring.py: part of expfactory package
+Functions to score survey responses, using the "scoring" field in a survey config.json
+
+'''
+
+from expfactory.survey import compile_survey, export_questions
+import pandas
+import numpy
+
+
+def get_scoring(experiment):
+    '''get_scoring returns the "scoring" field of a survey config.json, or None if it is not defined.
+    The field names scales (subscales) of questions, by their ids in export_questions:
+
+      "scoring": {"missing": {"max_missing":0, "impute":false},
+                  "scales": {"planning": {"questions": ["survey_1_options","survey_2_options"],
+                                          "reverse": ["survey_2_options"],
+                                          "max_missing": 1}}}
+
+    :param experiment: The experiment loaded config.json
+    '''
+    return experiment[0].get("scoring",None)
+
+
+def get_missing_rule(scale,missing=None):
+    '''get_missing_rule returns (max_missing,impute) for a scale, with defaults from the survey "missing" rule.
+    max_missing is the number of questions that can be unanswered for the scale to be scored (default 0). If impute
+    is true, the sum of a scale with unanswered questions is prorated from the mean of the answered ones.
+    :param scale: the scale (dict) from the scoring config
+    :param missing: the "missing" rule (dict) of the scoring config, applied to all scales
+    '''
+    rule = {"max_missing":0,"impute":False}
+    if missing != None:
+        rule.update(missing)
+    rule.update(dict([(k,v) for k,v in scale.items() if k in ["max_missing","impute"]]))
+    return int(rule["max_missing"]),rule["impute"] in [True,1,"true","True","mean"]
+
+
+class SurveyScorer(object):
+    '''SurveyScorer
+    a survey's question map (see survey.export_questions) and scoring config (see get_scoring), compiled into
+    lookup arrays to score many response records at once. Each (question,value) is looked up once to fill a
+    response matrix, and reverse-keying, scale sums, means and missing rules are done on the whole matrix.
+    :param questions: the question map, {id:question}, from export_questions
+    :param scoring: the "scoring" field of the survey config.json
+    '''
+    def __init__(self,questions,scoring):
+        if scoring == None or "scales" not in scoring:
+            raise ValueError("scoring must define scales")
+
+        self.scales = sorted(scoring["scales"].keys())
+        self.question_ids = []
+        self.lookup = dict()
+        self.number_lookup = dict()
+        low,high = [],[]
+        for name in self.scales:
+            for question_id in scoring["scales"][name].get("questions",[]):
+                if question_id in self.question_ids:
+                    continue
+                values = self.get_values(questions,question_id)
+                column = len(self.question_ids)
+                for value,number in values:
+                    self.lookup[(question_id,value)] = (column,number)
+                    self.number_lookup[(question_id,number)] = (column,number)
+                numbers = [x[1] for x in values]
+                low.append(min(numbers))
+                high.append(max(numbers))
+                self.question_ids.append(question_id)
+
+        # weights: questions (rows) in each scale (columns), reverse: sign of a question in each scale
+        columns = dict([(self.question_ids[n],n) for n in range(len(self.question_ids))])
+        self.weights = numpy.zeros((len(self.question_ids),len(self.scales)))
+        self.reverse = numpy.zeros((len(self.question_ids),len(self.scales)),dtype=bool)
+        self.max_missing = numpy.zeros(len(self.scales))
+        self.impute = numpy.zeros(len(self.scales),dtype=bool)
+        for s in range(len(self.scales)):
+            scale = scoring["scales"][self.scales[s]]
+            if len(scale.get("questions",[])) == 0:
+                raise ValueError("scale %s has no questions" %(self.scales[s]))
+            for question_id in scale["questions"]:
+                self.weights[columns[question_id],s] = 1
+            for question_id in scale.get("reverse",[]):
+                if question_id not in scale["questions"]:
+                    raise ValueError("reverse question %s is not in scale %s" %(question_id,self.scales[s]))
+                self.reverse[columns[question_id],s] = True
+            self.max_missing[s],self.impute[s] = get_missing_rule(scale,scoring.get("missing"))
+
+        # A reversed value is (low + high - value), low and high from the question's options
+        self.offset = numpy.array(low) + numpy.array(high)
+
+    def get_values(self,questions,question_id):
+        '''get_values returns a list of (value,number) for the options of a question, and raises a ValueError if
+        the question is not in the survey, or its option values are not numbers
+        '''
+        if question_id not in questions:
+            raise ValueError("question %s is not in the survey" %(question_id))
+        options = questions[question_id].get("options")
+        if options == None or "value" not in questions[question_id]["options"][0]:
+            raise ValueError("question %s does not have option values to score" %(question_id))
+        values = []
+        for option in options:
+            try:
+                values.append((str(option["value"]),float(option["value"])))
+            except ValueError:
+                raise ValueError("question %s has a value %s that is not a number" %(question_id,option["value"]))
+        return values
+
+    def get_matrix(self,records):
+        '''get_matrix returns a response matrix (records by questions) of numeric values, with NaN for
+        unanswered questions. Answers to questions that are not scored, or with unknown values, are ignored.
+        A value is matched to an option value as text, or else as a number (eg, 1.0 from pandas.read_csv matches "1")
+        :param records: a list of response records, each a list of {"name":..,"value":..} (as saved by the
+                        survey), or a dictionary {name:value}
+        '''
+        lookup = self.lookup
+        number_lookup = self.number_lookup
+        rows,columns,numbers = [],[],[]
+        for r in range(len(records)):
+            record = records[r]
+            if isinstance(record,dict):
+                answers = [(name,str(value),value) for name,value in record.items()]
+            else:
+                answers = [(x.get("name"),str(x.get("value")),x.get("value")) for x in record]
+            for name,text,value in answers:
+                found = lookup.get((name,text))
+                if found == None and value != None:
+                    try:
+                        found = number_lookup.get((name,float(value)))
+                    except (TypeError,ValueError):
+                        pass
+                if found != None:
+                    rows.append(r)
+                    columns.append(found[0])
+                    numbers.append(found[1])
+
+        matrix = numpy.full((len(records),len(self.question_ids)),numpy.nan)
+        matrix[rows,columns] = numbers
+        return matrix
+
+    def score_matrix(self,matrix):
+        '''score_matrix returns (sums,means,missing) arrays (records by scales) for a response matrix. A scale
+        with more than max_missing unanswered questions has NaN for its sum and mean.
+        :param matrix: a response matrix, see get_matrix
+        '''
+        answered = ~numpy.isnan(matrix)
+        values = numpy.where(answered,matrix,0)
+        reversed_values = numpy.where(answered,self.offset - matrix,0)
+
+        # Each scale takes the reversed or forward value of its questions
+        forward = self.weights * ~self.reverse
+        sums = values.dot(forward) + reversed_values.dot(self.reverse.astype(float))
+        counts = answered.astype(float).dot(self.weights)
+        missing = self.weights.sum(axis=0) - counts
+
+        with numpy.errstate(divide="ignore",invalid="ignore"):
+            means = sums / counts
+        sums = numpy.where(self.impute,means * self.weights.sum(axis=0),sums)
+        invalid = (missing > self.max_missing) | (counts == 0)
+        sums[invalid] = numpy.nan
+        means[invalid] = numpy.nan
+        return sums,means,missing
+
+    def score(self,records,index=None):
+        '''score returns a pandas data frame with the [scale]_sum, [scale]_mean and [scale]_missing (count of
+        unanswered questions) of each scale, with one row per record
+        :param records: a list of response records, see get_matrix
+        :param index: an index for the data frame (eg, subject ids). Default is the record number
+        '''
+        sums,means,missing = self.score_matrix(self.get_matrix(records))
+        scores = dict()
+        columns = []
+        for s in range(len(self.scales)):
+            for label,values in [("sum",sums),("mean",means),("missing",missing)]:
+                column = "%s_%s" %(self.scales[s],label)
+                scores[column] = values[:,s]
+                columns.append(column)
+        return pandas.DataFrame(scores,columns=columns,index=index)
+
+
+def compile_scoring(experiment,experiment_folder,survey_file="survey.tsv",cache=True,cache_dir=None):
+    '''compile_scoring returns a SurveyScorer for a survey, or None if the survey does not define scoring or
+    cannot be parsed. The question map is taken from the compiled survey (see survey.compile_survey)
+    :param experiment: The experiment loaded config.json
+    :param experiment_folder: should contain survey.tsv
+    :param survey_file: the survey file, should be survey.tsv for a valid survey experiment
+    :param cache: if False, read the questions from the survey file, and don't use the compiled survey cache
+    :param cache_dir: folder to cache compiled surveys on disk, see survey.compile_survey
+    '''
+    scoring = get_scoring(experiment)
+    if scoring == None:
+        print("Survey %s does not define scoring." %(experiment[0]["exp_id"]))
+        return None
+    if cache == True:
+        compiled = compile_survey(experiment,experiment_folder,survey_file=survey_file,cache_dir=cache_dir)
+        questions = None if compiled == None else compiled["questions"]
+    else:
+        questions = export_questions(experiment,experiment_folder,survey_file=survey_file)
+    if questions == None:
+        return None
+    return SurveyScorer(questions,scoring)
+
+
+def score_responses(experiment,experiment_folder,records,index=None,survey_file="survey.tsv"):
+    '''score_responses returns a data frame of scale scores for a list of response records (see SurveyScorer.score),
+    or None if the survey does not define scoring
+    :param experiment: The experiment loaded config.json
+    :param experiment_folder: should contain survey.tsv
+    :param records: a list of response records, each a list of {"name":..,"value":..} as saved by the survey
+    :param index: an index for the data frame (eg, subject ids). Default is the record number
+    '''
+    scorer = compile_scoring(experiment,experiment_folder,survey_file=survey_file)
+    if scorer == None:
+        return None
+    return scorer.score(records,index=index)
@@ -6,19 +6,32 @@ Runtime executable
 
 '''
 from expfactory.views import preview_experiment, run_battery, run_single
-from expfactory.battery import generate, generate_local
+from expfactory.battery import generate, generate_local, generate_local_batch
 from expfactory.experiment import validate, load_experiment
 from expfactory.tests import validate_surveys
+from expfactory.vm import export_snapshot, import_snapshot
 from glob import glob
 import argparse
 import sys
 import os
 
+def get_subids(subids):
+    '''get_subids
+    return the list of subject ids for --subids, a comma separated list or a file with one per line
+    '''
+    if subids == None:
+        return None
+    if os.path.isfile(subids):
+        with open(subids,"r") as filey:
+            return [x.strip() for x in filey.readlines() if x.strip() != ""]
+    return subids.split(",")
+
 def main():
     parser = argparse.ArgumentParser(
     description="generate experiments and infrastructure to serve them.")
     parser.add_argument("--folder", dest='folder', help="full path to single experiment folder (for single experiment run with --run) or folder with many experiments (for battery run with --run)", type=str, default=None)
     parser.add_argument("--subid", dest='subid', help="subject id to embed in experiments data in the case of a battery run with --run", type=str, default=None)
+    parser.add_argument("--subids", dest='subids', help="with --generate or --run, comma separated list of subject ids (or a file with one per line) to generate one battery with an entry page [subid].html per subject", type=str, default=None)
     parser.add_argument("--experiments", dest='experiments', help="comma separated list of experiments for a local battery", type=str, default=None)
     parser.add_argument("--port", dest='port', help="port to preview experiment", type=int, default=None)
     parser.add_argument("--battery", dest='battery_folder', help="full path to local battery folder to use as template", type=str, default=None)
@@ -30,7 +43,17 @@ def main():
     parser.add_argument('--validate', dest='validate', help="validate an experiment folder", default=False, action='store_true')
     parser.add_argument('--psiturk', dest='psiturk', help="to be used with the --generate command, to generate a psiturk battery instead of local folder deployment", default=False, action='store_true')
     parser.add_argument('--generate', dest='generate', help="generate (and don't run) a battery with --experiments to a --folder", default=False, action='store_true')
-    parser.add_argument("--output", dest='output', help="output folder for --generate command, if a temporary directory is not desired. Must not exist.", type=str, default=None)
+    parser.add_argument("--output", dest='output', help="output folder for --generate (or --run) command, if a temporary directory is not desired. Must not exist, unless --update is used.", type=str, default=None)
+    parser.add_argument("--link", dest='link', help="with --generate, how to add experiment folders to the battery: copy (default), hardlink, reflink, or symlink", type=str, default="copy", choices=["copy","hardlink","reflink","symlink"])
+    parser.add_argument('--update', dest='update', help="with --generate or --run, update an existing --output folder in place, copying only new or changed experiments", default=False, action='store_true')
+    parser.add_argument('--bundle', dest='bundle', help="with --generate, concatenate experiment scripts and styles into hashed bundles, to load the battery with fewer requests", default=False, action='store_true')
+    parser.add_argument('--compress', dest='compress', help="with --generate, write precompressed .gz (and .br, if brotli is installed) copies of static files, for web servers to send as is", default=False, action='store_true')
+    parser.add_argument('--offline', dest='offline', help="don't use the internet: take the battery, experiments, surveys, games and vm repos from the local cache or --snapshot (same as setting EXPFACTORY_OFFLINE=1)", default=False, action='store_true')
+    parser.add_argument("--snapshot", dest='snapshot', help="snapshot folder or tarball (from --export-snapshot) to take repos from, without internet (same as setting EXPFACTORY_SNAPSHOT)", type=str, default=None)
+    parser.add_argument("--export-snapshot", dest='export_snapshot', help="write a snapshot of the expfactory repos to a tarball (.tar.gz) or folder, to use on computers without internet", type=str, default=None)
+    parser.add_argument("--import-snapshot", dest='import_snapshot', help="add the repos from a snapshot tarball or folder to the local cache, to use without internet", type=str, default=None)
+    parser.add_argument("--results", dest='results', help="with --run (for a battery), a folder to save results in: the battery sends its data to the local server, instead of downloading a file in the browser", type=str, default=None)
+    parser.add_argument("--validation", dest='validation', help="with --preview or --run of a survey, how to check required questions: jquery (default) code generated for each page, or map, a map of required questions checked by a small validator", type=str, default="jquery", choices=["jquery","map"])
     parser.add_argument('--test', dest='test', help="test an experiment folder with the experiment robot", default=False, action='store_true')
 
     try:
@@ -39,9 +62,21 @@ def main():
         parser.print_help()
         sys.exit(0)
 
+    if args.offline == True:
+        os.environ["EXPFACTORY_OFFLINE"] = "1"
+    if args.snapshot != None:
+        os.environ["EXPFACTORY_SNAPSHOT"] = os.path.abspath(args.snapshot)
+
+    # Prepare or add a snapshot of the repos, for offline use
+    if args.export_snapshot != None:
+        export_snapshot(os.path.abspath(args.export_snapshot))
+
+    elif args.import_snapshot != None:
+        import_snapshot(os.path.abspath(args.import_snapshot))
+
     # Check if the person wants to preview experiment or battery
-    if args.preview == True:
-        preview_experiment(folder=args.folder,battery_folder=args.battery_folder,port=args.port)
+    elif args.preview == True:
+        preview_experiment(folder=args.folder,battery_folder=args.battery_folder,port=args.port,validation_mode=args.validation)
 
     # Generate a local battery folder (static)
     elif args.generate == True:
@@ -56,7 +91,25 @@ def main():
                                   experiment_repo=args.folder,
                                   experiments=experiments,
                                   make_config=True,
-                                  warning=False)
+                                  warning=False,
+                                  link_strategy=args.link,
+                                  update=args.update,
+                                  bundle=args.bundle,
+                                  compress=args.compress)
+
+            # Deploy one battery folder, with an entry page per subject
+            elif args.subids != None:
+                outdir = generate_local_batch(subject_ids=get_subids(args.subids),
+                                              battery_dest=args.output,
+                                              battery_repo=args.battery_folder,
+                                              experiment_repo=args.folder,
+                                              experiments=experiments,
+                                              warning=False,
+                                              time=args.time,
+                                              link_strategy=args.link,
+                                              update=args.update,
+                                              bundle=args.bundle,
+                                              compress=args.compress)
 
             # Deploy a regular battery folder
             else:
@@ -66,9 +119,14 @@ def main():
                                         experiment_repo=args.folder,
                                         experiments=experiments,
                                         warning=False,
-                                        time=args.time)
+                                        time=args.time,
+                                        link_strategy=args.link,
+                                        update=args.update,
+                                        bundle=args.bundle,
+                                        compress=args.compress)
 
-            print("Battery generation complete: static files are in %s" %(outdir))
+            if outdir != None:
+                print("Battery generation complete: static files are in %s" %(outdir))
 
         else:
             print("Please specify list of comma separated experiments with --experiments")
@@ -83,6 +141,11 @@ def main():
         if args.folder == None:
             print("No experiments, games, or surveys folder specified. Will pull latest from expfactory-experiments repo")
 
+        # Only a battery sends its results to the local server
+        if args.results != None and (args.survey != None or args.game != None):
+            print("--results can only be used to --run a battery of --experiments, not a --survey or --game.")
+            sys.exit(1)
+
         if args.survey != None:
             survey = args.survey.split(",")
             if len(survey) > 0:
@@ -93,7 +156,8 @@ def main():
                        source_repo=args.folder,
                        battery_repo=args.battery_folder,
                        port=args.port,
-                       subject_id=args.subid)
+                       subject_id=args.subid,
+                       validation_mode=args.validation)
 
         if args.game != None:
             game = args.game.split(",")
@@ -109,12 +173,16 @@ def main():
 
         if args.experiments != None:
             experiments = args.experiments.split(",")
-            run_battery(experiments=experiments,
+            run_battery(destination=args.output,
+                        experiments=experiments,
                         experiment_folder=args.folder,
                         subject_id=args.subid,
                         battery_folder=args.battery_folder,
                         port=args.port,
-                        time=args.time)
+                        time=args.time,
+                        update=args.update,
+                        results=args.results,
+                        subject_ids=get_subids(args.subids))
         else:
             print("Please specify list of comma separated experiments with --experiments")
 
@@ -5,7 +5,11 @@ Functions to work with javascript surveys
 '''
 
 from expfactory.experiment import get_experiments
+from expfactory.utils import save_json_atomic
+from expfactory.vm import get_cache_dir
+from expfactory import __version__
 from glob import glob
+import hashlib
 import pandas
 import json
 import uuid
@@ -17,13 +21,15 @@ try:
 except:
     pass
 
-def get_surveys(survey_repo=None,load=False,warning=True,repo_type="surveys"):
+def get_surveys(survey_repo=None,load=False,warning=True,repo_type="surveys",workers=None,index=True):
     '''get_surveys is a wrapper for "get_experiments" - the functionality is the same, but provided for users: return loaded json for all valid survyes from an surveys folder
     :param survey_repo: full path to the surveys repo
     :param load: if True, returns a list of loaded config.json objects. If False (default) returns the paths to the experiments
     :param repo_type: tells the user what kind of task is being parsed, default is "experiments," but can also be "surveys" when called by get_surveys
+    :param workers: number of threads to validate survey folders with. If None (default) folders are validated one at a time
+    :param index: if True (default), use the validated manifest in the repo, see experiment.get_experiments
     '''
-    return get_experiments(experiment_repo=survey_repo,load=load,warning=warning,repo_type=repo_type)
+    return get_experiments(experiment_repo=survey_repo,load=load,warning=warning,repo_type=repo_type,workers=workers,index=index)
 
 
 def get_question_types():
@@ -101,11 +107,11 @@ def create_radio(text,id_attribute,options,values,classes="",required=0,validate
 
     # If options provided are equal to values, parse the question
     if len(options) == len(values):
-        radio_html = '<p id="%s_options">%s</p>' %(id_attribute,text)
+        radio_html = ['<p id="%s_options">%s</p>' %(id_attribute,text)]
         for n in range(len(options)):
             option_id = "%s_%s" %(id_attribute,n)
-            radio_html = '%s\n<label class="%s" for="option-%s">\n<input type="radio" id="option-%s" class="mdl-radio__button %s %s" name="%s_options" value="%s" %s>\n<span class="mdl-radio__label">%s</span>\n</label>' %(radio_html,class_names,option_id,option_id,required,classes,id_attribute,values[n],meta,options[n])
-        return "%s<br><br><br><br>" %(radio_html)
+            radio_html.append('<label class="%s" for="option-%s">\n<input type="radio" id="option-%s" class="mdl-radio__button %s %s" name="%s_options" value="%s" %s>\n<span class="mdl-radio__label">%s</span>\n</label>' %(class_names,option_id,option_id,required,classes,id_attribute,values[n],meta,options[n]))
+        return "%s<br><br><br><br>" %("\n".join(radio_html))
 
     # Otherwise, we cannot include it
     else:   
@@ -131,11 +137,11 @@ def create_checkbox(text,id_attribute,options,classes="",required=0):
 
     meta = parse_meta(text,options)
 
-    checkbox_html = '<p id="%s_options">%s</p>' %(id_attribute,text)
+    checkbox_html = ['<p id="%s_options">%s</p>' %(id_attribute,text)]
     for n in range(len(options)):
         option_id = "%s_%s" %(id_attribute,n)
-        checkbox_html = '%s\n<label class="%s" for="checkbox-%s">\n<input type="checkbox" id="checkbox-%s" %s class="mdl-checkbox__input %s %s" name="%s_options" value="%s">\n<span class="mdl-checkbox__label">%s</span>\n</label>' %(checkbox_html,class_names,option_id,option_id,meta,classes,required,option_id,options[n],options[n])
-    return "%s<br><br><br>" %(checkbox_html)
+        checkbox_html.append('<label class="%s" for="checkbox-%s">\n<input type="checkbox" id="checkbox-%s" %s class="mdl-checkbox__input %s %s" name="%s_options" value="%s">\n<span class="mdl-checkbox__label">%s</span>\n</label>' %(class_names,option_id,option_id,meta,classes,required,option_id,options[n],options[n]))
+    return "%s<br><br><br>" %("\n".join(checkbox_html))
     
 def base_textfield(text,id_attribute,box_text=None):
     '''format_textfield parses input for a general textfield, returning base html, box_text, and id.
@@ -227,6 +233,43 @@ def create_select_table(text,id_attribute,df,classes="",required=0):
     print("ERROR: DataFrame (df) must be a pandas.DataFrame")
 
 
+def create_radio_table(questions,options,values,classes="",validate=False):
+    '''create_radio_table generates a table of radio buttons, with a row for each question and a column for each option, for
+    questions that share options (eg, a Likert scale). Each row is answered like a radio question (see create_radio)
+    :param questions: a list of questions, each a dictionary with "question_text", "unique_id" and "required" (0 or 1)
+    :param options: a list of text options for the user to select from, shown once in the table header
+    :param values: a list of values for corresponding options
+    :param classes: classes to add to the inputs, should be a string
+    :param validate: throw an error in the case that number of values != number of option (for testing)
+    '''
+    options,values = format_options_values(options,values)
+
+    if len(options) != len(values):
+        error_message = "ERROR: %s options provided, and only %s values. Must define one option per value." %(len(options),len(values))
+        if validate == True:
+            raise ValueError(error_message)
+        print(error_message)
+        return ""
+
+    if validate == True:
+        for question in questions:
+            print("Testing question %s with text %s" %(question["unique_id"],question["question_text"]))
+
+    header = "".join(['\n<th>%s</th>' %(option) for option in options])
+    table_html = ['<table class="mdl-data-table mdl-js-data-table expfactory-table">\n<thead>\n<tr>\n<th></th>%s\n</tr>\n</thead>\n<tbody>' %(header)]
+    for question in questions:
+        id_attribute = question["unique_id"]
+        required = get_required_string(int(question["required"]))
+        meta = parse_meta(question["question_text"],options)
+        row = ['<tr>\n<td class="mdl-data-table__cell--non-numeric" id="%s_options">%s</td>' %(id_attribute,question["question_text"])]
+        for n in range(len(options)):
+            row.append('<td><input type="radio" id="option-%s_%s" class="%s %s" name="%s_options" value="%s" %s></td>' %(id_attribute,n,required,classes,id_attribute,values[n],meta))
+        row.append('</tr>')
+        table_html.append("\n".join(row))
+    table_html.append('</tbody>\n</table>')
+    return "%s<br><br><br><br>" %("\n".join(table_html))
+
+
 def create_textarea(text,id_attribute,box_text=None,classes="",rows=3,required=0):
     '''create_textarea generates a material lite multi line text field with a text prompt.
     :param text: A text prompt to put before the text field
@@ -314,24 +357,63 @@ def parse_validation(required_counts):
     '''parse_validation parses code to validate each step
     :param page_count: the total number of pages for the survey (called "steps")
     '''
-    validation = ""
-    current_page = 1
-    pages = required_counts.keys()
-    pages.sort()
+    validation = []
+    pages = sorted(required_counts.keys())
     for page_number in pages:
-        if current_page == 1:
-            validation = "%s if ( state.stepIndex === %s ) {\n" %(validation,page_number)
+        if page_number == pages[0]:
+            validation.append(" if ( state.stepIndex === %s ) {\n" %(page_number))
         else:
-            validation = "%s else if ( state.stepIndex === %s ) {\n" %(validation,page_number)
-        validation = '%s if (($.unique($(`.page%s.required[type=number],.page%s.required:text`).map(function(){return $(this).attr(`meta-text`)})).map(function() {return $(`[meta-text*="` + this + `"].required[type=number], [meta-text*="` + this + `"].required:text`).filter(function() { return $(this).val();}).length > 0}).get().indexOf(false) != -1) || ($.unique($(`.page%s.required:not([type=number]):not(:text)`).map(function(){return $(this).attr(`meta-text`)})).map(function() {return $(`[meta-text*="` + this + `"].required:checked`).length > 0}).get().indexOf(false) != -1)){\nis_required($(`.page%s.required:not(checked)`));\nreturn false;\n' % (validation, page_number, page_number, page_number, page_number)
+            validation.append(" else if ( state.stepIndex === %s ) {\n" %(page_number))
+        validation.append(' if (($.unique($(`.page%s.required[type=number],.page%s.required:text`).map(function(){return $(this).attr(`meta-text`)})).map(function() {return $(`[meta-text*="` + this + `"].required[type=number], [meta-text*="` + this + `"].required:text`).filter(function() { return $(this).val();}).length > 0}).get().indexOf(false) != -1) || ($.unique($(`.page%s.required:not([type=number]):not(:text)`).map(function(){return $(this).attr(`meta-text`)})).map(function() {return $(`[meta-text*="` + this + `"].required:checked`).length > 0}).get().indexOf(false) != -1)){\nis_required($(`.page%s.required:not(checked)`));\nreturn false;\n' % (page_number, page_number, page_number, page_number))
 
         # If we are at the last page, passing validation should enable the submit
         if page_number == pages[-1]:
-            validation = '%s } else {\nexpfactory_finished=true;\n' %(validation)
-        validation = '%s}}' %(validation)
-        current_page+=1
+            validation.append(' } else {\nexpfactory_finished=true;\n')
+        validation.append('}}')
+
+    return "".join(validation)
 
-    return validation
+
+def get_validation_map(questions):
+    '''get_validation_map returns the required questions on each page, for the survey validator (see parse_validation_map), as
+    {page:[{"id":..,"kind":..,"names":[..]}]}. A question is answered when one of the inputs with its names has a value (kind "text")
+    or is checked (kind "choice"), and id is the element to mark in red if it is not.
+    :param questions: the questions data frame, from normalize_questions
+    '''
+    validation_map = dict()
+    for question in questions[questions.valid & (questions.required == 1)].to_dict("records"):
+        unique_id = question["unique_id"]
+        question_type = question["question_type"]
+        group = None
+        if question_type in ["radio","table"] and question["options"] != None and question["values"] != None:
+            if len(question["options"]) == len(question["values"]):
+                group = {"id":"%s_options" %(unique_id),"kind":"choice","names":["%s_options" %(unique_id)]}
+        elif question_type == "checkbox" and question["options"] != None:
+            names = ["%s_%s_options" %(unique_id,n) for n in range(len(question["options"]))]
+            group = {"id":"%s_options" %(unique_id),"kind":"choice","names":names}
+        elif question_type in ["textfield","numeric","textarea"]:
+            group = {"id":unique_id,"kind":"text","names":[unique_id]}
+        if group != None:
+            page_number = str(question["page_number"])
+            if page_number not in validation_map:
+                validation_map[page_number] = []
+            validation_map[page_number].append(group)
+    return validation_map
+
+
+def parse_validation_map(validation_map,last_page=None):
+    '''parse_validation_map returns code to validate each step with the survey validator (expfactory_validate in survey.html),
+    an alternative to parse_validation: the required questions are looked up by name from a map made at build time, instead of
+    searched for in the page on each step
+    :param validation_map: the required questions on each page, from get_validation_map
+    :param last_page: the page that finishes the survey when it is valid. If None, the last page with required questions
+    '''
+    if last_page == None and len(validation_map) > 0:
+        last_page = max([int(x) for x in validation_map.keys()])
+    validation = ['if (!expfactory_validate(%s,state.stepIndex)) {\nreturn false;\n}' %(json.dumps(validation_map,sort_keys=True,separators=(",",":")))]
+    if last_page != None:
+        validation.append('if ( state.stepIndex === %s ) {\nexpfactory_finished=true;\n}' %(last_page))
+    return "\n".join(validation)
 
 
 
@@ -361,118 +443,201 @@ def read_survey_file(question_file,delim="\t"):
         print("Question file is missing required columns %s" %(",".join(missing_columns)))
         return None
 
-def parse_questions(question_file,exp_id,delim="\t",return_requiredcount=True,validate=False):
+def split_options(column):
+    '''split_options splits a column of comma separated options (or values) into lists, in one pass
+    :param column: the option_text or option_values column of a survey data frame
+    '''
+    try:
+        return column.str.split(",")
+    except AttributeError:
+        return column
+
+
+def normalize_questions(df,exp_id):
+    '''normalize_questions prepares the columns of a survey data frame (from read_survey_file) in one vectorized pass, and returns a
+    data frame with a row per question, in file order: question_type, question_text, page_number, page_class, required (int), unique_id,
+    options and values (lists, or None if missing), valid (False for an unknown question_type, which is skipped), and table_id.
+    Consecutive table questions on the same page with the same options and values are rendered as one table, and share a
+    table_id (-1 for other questions)
+    :param df: the survey data frame
+    :param exp_id: the experiment unique id, to be used to generate question ids
+    '''
+    valid = df.question_type.isin(get_question_types())
+
+    # Each valid question will have id [exp_id]_[question_count] with appended _[count] for options
+    question_count = valid.astype(int).cumsum() - 1
+
+    questions = pandas.DataFrame({"question_type":df.question_type,
+                                  "question_text":df.question_text,
+                                  "page_number":df.page_number,
+                                  "page_class":"page" + df.page_number.astype(str),
+                                  "required":df.required.astype(int),
+                                  "unique_id":"%s_" %(exp_id) + question_count.astype(str),
+                                  "valid":valid},
+                                  index=df.index)
+    has_options = valid
+    for column,output in [("option_text","options"),("option_values","values")]:
+        missing = df[column].isnull() | (df[column] == "nan")
+        has_options = has_options & ~missing
+        missing = missing.tolist()
+        split = split_options(df[column]).tolist()
+        questions[output] = pandas.Series([None if missing[n] else split[n] for n in range(len(split))],index=df.index,dtype=object)
+
+    # A table starts at a table question that does not continue the table of the question before it
+    is_table = has_options & (df.question_type == "table")
+    scale = df.page_number.astype(str) + "\t" + df.option_text.astype(str) + "\t" + df.option_values.astype(str)
+    continues = is_table.shift(1,fill_value=False) & (scale == scale.shift(1))
+    table_start = is_table & ~continues
+    questions["table_id"] = table_start.astype(int).cumsum().where(is_table,0) - 1
+    return questions
+
+
+def get_required_counts(questions):
+    '''get_required_counts returns a dictionary to look up the number of required questions on each page {1:10}
+    :param questions: the questions data frame, from normalize_questions
+    '''
+    required = questions[questions.required == 1]
+    return dict(required.groupby("page_number").size())
+
+
+def create_question(question,validate=False):
+    '''create_question returns the html for a question, or None if it is skipped
+    :param question: a question (dict) from normalize_questions
+    :param validate: throw an error in the case that number of values != number of option (for testing)
+    '''
+    question_type = question["question_type"]
+    question_text = question["question_text"]
+    options = question["options"]
+    values = question["values"]
+    required = int(question["required"])
+    unique_id = question["unique_id"]
+    page_class = question["page_class"]
+
+    if question["valid"] == False:
+        return None
+
+    # Instruction block / text
+    if question_type == "instruction":
+        return create_instruction(question_text,tag="h3",id_attribute=unique_id)
+
+    # Radio button
+    elif question_type == "radio":
+        if options != None and values != None:
+            return create_radio(text=question_text,
+                                options=options,
+                                values=values,
+                                required=required,
+                                id_attribute=unique_id,
+                                classes=page_class,
+                                validate=validate)
+        print("Radio question %s found null for options or values, skipping." %(question_text))
+
+    # Checkbox
+    elif question_type == "checkbox":
+        if options != None:
+            return create_checkbox(text=question_text,
+                                   options=options,
+                                   required=required,
+                                   id_attribute=unique_id,
+                                   classes=page_class)
+        print("Checkbox question %s found null for options, skipping." %(question_text))
+
+    # Textareas and Textfields, regular and numeric
+    elif question_type == "textarea":
+        return create_textarea(question_text,
+                               required=required,
+                               id_attribute=unique_id,
+                               classes=page_class)
+
+    elif question_type == "textfield":
+        return create_textfield(question_text,
+                                required=required,
+                                id_attribute=unique_id,
+                                classes=page_class)
+
+    elif question_type == "numeric":
+        return create_numeric_textfield(question_text,
+                                        required=required,
+                                        id_attribute=unique_id,
+                                        classes=page_class)
+
+    # Table of radio buttons, one row per question
+    elif question_type == "table":
+        if "table" in question:
+            return create_radio_table(question["table"],
+                                      options=options,
+                                      values=values,
+                                      classes=page_class,
+                                      validate=validate)
+        print("Table question %s found null for options or values, skipping." %(question_text))
+
+    return None
+
+
+def combine_tables(questions):
+    '''combine_tables returns the questions with each table (consecutive questions with the same table_id, see normalize_questions)
+    combined into one question, the first of the table with "table", a list of the questions in it
+    :param questions: a list of questions (dict) from normalize_questions
+    '''
+    combined = []
+    for question in questions:
+        if question["table_id"] < 0:
+            combined.append(question)
+        elif len(combined) > 0 and combined[-1].get("table_id") == question["table_id"]:
+            combined[-1]["table"].append(question)
+        else:
+            table = dict(question)
+            table["table"] = [question]
+            combined.append(table)
+    return combined
+
+
+def parse_questions(question_file,exp_id,delim="\t",return_requiredcount=True,validate=False,return_frame=False):
     '''parse_questions reads in a text file, separated by delim, into a pandas data frame, checking that all column names are provided.
     :param question_file: a TAB separated file to be read with experiment questions. Will also be validated for columns names.
     :param exp_id: the experiment unique id, to be used to generate question ids
     :param return_requiredcount: if True, will return questions,page_count where page_count is a dictionary to look up the number of required questions on each page {1:10}
     :param validate: throw an error in the case that number of values != number of option (for testing)
+    :param return_frame: if True, also return the normalized questions (see normalize_questions), last in the result
     '''
     df = read_survey_file(question_file,delim=delim)
-    acceptable_types = get_question_types()
-    required_counts = dict()
 
     if isinstance(df,pandas.DataFrame):
- 
-        # Each question will have id [exp_id][question_count] with appended _[count] for options
-        question_count = 0
-        questions = []
+
+        frame = normalize_questions(df,exp_id)
+        required_counts = get_required_counts(frame)
+
+        # A new page (step) is started each time the page number changes
+        pages = []
+        current_page = []
         current_page_number = 1
-        current_page = '<div class="step">'
-        for question in df.iterrows():
-
-            question_type = question[1].question_type
-            question_text = question[1].question_text
-            page_number = question[1].page_number
-            page_class = "page%s" %(page_number)
-            options = question[1].option_text
-            values = question[1].option_values
-            required = int(question[1].required)
-            unique_id = "%s_%s" %(exp_id,question_count)
-            new_question = None
-            if required == 1:
-                if page_number not in required_counts:
-                    required_counts[page_number] = 1
-                else:
-                    required_counts[page_number] = required_counts[page_number] + 1
-
-            if question_type in acceptable_types:
-
-                # Instruction block / text
-                if question_type == "instruction":
-                    new_question = create_instruction(question_text,tag="h3",id_attribute=unique_id)
-                
-                # Radio button
-                elif question_type == "radio":
-                    if not str(options) == "nan" and not str(values) == "nan":
-                        new_question = create_radio(text=question_text,
-                                                    options=options.split(","),
-                                                    values = values.split(","),
-                                                    required=required,
-                                                    id_attribute=unique_id,
-                                                    classes=page_class,
-                                                    validate=validate)
-                    else:
-                        print("Radio question %s found null for options or values, skipping." %(question_text))
- 
-                # Checkbox
-                elif question_type == "checkbox":
-                    if not str(options) == "nan":
-                        new_question = create_checkbox(text=question_text,
-                                                       options=options.split(","),
-                                                       required=required,
-                                                       id_attribute=unique_id,
-                                                       classes=page_class)
-                    else:
-                        print("Checkbox question %s found null for options, skipping." %(question_text))
-
-                # Textareas and Textfields, regular and numeric
-                elif question_type == "textarea":
-                    new_question = create_textarea(question_text,
-                                                   required=required,
-                                                   id_attribute=unique_id,
-                                                   classes=page_class)
-
-                elif question_type == "textfield":
-                    new_question = create_textfield(question_text,
-                                                    required=required,
-                                                    id_attribute=unique_id,
-                                                    classes=page_class)
-
-                elif question_type == "numeric":
-                    new_question = create_numeric_textfield(question_text,
-                                                            required=required,
-                                                            id_attribute=unique_id,
-                                                            classes=page_class)
-
-
-                # Table
-                elif question_type == "table":
-                    print("Table option not yet supported! Coming soon.")
- 
-                question_count+=1
-            
+        for question in combine_tables(frame.to_dict("records")):
+            new_question = create_question(question,validate=validate)
             if new_question != None:
-                # Add the new question to the current page
-                if page_number == current_page_number:                 
-                    current_page = "%s\n%s" %(current_page,new_question)
-                # Save the current page, add the current question to the next page
-                else:
-                    questions.append("%s</div>" %current_page)
-                    current_page = '<div class="step">\n%s' %new_question
-                    current_page_number = page_number
+                if question["page_number"] != current_page_number:
+                    pages.append(current_page)
+                    current_page = []
+                    current_page_number = question["page_number"]
+                current_page.append("\n%s" %(new_question))
 
         # Add the last page
-        questions.append("%s</div>" %current_page)
+        pages.append(current_page)
+        questions = ['<div class="step">%s</div>' %("".join(page)) for page in pages]
 
+        result = [questions]
         if return_requiredcount == True:
-            return questions,required_counts
-        return questions
+            result.append(required_counts)
+        if return_frame == True:
+            result.append(frame)
+        if len(result) == 1:
+            return questions
+        return tuple(result)
     else:
         return None
 
 
-def generate_survey(experiment,experiment_folder,form_action="#",classes=None,survey_file="survey.tsv",get_validation=True,csrf_token=False):
+def generate_survey(experiment,experiment_folder,form_action="#",classes=None,survey_file="survey.tsv",get_validation=True,csrf_token=False,
+                    validation_mode="jquery"):
     '''generate_survey takes a list of questions and outputs html for an expfactory survey, and validation code
     :param experiment: The experiment loaded config.json
     :param experiment_folder: should contain survey.tsv, a TAB separated file with question data. Will be read into a pandas data frame, and columns must follow expfactory standard. Data within columns is separated by commas.
@@ -481,6 +646,8 @@ def generate_survey(experiment,experiment_folder,form_action="#",classes=None,su
     :param survey_file: the survey file, should be survey.tsv for a valid survey experiment
     :param get_validation: get code for validation, default is True
     :param csrf_token: if true, include django code for csrf_token ({% csrf_token %})
+    :param validation_mode: "jquery" (default) to validate each step with generated jQuery (see parse_validation), or "map" to
+                            validate with a map of required questions made at build time (see parse_validation_map)
     '''       
     if classes == None:
         classes = "experiment-layout mdl-layout mdl-layout--fixed-header mdl-js-layout mdl-color--grey-100"
@@ -489,10 +656,17 @@ def generate_survey(experiment,experiment_folder,form_action="#",classes=None,su
     exp_id = experiment[0]["exp_id"]
     question_file = "%s/%s" %(experiment_folder,survey_file)
 
-    questions,required_count = parse_questions(question_file,exp_id=exp_id)
+    parsed = parse_questions(question_file,exp_id=exp_id,return_frame=True)
+    if parsed == None:
+        print("ERROR: parsing input text file survey.tsv. Will not generate survey HTML")
+        return None
+    questions,required_count,frame = parsed
 
     # Get validation code based on maximum page value
-    validation = parse_validation(required_count)
+    if validation_mode == "map":
+        validation = parse_validation_map(get_validation_map(frame))
+    else:
+        validation = parse_validation(required_count)
     token = ""
     if csrf_token == True:
         token = "{% csrf_token %}"
@@ -500,8 +674,7 @@ def generate_survey(experiment,experiment_folder,form_action="#",classes=None,su
     if questions != None:
         survey = '<div class="%s">\n<div class="experiment-ribbon"></div>\n<main class="experiment-main mdl-layout__content">\n<div class="experiment-container mdl-grid">\n<div class="mdl-cell mdl-cell--2-col mdl-cell--hide-tablet mdl-cell--hide-phone">\n</div>\n<div class="experiment-content mdl-color--white mdl-shadow--4dp content mdl-color-text--grey-800 mdl-cell mdl-cell--8-col">\n\n<div id="questions">\n\n<form name="questions" action="%s", method="POST">%s' %(classes,form_action,token)
 
-        for question in questions:
-            survey = "%s\n%s" %(survey,question)       
+        survey = "%s%s" %(survey,"".join(["\n%s" %(question) for question in questions]))
         if get_validation == True:
             return survey,validation    
         return survey
@@ -509,6 +682,64 @@ def generate_survey(experiment,experiment_folder,form_action="#",classes=None,su
         print("ERROR: parsing input text file survey.tsv. Will not generate survey HTML")
 
 
+def export_question(question):
+    '''export_question returns the json data structure for a question (a dict, or a list for checkbox options), or None if it is skipped
+    :param question: a question (dict) from normalize_questions
+    '''
+    question_type = question["question_type"]
+    question_text = question["question_text"]
+    options = question["options"]
+    values = question["values"]
+    required = int(question["required"])
+    unique_id = question["unique_id"]
+
+    if question["valid"] == False:
+        return None
+
+    # Instruction block / text
+    if question_type == "instruction":
+        return export_instruction(question_text,
+                                  id_attribute=unique_id,
+                                  required=required)
+
+    # Radio button
+    elif question_type == "radio":
+        if options != None and values != None:
+            return export_radio(text=question_text,
+                                options=options,
+                                values=values,
+                                required=required,
+                                id_attribute=unique_id)
+        print("Radio question %s found null for options or values, skipping." %(question_text))
+
+    # Table, each row is exported as a radio question
+    elif question_type == "table":
+        if options != None and values != None:
+            return export_radio(text=question_text,
+                                options=options,
+                                values=values,
+                                required=required,
+                                id_attribute=unique_id)
+        print("Table question %s found null for options or values, skipping." %(question_text))
+
+    # Checkbox
+    elif question_type == "checkbox":
+        if options != None:
+            return export_checkbox(text=question_text,
+                                   options=options,
+                                   required=required,
+                                   id_attribute=unique_id)
+        print("Checkbox question %s found null for options, skipping." %(question_text))
+
+    # Textareas and Textfields, regular and numeric
+    elif question_type in ["textarea","textfield","numeric"]:
+        return export_textfield(question_text,
+                                required=required,
+                                id_attribute=unique_id)
+
+    return None
+
+
 def export_questions(experiment,experiment_folder,survey_file="survey.tsv",delim="\t"):
     '''export_questions reads in a text file, separated by delim, and returns a json data structure with questions to look up
     :param question_file: a TAB separated file to be read with experiment questions. Will also be validated for columns names.
@@ -519,67 +750,100 @@ def export_questions(experiment,experiment_folder,survey_file="survey.tsv",delim
     exp_id = experiment[0]["exp_id"]
     question_file = "%s/%s" %(experiment_folder,survey_file)
     df = read_survey_file(question_file,delim=delim)
-    acceptable_types = get_question_types()
 
     if isinstance(df,pandas.DataFrame):
- 
-        # Each question will have id [exp_id][question_count] with appended _[count] for options
-        question_count = 0
+
         questions = dict()
-        for question in df.iterrows():
-
-            question_type = question[1].question_type
-            question_text = question[1].question_text
-            page_number = question[1].page_number
-            page_class = "page%s" %(page_number)
-            options = question[1].option_text
-            values = question[1].option_values
-            required = int(question[1].required)
-            unique_id = "%s_%s" %(exp_id,question_count)
-            new_question = None
-
-            if question_type in acceptable_types:
-
-                # Instruction block / text
-                if question_type == "instruction":
-                    new_question = export_instruction(question_text,
-                                                      id_attribute=unique_id,
-                                                      required=required)
-                
-                # Radio button
-                elif question_type == "radio":
-                    if not str(options) == "nan" and not str(values) == "nan":
-                        new_question = export_radio(text=question_text,
-                                                    options=options.split(","),
-                                                    values = values.split(","),
-                                                    required=required,
-                                                    id_attribute=unique_id)
-                    else:
-                        print("Radio question %s found null for options or values, skipping." %(question_text))
- 
-                # Checkbox
-                elif question_type == "checkbox":
-                    if not str(options) == "nan":
-                        new_question = export_checkbox(text=question_text,
-                                                       options=options.split(","),
-                                                       required=required,
-                                                       id_attribute=unique_id)
-                    else:
-                        print("Checkbox question %s found null for options, skipping." %(question_text))
-
-                # Textareas and Textfields, regular and numeric
-                elif question_type in ["textarea","textfield","numeric"]:
-                    new_question = export_textfield(question_text,
-                                                   required=required,
-                                                   id_attribute=unique_id)
- 
-                question_count+=1
-                if isinstance(new_question,dict):
-                    questions[new_question["id"]] = new_question
-                elif isinstance(new_question,list):
-                    for nq in new_question:
-                        questions[nq["id"]] = nq
+        for question in normalize_questions(df,exp_id).to_dict("records"):
+            new_question = export_question(question)
+            if isinstance(new_question,dict):
+                questions[new_question["id"]] = new_question
+            elif isinstance(new_question,list):
+                for nq in new_question:
+                    questions[nq["id"]] = nq
 
         return questions
     else:
         return None
+
+
+# CACHE FUNCTIONS ##############################################################################
+
+# Compiled surveys, {key:compiled}, see compile_survey
+compiled_surveys = dict()
+
+def get_survey_key(experiment,question_file,form_action="#",classes=None,csrf_token=False,validation_mode="jquery"):
+    '''get_survey_key returns the cache key for a compiled survey: a hash of the survey file, the config fields and options
+    used to compile it, and the expfactory version
+    :param experiment: The experiment loaded config.json
+    :param question_file: full path to the survey.tsv
+    '''
+    survey_hash = hashlib.sha256()
+    with open(question_file,"rb") as filey:
+        survey_hash.update(filey.read())
+    fields = {"exp_id":experiment[0]["exp_id"],
+              "form_action":form_action,
+              "classes":classes,
+              "csrf_token":csrf_token,
+              "validation_mode":validation_mode,
+              "version":__version__}
+    survey_hash.update(json.dumps(fields,sort_keys=True).encode("utf-8"))
+    return survey_hash.hexdigest()
+
+
+def compile_survey(experiment,experiment_folder,form_action="#",classes=None,survey_file="survey.tsv",csrf_token=False,
+                   validation_mode="jquery",cache=True,cache_dir=None):
+    '''compile_survey returns a compiled survey, a dictionary with the form "html", "validation" code (see generate_survey) and
+    "questions" (see export_questions), or None if the survey cannot be parsed. Compiled surveys are kept in memory, and on disk
+    in [cache_dir]/[key].json, so a survey is only compiled again when survey.tsv, the exp_id, the options, or the expfactory
+    version change (see get_survey_key). The returned dictionary is a copy, but its "questions" are shared with the cache, and
+    should not be changed (use copy.deepcopy first)
+    :param experiment: The experiment loaded config.json
+    :param experiment_folder: should contain survey.tsv, see generate_survey
+    :param form_action: the form action to take at the bottom of the page
+    :param classes: the classes to apply to the outer content div. If none, default will be used
+    :param survey_file: the survey file, should be survey.tsv for a valid survey experiment
+    :param csrf_token: if true, include django code for csrf_token ({% csrf_token %})
+    :param validation_mode: "jquery" (default) or "map", see generate_survey
+    :param cache: if False, always compile the survey, and don't cache it
+    :param cache_dir: folder to cache compiled surveys on disk. If None, [cache]/surveys is used (see vm.get_cache_dir)
+    '''
+    question_file = "%s/%s" %(experiment_folder,survey_file)
+    if cache == True:
+        key = get_survey_key(experiment,question_file,form_action=form_action,classes=classes,csrf_token=csrf_token,
+                             validation_mode=validation_mode)
+        if key in compiled_surveys:
+            return dict(compiled_surveys[key])
+        if cache_dir == None:
+            cache_dir = "%s/surveys" %(get_cache_dir())
+        cache_file = "%s/%s.json" %(cache_dir,key)
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file,"r") as filey:
+                    compiled = json.load(filey)
+                compiled_surveys[key] = compiled
+                return dict(compiled)
+            except ValueError:
+                print("Compiled survey %s is not valid, will compile again." %(cache_file))
+
+    survey = generate_survey(experiment,experiment_folder,
+                             form_action=form_action,
+                             classes=classes,
+                             survey_file=survey_file,
+                             csrf_token=csrf_token,
+                             validation_mode=validation_mode)
+    if survey == None:
+        return None
+    compiled = {"html":survey[0],
+                "validation":survey[1],
+                "questions":export_questions(experiment,experiment_folder,survey_file=survey_file)}
+
+    if cache == True:
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            save_json_atomic(cache_file,compiled)
+        except (IOError,OSError) as error:
+            print("Cannot cache compiled survey in %s: %s" %(cache_dir,error))
+        compiled_surveys[key] = compiled
+    return dict(compiled)
@@ -11,4 +11,4 @@ if [ "$#" -ne 2 ]; then
 fi
 
 cd $TEST_RUN_FOLDER
-nosetests --verbosity=3 --with-doctest --with-coverage --nocapture --cover-package=expfactory $TESTDIR/test_experiment.py $TESTDIR/test_battery.py $TESTDIR/test_vm.py $TESTDIR/test_views.py
+nosetests --verbosity=3 --with-doctest --with-coverage --nocapture --cover-package=expfactory $TESTDIR/test_experiment.py $TESTDIR/test_battery.py $TESTDIR/test_vm.py $TESTDIR/test_views.py $TESTDIR/test_jobs.py $TESTDIR/test_interface.py $TESTDIR/test_webserver.py $TESTDIR/test_results.py $TESTDIR/test_survey.py $TESTDIR/test_scoring.py
@@ -7,10 +7,15 @@ Test experiments
 import unittest
 import shutil
 from expfactory.experiment import get_experiments
-from expfactory.battery import generate, get_experiment_run, get_load_js, \
-get_concat_js, get_timing_js
+from expfactory.battery import generate, generate_local_batch, get_experiment_run, get_load_js, \
+get_concat_js, get_timing_js, get_load_static, BatteryPlan, move_experiments, \
+update_experiments, load_battery_state, add_custom_variables, update_battery_skeleton, \
+get_battery_state_file
+from expfactory.assets import bundle_static, compress_assets
+from expfactory import assets
 from expfactory.utils import copy_directory, get_installdir
 import tempfile
+import gzip
 import json
 import os
 import re
@@ -22,8 +27,14 @@ class TestBattery(unittest.TestCase):
         self.tmpdir = tempfile.mkdtemp()
         self.battery = "%s/battery"%self.tmpdir
         self.experiment = os.path.abspath("%s/testing/data/test_task/" %self.pwd)
+        self.cache = os.environ.get("EXPFACTORY_CACHE")
+        os.environ["EXPFACTORY_CACHE"] = "%s/cache" %self.tmpdir
 
     def tearDown(self):
+        if self.cache == None:
+            del os.environ["EXPFACTORY_CACHE"]
+        else:
+            os.environ["EXPFACTORY_CACHE"] = self.cache
         shutil.rmtree(self.tmpdir)
         
     def test_experiment_run(self):
@@ -46,5 +57,215 @@ class TestBattery(unittest.TestCase):
         self.assertTrue(timingjs[0]["name"]=="test_task")
         self.assertTrue(timingjs[0]["time"]==1)
 
+    def test_battery_plan(self):
+        plan = BatteryPlan([self.experiment])
+        self.assertEqual(plan.get_exp_ids(),["test_task"])
+        self.assertEqual(plan.folders,[self.experiment])
+
+        # Generators give the same result for a plan and a list of folders
+        self.assertEqual(get_load_js(plan),get_load_js([self.experiment]))
+        self.assertEqual(get_concat_js(plan),get_concat_js([self.experiment]))
+        self.assertEqual(get_timing_js(plan),get_timing_js([self.experiment]))
+        self.assertEqual(get_experiment_run(plan),get_experiment_run([self.experiment]))
+
+        # Scripts shared between experiments are only loaded once, in order
+        loadstatic = get_load_static(BatteryPlan([self.experiment,self.experiment]))
+        self.assertEqual(len(re.findall("experiment.js",loadstatic)),1)
+        self.assertTrue(loadstatic.index("jspsych.js") < loadstatic.index("experiment.js"))
+
+    def test_move_experiments(self):
+        for strategy in ["copy","hardlink","reflink","symlink"]:
+            battery_dest = "%s/%s" %(self.tmpdir,strategy)
+            moved = move_experiments([self.experiment],battery_dest,link_strategy=strategy)
+            self.assertEqual(moved,[self.experiment])
+            config = "%s/static/experiments/test_task/config.json" %(battery_dest)
+            self.assertTrue(os.path.exists(config))
+            with open(config,"r") as filey:
+                self.assertEqual(json.load(filey)[0]["exp_id"],"test_task")
+        self.assertTrue(os.path.islink("%s/symlink/static/experiments/test_task" %self.tmpdir))
+        self.assertTrue(os.path.samefile("%s/hardlink/static/experiments/test_task/config.json" %self.tmpdir,
+                                         "%s/config.json" %self.experiment))
+
+    def test_update_experiments(self):
+        source = "%s/source/test_task" %(self.tmpdir)
+        copy_directory(self.experiment,source)
+        battery_dest = "%s/battery" %(self.tmpdir)
+        dest = "%s/static/experiments/test_task" %(battery_dest)
+
+        # First update copies the experiment, and records its hash
+        self.assertEqual(update_experiments([source],battery_dest),[source])
+        self.assertTrue(os.path.exists("%s/config.json" %dest))
+        self.assertTrue("test_task" in load_battery_state(battery_dest)["experiments"])
+
+        # An unchanged experiment is not copied again
+        open("%s/marker" %dest,"w").close()
+        update_experiments([source],battery_dest)
+        self.assertTrue(os.path.exists("%s/marker" %dest))
+
+        # A changed experiment is replaced
+        with open("%s/style.css" %source,"a") as filey:
+            filey.write("body {}")
+        update_experiments([source],battery_dest)
+        self.assertFalse(os.path.exists("%s/marker" %dest))
+        with open("%s/style.css" %dest,"r") as filey:
+            self.assertTrue("body {}" in filey.read())
+
+        # Experiments no longer requested are removed
+        self.assertEqual(update_experiments([],battery_dest),[])
+        self.assertFalse(os.path.exists(dest))
+
+    def test_update_battery_skeleton(self):
+        battery_repo = "%s/battery_repo" %(self.tmpdir)
+        os.makedirs("%s/static/js" %battery_repo)
+        with open("%s/static/js/load_experiments.js" %battery_repo,"w") as filey:
+            filey.write("var experiments = [SUB_EXPERIMENTCONCAT_SUB];")
+
+        # A folder that was not made by an update is left alone
+        os.makedirs(self.battery)
+        with open("%s/thesis.tex" %self.battery,"w") as filey:
+            filey.write("\\documentclass{article}")
+        self.assertFalse(update_battery_skeleton(battery_repo,self.battery))
+        self.assertEqual(os.listdir(self.battery),["thesis.tex"])
+        self.assertEqual(generate_local_batch(["sub1"],battery_dest=self.battery,battery_repo=battery_repo,
+                                              experiment_repo=self.tmpdir,experiments=[],update=True),None)
+        self.assertEqual(os.listdir(self.battery),["thesis.tex"])
+
+        # A new folder is copied, and rebuilt when the template changes
+        shutil.rmtree(self.battery)
+        self.assertTrue(update_battery_skeleton(battery_repo,self.battery))
+        self.assertTrue(os.path.exists(get_battery_state_file(self.battery)))
+        open("%s/marker" %self.battery,"w").close()
+        self.assertTrue(update_battery_skeleton(battery_repo,self.battery))
+        self.assertTrue(os.path.exists("%s/marker" %self.battery))
+        with open("%s/static/js/load_experiments.js" %battery_repo,"a") as filey:
+            filey.write("\n")
+        self.assertTrue(update_battery_skeleton(battery_repo,self.battery))
+        self.assertFalse(os.path.exists("%s/marker" %self.battery))
+
+        # The state is not used for another folder made at the same path
+        shutil.rmtree(self.battery)
+        os.makedirs(self.battery)
+        self.assertFalse(update_battery_skeleton(battery_repo,self.battery))
+
+        # The state file of older versions, in the battery folder, is moved to the cache
+        with open("%s/.expfactory-battery.json" %self.battery,"w") as filey:
+            filey.write(json.dumps({"battery":"old","experiments":{},"hashes":{},"subjects":["sub1"]}))
+        self.assertEqual(load_battery_state(self.battery)["subjects"],["sub1"])
+        self.assertTrue(update_battery_skeleton(battery_repo,self.battery))
+        self.assertFalse(os.path.exists("%s/.expfactory-battery.json" %self.battery))
+
+    def test_generate_local_batch(self):
+        experiment_repo = "%s/experiments" %(self.tmpdir)
+        copy_directory(self.experiment,"%s/test_task" %experiment_repo)
+        battery_repo = "%s/battery_repo" %(self.tmpdir)
+        os.makedirs("%s/static/js" %battery_repo)
+        with open("%s/static/js/load_experiments.js" %battery_repo,"w") as filey:
+            filey.write("var experiments = [SUB_EXPERIMENTCONCAT_SUB];")
+        options = {"battery_repo":battery_repo,"experiment_repo":experiment_repo,"experiments":["test_task"],"warning":False}
+
+        # Each valid subject id gets an entry page, and invalid ids are skipped
+        battery_dest = generate_local_batch(["sub1","sub2","../sub3","index","sub1"],battery_dest=self.battery,update=True,**options)
+        self.assertEqual(sorted([x for x in os.listdir(battery_dest) if x.endswith(".html")]),
+                         ["index.html","sub1.html","sub2.html"])
+        with open("%s/sub1.html" %battery_dest,"r") as filey:
+            page = filey.read()
+        self.assertTrue("sub1" in page)
+        self.assertFalse("[SUB_SUBJECT_ID_SUB]" in page)
+
+        # index.html gets a new unique id each time
+        uuid_pattern = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+        with open("%s/index.html" %battery_dest,"r") as filey:
+            first_id = re.findall(uuid_pattern,filey.read())
+        self.assertEqual(len(set(first_id)),1)
+
+        # An update removes the entry pages of subjects no longer given
+        generate_local_batch(["sub2","sub4"],battery_dest=self.battery,update=True,**options)
+        self.assertFalse(os.path.exists("%s/sub1.html" %battery_dest))
+        self.assertTrue(os.path.exists("%s/sub4.html" %battery_dest))
+        self.assertEqual(load_battery_state(battery_dest)["subjects"],["sub2","sub4"])
+
+        # Subject ids are kept out of the served folder
+        state_file = get_battery_state_file(battery_dest)
+        self.assertTrue(state_file.startswith("%s/cache/" %self.tmpdir))
+        self.assertFalse(os.path.exists("%s/.expfactory-battery.json" %battery_dest))
+        with open("%s/.expfactory-battery-id" %battery_dest,"r") as filey:
+            self.assertFalse("sub2" in filey.read())
+        with open("%s/index.html" %battery_dest,"r") as filey:
+            second_id = re.findall(uuid_pattern,filey.read())
+        self.assertNotEqual(first_id[0],second_id[0])
+
+    def test_add_custom_variables(self):
+        template = "[SUB_A_SUB] [SUB_B_SUB] [SUB_A_SUB]"
+        custom_variables = [("[SUB_A_SUB]","[SUB_B_SUB]"),("[SUB_B_SUB]",2)]
+        # Substitutions are made in one pass, and substituted text is not searched again
+        self.assertEqual(add_custom_variables(custom_variables,template),"[SUB_B_SUB] 2 [SUB_B_SUB]")
+
+    def test_bundle_static(self):
+        battery_dest = "%s/battery" %(self.tmpdir)
+        move_experiments([self.experiment],battery_dest)
+        os.makedirs("%s/static/js/jspsych" %battery_dest)
+        os.makedirs("%s/static/css" %battery_dest)
+        with open("%s/static/js/jspsych/jspsych.js" %battery_dest,"w") as filey:
+            filey.write("var jsPsych = {}")
+        with open("%s/static/css/jspsych.css" %battery_dest,"w") as filey:
+            filey.write("body { background: url('../img/bg.png'); }")
+
+        # Shared libraries are bundled once, before each experiment bundle
+        loadstatic = bundle_static(BatteryPlan([self.experiment,self.experiment]),battery_dest)
+        bundles = re.findall("static/bundles/([^']+)",loadstatic)
+        self.assertEqual(len(bundles),4)
+        self.assertTrue(loadstatic.index("shared.") < loadstatic.index("test_task."))
+        with open("%s/static/bundles/%s" %(battery_dest,bundles[0]),"r") as filey:
+            self.assertTrue("var jsPsych" in filey.read())
+        css = [x for x in bundles if x.startswith("shared") and x.endswith(".css")][0]
+        with open("%s/static/bundles/%s" %(battery_dest,css),"r") as filey:
+            self.assertTrue("url('../img/bg.png')" in filey.read())
+
+        # Files missing from the battery keep their own tag
+        self.assertTrue("static/css/default_style.css" in loadstatic)
+        self.assertTrue("jspsych-poldrack-text.js" in loadstatic)
+
+    def test_compress_assets(self):
+        with open("%s/big.js" %self.tmpdir,"w") as filey:
+            filey.write("var x = 1;\n" * 500)
+        with open("%s/small.js" %self.tmpdir,"w") as filey:
+            filey.write("var x = 1;")
+        written = compress_assets(self.tmpdir,encodings=["gz"])
+        self.assertEqual(written,["%s/big.js.gz" %self.tmpdir])
+        with gzip.open("%s/big.js.gz" %self.tmpdir,"rb") as filey:
+            self.assertEqual(filey.read().decode("utf-8"),"var x = 1;\n" * 500)
+
+        # An up to date variant is not written again, even if the file is touched
+        self.assertEqual(compress_assets(self.tmpdir,encodings=["gz"]),[])
+        os.utime("%s/big.js" %self.tmpdir,(0,os.path.getmtime("%s/big.js" %self.tmpdir) + 10))
+        self.assertEqual(compress_assets(self.tmpdir,encodings=["gz"]),[])
+
+        # A file changed with the same size and an older mtime than its variant is compressed again
+        mtime = os.path.getmtime("%s/big.js" %self.tmpdir) - 10
+        with open("%s/big.js" %self.tmpdir,"w") as filey:
+            filey.write("var y = 1;\n" * 500)
+        os.utime("%s/big.js" %self.tmpdir,(0,mtime))
+        self.assertEqual(len(compress_assets(self.tmpdir,encodings=["gz"])),1)
+        with gzip.open("%s/big.js.gz" %self.tmpdir,"rb") as filey:
+            self.assertEqual(filey.read().decode("utf-8"),"var y = 1;\n" * 500)
+
+        # A file that does not get smaller is recorded, and not compressed again until it changes
+        with open("%s/packed.js" %self.tmpdir,"wb") as filey:
+            filey.write(os.urandom(4096))
+        self.assertEqual(compress_assets(self.tmpdir,encodings=["gz"]),[])
+        self.assertFalse(os.path.exists("%s/packed.js.gz" %self.tmpdir))
+        compressed = []
+        compress_file = assets.compress_file
+        assets.compress_file = lambda source,encoding,manifest=None: compressed.append(source)
+        try:
+            compress_assets(self.tmpdir,encodings=["gz"])
+            self.assertEqual(compressed,[])
+            with open("%s/packed.js" %self.tmpdir,"ab") as filey:
+                filey.write(b"0")
+            compress_assets(self.tmpdir,encodings=["gz"])
+            self.assertEqual(compressed,["%s/packed.js" %self.tmpdir])
+        finally:
+            assets.compress_file = compress_file
+
 if __name__ == '__main__':
     unittest.main()
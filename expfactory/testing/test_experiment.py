@@ -7,8 +7,9 @@ Test experiments
 import unittest
 import shutil
 from expfactory.experiment import validate, load_experiment, load_experiments, \
-get_experiments, make_lookup
-from expfactory.utils import copy_directory, get_installdir
+get_experiments, make_lookup, validate_experiments, get_index_file, load_index, \
+find_changed, save_snapshot, update_index
+from expfactory.utils import copy_directory, get_installdir, find_directories
 import tempfile
 import json
 import os
@@ -41,6 +42,93 @@ class TestExperiment(unittest.TestCase):
         loaded_experiment = load_experiment(self.experiment)  
         self.assertTrue(isinstance(loaded_experiment[0],dict))
 
+    def test_find_experiments_parallel(self):
+
+        # Parallel validation returns the same folders, in the same order
+        for name in ["task_b","task_a","task_c"]:
+            experiment = "%s/%s" %(self.tmpdir,name)
+            copy_directory(self.experiment,experiment)
+            config = json.loads(json.dumps(self.config))
+            config[0]["exp_id"] = name
+            self.save_config(config,experiment)
+        serial = get_experiments(self.tmpdir)
+        parallel = get_experiments(self.tmpdir,workers=3)
+        self.assertEqual(serial,parallel)
+        self.assertEqual([os.path.basename(x) for x in parallel],["task_a","task_b","task_c"])
+
+        # Messages are collected per experiment instead of printed
+        os.remove("%s/task_b/experiment.js" %self.tmpdir)
+        results = validate_experiments(sorted(find_directories(self.tmpdir)),warning=False,workers=3)
+        self.assertEqual([r[1] for r in results],[True,False,True])
+        self.assertTrue("experiment.js is specified in config.json but missing" in results[1][2][0])
+        self.assertEqual(results[0][2],[])
+
+    def test_find_experiments_index(self):
+        experiment = "%s/test_task" %self.tmpdir
+        copy_directory(self.experiment,experiment)
+
+        # The first load validates and writes the manifest
+        experiments = get_experiments(self.tmpdir,index=True)
+        self.assertEqual(experiments,[experiment])
+        self.assertTrue(os.path.exists(get_index_file(self.tmpdir)))
+        entry = load_index(self.tmpdir)["experiments"]["test_task"]
+        self.assertTrue(entry["valid"])
+        self.assertTrue("experiment.js" in entry["files"])
+
+        # Loaded configs come from the manifest
+        config = get_experiments(self.tmpdir,load=True,index=True)
+        self.assertEqual(config[0][0]["exp_id"],"test_task")
+
+        # A file copied over with the same mtime and size triggers revalidation
+        copied = "%s/copied.js" %self.tmpdir
+        shutil.copy2("%s/experiment.js" %experiment,copied)
+        entry = load_index(self.tmpdir)["experiments"]["test_task"]
+        os.rename(copied,"%s/experiment.js" %experiment)
+        get_experiments(self.tmpdir,index=True)
+        self.assertNotEqual(load_index(self.tmpdir)["experiments"]["test_task"]["files"]["experiment.js"],
+                            entry["files"]["experiment.js"])
+
+        # Changing a referenced file triggers revalidation
+        os.remove("%s/experiment.js" %experiment)
+        self.assertEqual(get_experiments(self.tmpdir,index=True),[])
+        self.assertFalse(load_index(self.tmpdir)["experiments"]["test_task"]["valid"])
+
+        # Updates to the manifest are merged with what is saved
+        def add_hash(index):
+            index["hashes"]["test_task/experiment.js"] = [0,0,0,0,"hash"]
+        update_index(self.tmpdir,add_hash)
+        copy_directory(self.experiment,"%s/other_task" %self.tmpdir)
+        get_experiments(self.tmpdir,index=True)
+        index = load_index(self.tmpdir)
+        self.assertTrue("other_task" in index["experiments"])
+        self.assertTrue("test_task/experiment.js" in index["hashes"])
+
+    def test_find_changed(self):
+        new_repo = "%s/new" %self.tmpdir
+        old_repo = "%s/old" %self.tmpdir
+        copy_directory(self.experiment,"%s/test_task" %new_repo)
+        copy_directory(self.experiment,"%s/test_task" %old_repo)
+        snapshot = "%s/snapshot.json" %self.tmpdir
+        save_snapshot(old_repo,snapshot)
+        os.remove(get_index_file(old_repo))
+
+        # Identical repos have no changes
+        self.assertEqual(find_changed(new_repo,old_repo),[])
+        self.assertEqual(find_changed(new_repo,snapshot),[])
+
+        # A modified file changes the experiment hash
+        with open("%s/test_task/style.css" %new_repo,"a") as filey:
+            filey.write("body {}")
+        changed = ["%s/test_task" %new_repo]
+        self.assertEqual(find_changed(new_repo,old_repo),changed)
+        self.assertEqual(find_changed(new_repo,snapshot),changed)
+        self.assertEqual(find_changed(new_repo,snapshot,return_experiments=False),
+                         ["%s/test_task/style.css" %new_repo])
+
+        # File hashes are cached in the manifest of the new repo only
+        self.assertTrue("test_task/style.css" in load_index(new_repo)["hashes"])
+        self.assertFalse(os.path.exists(get_index_file(old_repo)))
+
     def test_make_lookup(self):
         lookup = make_lookup([self.config],"exp_id")
         self.assertTrue("test_task" in lookup)
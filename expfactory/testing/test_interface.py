@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+"""
+Test the web interface and API
+"""
+
+from expfactory.interface import app
+from expfactory.experiment import load_experiment, make_lookup
+from expfactory.utils import get_installdir
+import unittest
+import json
+import time
+import os
+
+class TestInterface(unittest.TestCase):
+
+    def setUp(self):
+        self.pwd = get_installdir()
+        experiment = load_experiment("%s/testing/data/test_task" %self.pwd)
+        survey = [dict(experiment[0],exp_id="test_survey",template="survey",time=10)]
+        app.experiments = [experiment,survey]
+        app.experiment_lookup = make_lookup(app.experiments,"exp_id")
+        app.status = "ready"
+        app.loader = True
+        self.client = app.test_client()
+
+    def test_ready(self):
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code,200)
+        app.status = "loading"
+        self.assertEqual(self.client.get('/ready').status_code,503)
+        self.assertEqual(self.client.get('/experiments').status_code,503)
+
+    def test_experiments(self):
+        response = self.client.get('/experiments')
+        self.assertEqual(len(json.loads(response.data.decode("utf-8"))),2)
+
+        # Filters and fields
+        response = self.client.get('/experiments?template=survey&fields=exp_id,time')
+        self.assertEqual(json.loads(response.data.decode("utf-8")),[[{"exp_id":"test_survey","time":10}]])
+        response = self.client.get('/experiments?max_time=5&fields=exp_id')
+        self.assertEqual(json.loads(response.data.decode("utf-8")),[[{"exp_id":"test_task"}]])
+        self.assertEqual(self.client.get('/experiments?max_time=soon').status_code,400)
+
+        # Pages
+        response = self.client.get('/experiments?page=1&per_page=1&fields=exp_id')
+        self.assertEqual(json.loads(response.data.decode("utf-8")),[[{"exp_id":"test_task"}]])
+        self.assertEqual(response.headers["X-Total-Count"],"2")
+        self.assertTrue('rel="next"' in response.headers["Link"])
+
+        # A page that did not change is not sent again
+        etag = response.headers["ETag"]
+        response = self.client.get('/experiments?page=1&per_page=1&fields=exp_id',headers={"If-None-Match":etag})
+        self.assertEqual(response.status_code,304)
+
+    def test_experiment_single(self):
+        response = self.client.get('/experiments/test_task')
+        self.assertEqual(json.loads(response.data.decode("utf-8"))["test_task"]["exp_id"],"test_task")
+        self.assertEqual(self.client.get('/experiments/nope').status_code,404)
+
+    def test_job_download(self):
+        workspace = app.workspaces.create()
+        def build(job):
+            artifact = "%s/battery.zip" %(workspace.path)
+            with open(artifact,"w") as filey:
+                filey.write("battery")
+            return {"battery_dest":workspace.path,"artifact":artifact}
+        job = app.jobs.submit(build)
+        job.cleanup = workspace.release
+        for i in range(100):
+            if job.status == "finished":
+                break
+            time.sleep(0.05)
+
+        # The job and its workspace are removed once the battery is downloaded
+        response = self.client.get('/battery/jobs/%s/download' %(job.id))
+        self.assertEqual(response.data,b"battery")
+        response.close()
+        self.assertEqual(app.jobs.get(job.id),None)
+        self.assertFalse(os.path.exists(workspace.path))
+        self.assertEqual(self.client.get('/battery/jobs/%s/download' %(job.id)).status_code,404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+"""
+Test background jobs, and their workspaces
+"""
+
+from expfactory.jobs import JobQueue
+from expfactory.workspace import WorkspaceManager
+import unittest
+import threading
+import tempfile
+import shutil
+import time
+import os
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue(workers=2,max_jobs=2)
+
+    def wait(self,job):
+        for i in range(100):
+            if job.status in ["finished","failed"]:
+                break
+            time.sleep(0.05)
+        return job
+
+    def test_job_status(self):
+        event = threading.Event()
+        def build(job,name):
+            job.set_progress("building %s" %name)
+            event.wait(5)
+            return name
+
+        job = self.queue.submit(build,"stroop")
+        self.assertTrue(self.queue.get(job.id) is job)
+        event.set()
+        self.wait(job)
+        self.assertEqual(job.status,"finished")
+        self.assertEqual(job.result,"stroop")
+        self.assertEqual(job.to_dict()["progress"],"building stroop")
+
+    def test_job_failed(self):
+        def build(job):
+            raise ValueError("no experiments")
+        job = self.wait(self.queue.submit(build))
+        self.assertEqual(job.status,"failed")
+        self.assertEqual(job.error,"no experiments")
+
+        # Only max_jobs jobs are kept, the oldest done are forgotten
+        for x in range(2):
+            self.wait(self.queue.submit(build))
+        self.queue.submit(build)
+        self.assertEqual(self.queue.get(job.id),None)
+        self.assertEqual(len(self.queue.jobs),2)
+
+    def test_job_cleanup(self):
+        released = []
+        queue = JobQueue(workers=1,max_age=60)
+        def build(job):
+            return "battery.zip"
+
+        # A job is cleaned up when it is forgotten (eg, after its battery is downloaded)
+        job = self.wait(queue.submit(build))
+        job.cleanup = lambda: released.append(job.id)
+        self.assertTrue(queue.forget(job.id) is job)
+        self.assertEqual(queue.forget(job.id),None)
+        self.assertEqual(released,[job.id])
+
+        # Or when it expires
+        job = self.wait(queue.submit(build))
+        job.cleanup = lambda: released.append(job.id)
+        queue.expire()
+        self.assertTrue(queue.get(job.id) is job)
+        job.finished -= 120
+        queue.expire()
+        self.assertEqual(queue.get(job.id),None)
+        self.assertEqual(released[-1],job.id)
+
+
+class TestWorkspace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs("%s/catalog/battery" %self.tmpdir)
+        with open("%s/catalog/battery/config.txt" %self.tmpdir,"w") as filey:
+            filey.write("catalog")
+        self.workspaces = WorkspaceManager("%s/catalog" %self.tmpdir,root="%s/workspaces" %self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_workspace(self):
+        workspace = self.workspaces.create(["battery"])
+        other = self.workspaces.create(["battery"])
+        self.assertTrue(self.workspaces.get(workspace.id) is workspace)
+
+        # Writing to an unshared file does not change the catalog, or other workspaces
+        with open(workspace.unshare("battery/config.txt"),"w") as filey:
+            filey.write("workspace")
+        for folder in ["%s/catalog" %self.tmpdir,other.path]:
+            with open("%s/battery/config.txt" %folder,"r") as filey:
+                self.assertEqual(filey.read(),"catalog")
+
+        # The workspace is removed with its last reference
+        workspace.acquire()
+        workspace.release()
+        self.assertTrue(os.path.exists(workspace.path))
+        workspace.release()
+        self.assertFalse(os.path.exists(workspace.path))
+        self.assertEqual(self.workspaces.get(workspace.id),None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+"""
+Test saving results sent to the local server
+"""
+
+from expfactory.results import ResultStore
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+class TestResults(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = ResultStore(self.tmpdir,batch_size=5,flush_interval=None)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def read_results(self,subject,exp_id):
+        with open("%s/%s/%s.jsonl" %(self.tmpdir,subject,exp_id),"r") as filey:
+            return [json.loads(x) for x in filey.readlines()]
+
+    def test_batches(self):
+        '''test_batches
+        trials are buffered until the batch is full, and then written to a file per subject and experiment
+        '''
+        self.assertEqual(self.store.add("sub001","stroop",[{"rt":1},{"rt":2}]),2)
+        self.assertEqual(self.store.add("sub002","stroop",{"rt":3}),1)
+        self.assertFalse(os.path.exists("%s/sub001" %(self.tmpdir)))
+        self.store.add("sub001","battery",[{"rt":4,"exp_id":"nback"},{"rt":5}])
+        self.assertEqual(len(self.store.buffer),0)
+        self.assertEqual(self.read_results("sub001","stroop"),[{"rt":1},{"rt":2}])
+        self.assertEqual(self.read_results("sub001","nback"),[{"rt":4,"exp_id":"nback"}])
+        self.assertEqual(self.read_results("sub001","battery"),[{"rt":5}])
+        self.assertEqual(self.read_results("sub002","stroop"),[{"rt":3}])
+
+        # Files are appended to
+        self.store.add("sub002","stroop",{"rt":6})
+        self.assertEqual(self.store.close(),1)
+        self.assertEqual(self.read_results("sub002","stroop"),[{"rt":3},{"rt":6}])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError,self.store.add,"../sub001","stroop",[{"rt":1}])
+        self.assertRaises(ValueError,self.store.add,None,"stroop",[{"rt":1}])
+        self.assertRaises(ValueError,self.store.add,"sub001",None,[{"rt":1}])
+        self.assertRaises(ValueError,self.store.add,"sub001","stroop",[{"rt":1,"exp_id":".."}])
+        self.assertRaises(ValueError,self.store.add,"sub001","stroop","rt")
+        self.assertEqual(len(self.store.buffer),0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+"""
+Test survey scoring
+"""
+
+from expfactory.scoring import SurveyScorer, compile_scoring, get_missing_rule, get_scoring
+from expfactory.survey import export_questions, compiled_surveys
+from expfactory.experiment import load_experiment
+from expfactory.utils import get_installdir
+import unittest
+import tempfile
+import shutil
+import numpy
+import os
+
+class TestScoring(unittest.TestCase):
+
+    def setUp(self):
+        self.pwd = get_installdir()
+        self.survey = os.path.abspath("%s/testing/data/surveys/test_survey" %self.pwd)
+        self.config = load_experiment(self.survey)
+        self.questions = export_questions(self.config,self.survey)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        compiled_surveys.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing_rule(self):
+        self.assertEqual(get_missing_rule({}),(0,False))
+        self.assertEqual(get_missing_rule({"impute":True},{"max_missing":2}),(2,True))
+        self.assertEqual(get_missing_rule({"max_missing":1},{"max_missing":2,"impute":"mean"}),(1,True))
+
+    def test_score(self):
+        scorer = compile_scoring(self.config,self.survey,cache_dir="%s/cache" %(self.tmpdir))
+        self.assertEqual(scorer.scales,["impulsivity","planning"])
+        records = [[{"name":"test_survey_1_options","value":"4"},{"name":"test_survey_2_options","value":"1"},
+                    {"name":"test_survey_3_0_options","value":"Coffee"},{"name":"test_survey_5","value":"30"}],
+                   {"test_survey_1_options":"2"},
+                   [],
+                   {"test_survey_1_options":"9","test_survey_2_options":"3"}]
+        scores = scorer.score(records,index=["sub1","sub2","sub3","sub4"])
+        self.assertEqual(list(scores.columns),["impulsivity_sum","impulsivity_mean","impulsivity_missing",
+                                               "planning_sum","planning_mean","planning_missing"])
+
+        # Reverse-keyed items are (low + high - value)
+        self.assertEqual(scores.loc["sub1","impulsivity_sum"],2)
+        self.assertEqual(scores.loc["sub1","planning_sum"],8)
+        self.assertEqual(scores.loc["sub1","planning_mean"],4)
+
+        # One missing item is allowed, and imputed, for impulsivity only
+        self.assertEqual(scores.loc["sub2","impulsivity_sum"],6)
+        self.assertEqual(scores.loc["sub2","impulsivity_mean"],3)
+        self.assertEqual(scores.loc["sub2","planning_missing"],1)
+        self.assertTrue(numpy.isnan(scores.loc["sub2","planning_sum"]))
+
+        # Numeric values (eg, from pandas.read_csv) match option values as numbers
+        numeric = scorer.score([{"test_survey_1_options":4.0,"test_survey_2_options":1},
+                                {"test_survey_1_options":" 4 ","test_survey_2_options":float("nan")}])
+        self.assertEqual(list(numeric["planning_sum"])[0],8)
+        self.assertEqual(list(numeric["impulsivity_sum"])[1],2)
+
+        # No answers, and unknown values, are missing
+        self.assertEqual(scores.loc["sub3","impulsivity_missing"],2)
+        self.assertTrue(numpy.isnan(scores.loc["sub3","impulsivity_mean"]))
+        self.assertEqual(scores.loc["sub4","impulsivity_sum"],6)
+
+    def test_invalid_scoring(self):
+        scoring = get_scoring(self.config)
+        self.assertRaises(ValueError,SurveyScorer,self.questions,{"scales":{"bad":{"questions":["test_survey_5"]}}})
+        self.assertRaises(ValueError,SurveyScorer,self.questions,{"scales":{"bad":{"questions":["test_survey_3_0_options"]}}})
+        self.assertRaises(ValueError,SurveyScorer,self.questions,{"scales":{"bad":{"questions":["missing_options"]}}})
+        self.assertRaises(ValueError,SurveyScorer,self.questions,{"scales":{"bad":{"questions":["test_survey_1_options"],
+                                                                                  "reverse":["test_survey_2_options"]}}})
+        self.assertTrue(isinstance(SurveyScorer(self.questions,scoring),SurveyScorer))
+
+if __name__ == '__main__':
+    unittest.main()
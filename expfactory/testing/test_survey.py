@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+"""
+Test surveys
+"""
+
+from expfactory.survey import parse_questions, parse_validation, export_questions, generate_survey, compile_survey, \
+     compiled_surveys, get_validation_map, normalize_questions, read_survey_file
+from expfactory.experiment import load_experiment
+from expfactory.utils import get_installdir, copy_directory
+import unittest
+import tempfile
+import shutil
+import os
+import re
+
+class TestSurvey(unittest.TestCase):
+
+    def setUp(self):
+        self.pwd = get_installdir()
+        self.survey = os.path.abspath("%s/testing/data/surveys/test_survey" %self.pwd)
+        self.config = load_experiment(self.survey)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_questions(self):
+        questions,required_counts = parse_questions("%s/survey.tsv" %(self.survey),exp_id="test_survey")
+        self.assertEqual(len(questions),3)
+        self.assertEqual(required_counts,{1:2,2:2})
+        for page in questions:
+            self.assertTrue(page.startswith('<div class="step">\n'))
+            self.assertTrue(page.endswith('</div>'))
+        self.assertTrue(re.search('name="test_survey_1_options" value="1"',questions[0]))
+        self.assertTrue(re.search('name="test_survey_2_options" value="4"',questions[0]))
+        self.assertTrue(re.search('id="test_survey_5"',questions[1]))
+        self.assertTrue(re.search('page3',questions[2]))
+
+        # The normalized questions can be returned, to use without parsing the file again
+        questions,required_counts,frame = parse_questions("%s/survey.tsv" %(self.survey),exp_id="test_survey",return_frame=True)
+        self.assertEqual(list(frame["unique_id"])[:2],["test_survey_0","test_survey_1"])
+        self.assertEqual(parse_questions("%s/survey.tsv" %(self.survey),exp_id="test_survey",return_requiredcount=False),questions)
+
+    def test_parse_validation(self):
+        validation = parse_validation({2:1,1:3})
+        self.assertTrue(validation.startswith(" if ( state.stepIndex === 1 ) {\n"))
+        self.assertTrue(" else if ( state.stepIndex === 2 ) {" in validation)
+        self.assertEqual(validation.count("expfactory_finished=true"),1)
+
+    def test_validation_map(self):
+        questions = normalize_questions(read_survey_file("%s/survey.tsv" %(self.survey)),"test_survey")
+        validation_map = get_validation_map(questions)
+        self.assertEqual(sorted(validation_map.keys()),["1","2"])
+        self.assertEqual(validation_map["1"][0],{"id":"test_survey_1_options","kind":"choice","names":["test_survey_1_options"]})
+        self.assertEqual(validation_map["2"][1],{"id":"test_survey_5","kind":"text","names":["test_survey_5"]})
+
+        survey,validation = generate_survey(self.config,self.survey,validation_mode="map")
+        self.assertTrue(validation.startswith("if (!expfactory_validate("))
+        self.assertTrue("state.stepIndex === 2 ) {\nexpfactory_finished=true;" in validation)
+        self.assertEqual(survey,generate_survey(self.config,self.survey)[0])
+
+    def test_table(self):
+        survey = "%s/table_survey" %(self.tmpdir)
+        os.mkdir(survey)
+        scale = "Disagree,Neutral,Agree\t1,2,3"
+        rows = ["question_type\tquestion_text\tpage_number\toption_text\toption_values\trequired",
+                "table\tI am organized.\t1\t%s\t1" %(scale),
+                "table\tI am talkative.\t1\t%s\t0" %(scale),
+                "table\tI am calm.\t1\t%s\t1" %(scale),
+                "radio\tDo you agree?\t1\tYes,No\t1,0\t0",
+                "table\tI am curious.\t1\t%s\t1" %(scale),
+                "table\tI am kind.\t2\t%s\t1" %(scale)]
+        with open("%s/survey.tsv" %(survey),"w") as filey:
+            filey.write("%s\n" %("\n".join(rows)))
+        config = [{"exp_id":"table_survey"}]
+
+        # Consecutive rows on a page, with the same options, are one table
+        questions,required_counts = parse_questions("%s/survey.tsv" %(survey),exp_id="table_survey")
+        self.assertEqual(questions[0].count("<table"),2)
+        self.assertEqual(questions[0].count("<th>Agree</th>"),2)
+        self.assertEqual(questions[1].count("<table"),1)
+        self.assertEqual(questions[0].count('type="radio"'),3*3 + 2 + 3)
+        self.assertTrue('id="table_survey_1_options">I am talkative.</td>' in questions[0])
+        self.assertTrue('class="required page1" name="table_survey_2_options" value="3"' in questions[0])
+        self.assertEqual(required_counts,{1:3,2:1})
+
+        exported = export_questions(config,survey)
+        self.assertEqual(exported["table_survey_4_options"]["options"][2],{"id":"table_survey_4_2","value":"3","text":"Agree"})
+        self.assertEqual(len(exported),6)
+
+        validation_map = get_validation_map(normalize_questions(read_survey_file("%s/survey.tsv" %(survey)),"table_survey"))
+        self.assertEqual([x["id"] for x in validation_map["1"]],["table_survey_0_options","table_survey_2_options","table_survey_4_options"])
+
+    def test_generate_survey(self):
+        survey,validation = generate_survey(self.config,self.survey)
+        self.assertEqual(survey.count('<div class="step">'),3)
+        self.assertTrue(re.search("state.stepIndex === 2",validation))
+
+    def test_export_questions(self):
+        questions = export_questions(self.config,self.survey)
+        self.assertEqual(questions["test_survey_1_options"]["options"][3],
+                         {"id":"test_survey_1_3","value":"4","text":"Almost Always/Always"})
+        self.assertEqual(questions["test_survey_3_1_options"]["value"],"Tea")
+        self.assertEqual(questions["test_survey_5"]["required"],1)
+        self.assertEqual(len(questions),8)
+
+    def test_compile_survey(self):
+        cache_dir = "%s/cache" %(self.tmpdir)
+        compiled = compile_survey(self.config,self.survey,cache_dir=cache_dir)
+        html,validation = generate_survey(self.config,self.survey)
+        self.assertEqual(compiled["html"],html)
+        self.assertEqual(compiled["validation"],validation)
+        self.assertEqual(compiled["questions"],export_questions(self.config,self.survey))
+        self.assertEqual(len(os.listdir(cache_dir)),1)
+
+        # Compiled surveys are kept in memory, and read from disk in a new process
+        cached = compile_survey(self.config,self.survey,cache_dir=cache_dir)
+        self.assertTrue(cached["questions"] is compiled["questions"])
+
+        # Changing a returned survey does not change the cache
+        cached["html"] = ""
+        self.assertEqual(compile_survey(self.config,self.survey,cache_dir=cache_dir)["html"],html)
+        compiled_surveys.clear()
+        self.assertEqual(compile_survey(self.config,self.survey,cache_dir=cache_dir),compiled)
+
+        # A changed survey.tsv is compiled again
+        survey = "%s/test_survey" %(self.tmpdir)
+        copy_directory(self.survey,survey)
+        with open("%s/survey.tsv" %(survey),"a") as filey:
+            filey.write("textarea\tAnything else?\t3\t\t\t0\n")
+        changed = compile_survey(self.config,survey,cache_dir=cache_dir)
+        self.assertEqual(len(changed["questions"]),9)
+        self.assertEqual(len(os.listdir(cache_dir)),2)
+
+if __name__ == '__main__':
+    unittest.main()
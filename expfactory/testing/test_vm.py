@@ -7,6 +7,7 @@ Test experiments
 from expfactory.utils import copy_directory, get_installdir
 from expfactory.experiment import load_experiment
 from expfactory.vm import *
+from git import Repo
 import tempfile
 import unittest
 import shutil
@@ -46,6 +47,10 @@ class TestVm(unittest.TestCase):
         self.assertTrue(re.search("test_task_experiment",init))
         self.assertTrue(re.search("jsPsych.init",init))
 
+        init = get_jspsych_init(self.config[0],deployment="local-server")
+        self.assertTrue(re.search('"POST", "results"',init))
+        self.assertTrue(re.search("expfactory_finished",init))
+
     def test_getstylejs(self):
         experiment = load_experiment(self.experiment)
         stylejs = get_stylejs(experiment)
@@ -53,5 +58,105 @@ class TestVm(unittest.TestCase):
         self.assertTrue(re.search("style.css",stylejs[0])!=None)
         self.assertTrue(re.search("experiment.js",stylejs[1])!=None)
 
+
+class TestMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ["EXPFACTORY_CACHE"] = "%s/cache" %self.tmpdir
+
+        # A local bare repo acts as the remote
+        self.source = "%s/source" %self.tmpdir
+        self.remote = "%s/remote" %self.tmpdir
+        self.repo = Repo.init(self.source)
+        self.commit("battery.html","<html></html>")
+        Repo.clone_from(self.source,"%s/expfactory-battery" %self.remote,bare=True)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def commit(self,filename,content):
+        if not os.path.exists(os.path.dirname("%s/%s" %(self.source,filename))):
+            os.makedirs(os.path.dirname("%s/%s" %(self.source,filename)))
+        with open("%s/%s" %(self.source,filename),"w") as filey:
+            filey.write(content)
+        self.repo.index.add([filename])
+        self.repo.index.commit("add %s" %filename)
+
+    def test_refresh_policy(self):
+        self.assertEqual(get_refresh_policy("always"),0)
+        self.assertEqual(get_refresh_policy("never"),None)
+        self.assertEqual(get_refresh_policy("60"),60)
+        os.environ["EXPFACTORY_REFRESH"] = "hourly"
+        self.assertEqual(get_refresh_policy(),3600)
+
+    def test_download_repo_mirror(self):
+        repo = download_repo("battery","%s/battery1" %self.tmpdir,remote=self.remote)
+        self.assertTrue(os.path.exists("%s/battery1/battery.html" %self.tmpdir))
+        self.assertTrue(os.path.exists("%s/cache/expfactory-battery.git" %self.tmpdir))
+        self.assertEqual(repo.remotes.origin.url,"%s/expfactory-battery" %self.remote)
+
+        # Changes to the remote are only fetched as the refresh policy allows
+        self.commit("new.html","<html></html>")
+        self.repo.git.push("%s/expfactory-battery" %self.remote,"HEAD")
+        download_repo("battery","%s/battery2" %self.tmpdir,remote=self.remote,refresh="never")
+        self.assertFalse(os.path.exists("%s/battery2/new.html" %self.tmpdir))
+        download_repo("battery","%s/battery3" %self.tmpdir,remote=self.remote,refresh="always")
+        self.assertTrue(os.path.exists("%s/battery3/new.html" %self.tmpdir))
+
+    def test_sparse_checkout(self):
+        self.commit("stroop/config.json","[]")
+        self.commit("nback/config.json","[]")
+        self.repo.git.push("%s/expfactory-battery" %self.remote,"HEAD")
+        download_repo("battery","%s/battery" %self.tmpdir,remote=self.remote,paths=["stroop","missing"])
+        self.assertTrue(os.path.exists("%s/battery/stroop/config.json" %self.tmpdir))
+        self.assertTrue(os.path.exists("%s/battery/battery.html" %self.tmpdir))
+        self.assertFalse(os.path.exists("%s/battery/nback" %self.tmpdir))
+
+        # Without sparse checkout (older git), the folders and base files are checked out from HEAD
+        repo = Repo.clone_from(self.source,"%s/fallback" %self.tmpdir,no_checkout=True)
+        checkout_paths(repo,["stroop"])
+        self.assertTrue(os.path.exists("%s/fallback/stroop/config.json" %self.tmpdir))
+        self.assertTrue(os.path.exists("%s/fallback/battery.html" %self.tmpdir))
+        self.assertFalse(os.path.exists("%s/fallback/nback" %self.tmpdir))
+
+    def test_custom_battery_download(self):
+        os.environ["EXPFACTORY_REMOTE"] = self.remote
+        timings = dict()
+        tmpdir = custom_battery_download("%s/download" %self.tmpdir,repos=["battery"],timings=timings)
+        self.assertTrue(os.path.exists("%s/battery/battery.html" %tmpdir))
+        self.assertTrue("battery" in timings)
+
+        # All failures are reported, and nothing is left behind
+        os.makedirs("%s/partial" %self.tmpdir)
+        with self.assertRaises(RuntimeError) as context:
+            custom_battery_download("%s/partial" %self.tmpdir,repos=["battery","experiments","surveys"])
+        self.assertTrue("experiments" in str(context.exception))
+        self.assertTrue("surveys" in str(context.exception))
+        self.assertEqual(os.listdir("%s/partial" %self.tmpdir),[])
+
+    def test_offline_snapshot(self):
+        snapshot = "%s/snapshot.tar.gz" %self.tmpdir
+        export_snapshot(snapshot,repos=["battery"],remote=self.remote)
+        self.assertTrue(os.path.exists(snapshot))
+
+        # Offline, repos come from the cache, which is empty until the snapshot is imported
+        os.environ["EXPFACTORY_OFFLINE"] = "1"
+        os.environ["EXPFACTORY_CACHE"] = "%s/offline" %self.tmpdir
+        self.assertRaises(RuntimeError,download_repo,"battery","%s/battery1" %self.tmpdir,remote=self.remote)
+        self.assertEqual(import_snapshot(snapshot),["battery"])
+        download_repo("battery","%s/battery1" %self.tmpdir,remote="%s/missing" %self.tmpdir)
+        self.assertTrue(os.path.exists("%s/battery1/battery.html" %self.tmpdir))
+
+        # Or directly from a snapshot tarball
+        del os.environ["EXPFACTORY_OFFLINE"]
+        os.environ["EXPFACTORY_CACHE"] = "%s/other" %self.tmpdir
+        os.environ["EXPFACTORY_SNAPSHOT"] = snapshot
+        download_repo("battery","%s/battery2" %self.tmpdir,remote="%s/missing" %self.tmpdir)
+        self.assertTrue(os.path.exists("%s/battery2/battery.html" %self.tmpdir))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+"""
+Test the static server for local batteries and previews
+"""
+
+from expfactory.webserver import start_server
+from expfactory.assets import compress_file
+from expfactory.results import ResultStore
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+class TestWebserver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.content = ("var trial = %s;\n" %("x" * 100)) * 50
+        with open("%s/experiment.js" %(self.tmpdir),"w") as filey:
+            filey.write(self.content)
+        with open("%s/index.html" %(self.tmpdir),"w") as filey:
+            filey.write("<html></html>")
+        self.results = ResultStore("%s/results" %(self.tmpdir),flush_interval=None)
+        self.httpd,self.port = start_server(port=0,directory=self.tmpdir,results=self.results)
+        self.connection = HTTPConnection("localhost",self.port)
+
+    def tearDown(self):
+        self.connection.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def get(self,path,headers=None):
+        self.connection.request("GET",path,headers=headers or dict())
+        response = self.connection.getresponse()
+        return response,response.read()
+
+    def test_keep_alive(self):
+        '''test_keep_alive
+        more than one request can be sent over the same connection
+        '''
+        response,body = self.get("/")
+        self.assertEqual(response.status,200)
+        self.assertEqual(body,b"<html></html>")
+        response,body = self.get("/experiment.js")
+        self.assertEqual(response.status,200)
+        self.assertEqual(body.decode("utf-8"),self.content)
+        response,body = self.get("/missing.js")
+        self.assertEqual(response.status,404)
+
+    def test_conditional_get(self):
+        response,body = self.get("/experiment.js")
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+        response,body = self.get("/experiment.js",{"If-None-Match":etag})
+        self.assertEqual(response.status,304)
+        self.assertEqual(body,b"")
+        response,body = self.get("/experiment.js",{"If-Modified-Since":last_modified})
+        self.assertEqual(response.status,304)
+        response,body = self.get("/experiment.js",{"If-None-Match":'"other"'})
+        self.assertEqual(response.status,200)
+
+    def test_range(self):
+        response,body = self.get("/experiment.js",{"Range":"bytes=10-19"})
+        self.assertEqual(response.status,206)
+        self.assertEqual(body.decode("utf-8"),self.content[10:20])
+        self.assertEqual(response.getheader("Content-Range"),"bytes 10-19/%s" %(len(self.content)))
+        response,body = self.get("/experiment.js",{"Range":"bytes=-5"})
+        self.assertEqual(body.decode("utf-8"),self.content[-5:])
+        response,body = self.get("/experiment.js",{"Range":"bytes=%s-" %(len(self.content))})
+        self.assertEqual(response.status,416)
+        # A range for an older version of the file sends the whole file
+        response,body = self.get("/experiment.js",{"Range":"bytes=10-19","If-Range":'"other"'})
+        self.assertEqual(response.status,200)
+        self.assertEqual(len(body),len(self.content))
+
+    def test_precompressed(self):
+        compress_file("%s/experiment.js" %(self.tmpdir),"gz")
+        response,body = self.get("/experiment.js",{"Accept-Encoding":"gzip, deflate"})
+        self.assertEqual(response.status,200)
+        self.assertEqual(response.getheader("Content-Encoding"),"gzip")
+        self.assertEqual(response.getheader("Vary"),"Accept-Encoding")
+        self.assertTrue(len(body) < len(self.content))
+        response,body = self.get("/experiment.js",{"Accept-Encoding":"gzip;q=0"})
+        self.assertEqual(response.getheader("Content-Encoding"),None)
+        self.assertEqual(body.decode("utf-8"),self.content)
+        # A variant compressed from different content is not sent, even if it is newer than the file
+        with open("%s/experiment.js" %(self.tmpdir),"w") as filey:
+            filey.write(self.content.upper())
+        os.utime("%s/experiment.js" %(self.tmpdir),(0,0))
+        response,body = self.get("/experiment.js",{"Accept-Encoding":"gzip"})
+        self.assertEqual(response.getheader("Content-Encoding"),None)
+
+    def test_post_results(self):
+        result = {"subject":"sub001","exp_id":"stroop","data":[{"rt":500},{"rt":650}]}
+        self.connection.request("POST","/results",json.dumps(result),{"Content-Type":"application/json"})
+        response = self.connection.getresponse()
+        self.assertEqual(response.status,200)
+        self.assertEqual(json.loads(response.read().decode("utf-8")),{"saved":2})
+        self.results.close()
+        with open("%s/results/sub001/stroop.jsonl" %(self.tmpdir),"r") as filey:
+            self.assertEqual(len(filey.readlines()),2)
+
+        # The connection is kept alive after a bad result
+        result["subject"] = "../sub001"
+        self.connection.request("POST","/results",json.dumps(result),{"Content-Type":"application/json"})
+        response = self.connection.getresponse()
+        response.read()
+        self.assertEqual(response.status,400)
+        response,body = self.get("/")
+        self.assertEqual(response.status,200)
+
+    def test_post_results_error(self):
+        def write_lines(subject,exp_id,lines):
+            raise OSError("No space left on device")
+        self.results.write_lines = write_lines
+        self.results.batch_size = 1
+
+        # A result that cannot be written gets an error, and is kept to write later
+        result = {"subject":"sub001","exp_id":"stroop","data":[{"rt":500}]}
+        self.connection.request("POST","/results",json.dumps(result),{"Content-Type":"application/json"})
+        response = self.connection.getresponse()
+        self.assertEqual(response.status,500)
+        self.assertTrue("No space left" in json.loads(response.read().decode("utf-8"))["error"])
+        self.assertEqual(len(self.results.buffer),1)
+        response,body = self.get("/")
+        self.assertEqual(response.status,200)
+
+if __name__ == '__main__':
+    unittest.main()
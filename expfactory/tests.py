@@ -9,13 +9,11 @@ from expfactory.views import generate_experiment_web, tmp_experiment
 from expfactory.survey import read_survey_file, parse_questions, parse_validation
 from expfactory.utils import find_directories, get_url
 from selenium.webdriver.common.keys import Keys
+from expfactory.webserver import StaticFileHandler, start_server
 from expfactory.vm import download_repo
 from random import choice
 from selenium import webdriver
-from threading import Thread
-import SimpleHTTPServer
 from time import sleep
-import SocketServer
 import webbrowser
 import requests
 import fnmatch
@@ -26,8 +24,8 @@ import re
 import sys
 import os
 
-# subclass SimpleHTTPServer to capture error messages
-class ExpfactoryServer(SimpleHTTPServer.SimpleHTTPRequestHandler):
+# subclass StaticFileHandler to capture error messages
+class ExpfactoryServer(StaticFileHandler):
     def log_message(self, format, *args):
         sys.stderr.write("%s - - [%s] %s\n" %
                      (self.address_string(),
@@ -51,14 +49,7 @@ def get_web_server(port=None):
     '''get_web_server returns a httpd object (socket server) to run the experiment robot
     :param port: the port for the server, default is None will select one randomly between 8000 and 9999
     '''
-    if port == None:
-        port =choice(range(8000,9999))
-    Handler = ExpfactoryServer
-    httpd = SocketServer.TCPServer(("", port), Handler)
-    server = Thread(target=httpd.serve_forever)
-    server.setDaemon(True)
-    server.start()
-    return httpd,port
+    return start_server(port=port,handler=ExpfactoryServer)
 
 ## GENERAL VALIDATION #############################################################################
 
@@ -628,12 +619,7 @@ def test_experiment(folder=None,battery_folder=None,port=None,pause_time=2000):
 
     try:
         if port == None:
-            port = choice(range(8000,9999),1)[0]
-            Handler = ExpfactoryServer
-            httpd = SocketServer.TCPServer(("", port), Handler)
-            server = Thread(target=httpd.serve_forever)
-            server.setDaemon(True)
-            server.start()
+            httpd,port = get_web_server()
 
         # Set up a web browser
         browser = get_browser()
@@ -2,8 +2,8 @@
 utils.py: part of expfactory package
 
 '''
+from multiprocessing.pool import ThreadPool
 import errno
-import collections
 import shutil
 import json
 import os
@@ -16,6 +16,11 @@ except:
     from urllib.request import urlopen, Request, HTTPError
     basestring = str
 
+try:
+    from collections.abc import Mapping, Iterable
+except ImportError:
+    from collections import Mapping, Iterable
+
 def get_installdir():
     return os.path.dirname(os.path.abspath(__file__))
 
@@ -50,6 +55,24 @@ def find_directories(root,fullpath=True):
                     directories.append(item)
     return directories
 
+def run_parallel(func,tasks,workers=None):
+    '''run_parallel
+    map func over a list of tasks with a pool of threads, returning results in the same order as tasks
+    :param func: the function to run, taking a single task as input
+    :param tasks: a list of inputs for func
+    :param workers: number of threads to use. If None or 1, tasks are run one at a time
+    '''
+    if workers == None or workers <= 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+
+    pool = ThreadPool(min(workers,len(tasks)))
+    try:
+        results = pool.map(func,tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
 def remove_unicode_dict(input_dict):
     """
     remove unicode keys and values from dict, encoding in utf8
@@ -57,9 +80,9 @@ def remove_unicode_dict(input_dict):
     """
     if isinstance(input_dict, basestring):
         return str(input_dict)
-    elif isinstance(input_dict, collections.Mapping):
+    elif isinstance(input_dict, Mapping):
         return dict(map(remove_unicode_dict, input_dict.items()))
-    elif isinstance(input_dict, collections.Iterable):
+    elif isinstance(input_dict, Iterable):
         return type(input_dict)(map(remove_unicode_dict, input_dict))
     else:
         return input_dict
@@ -79,6 +102,110 @@ def copy_directory(src, dest):
         else:
             print('Directory not copied. Error: %s' % e)
 
+def get_link_strategies():
+    return ["copy","hardlink","reflink","symlink"]
+
+# ioctl request to clone a file's extents (linux/fs.h)
+FICLONE = 0x40049409
+
+def reflink_file(src, dest):
+    """
+    Clone a file's data blocks into dest (copy on write) where the filesystem supports
+    it, first with the FICLONE ioctl (btrfs, XFS), then with copy_file_range. Returns
+    True if the file was cloned, False if the caller should copy instead.
+
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    with open(src,"rb") as source:
+        with open(dest,"wb") as destination:
+            try:
+                fcntl.ioctl(destination.fileno(),FICLONE,source.fileno())
+                cloned = True
+            except (IOError,OSError):
+                cloned = False
+
+            if not cloned and hasattr(os,"copy_file_range"):
+                remaining = os.fstat(source.fileno()).st_size
+                try:
+                    while remaining > 0:
+                        copied = os.copy_file_range(source.fileno(),destination.fileno(),remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                    cloned = remaining == 0
+                except OSError:
+                    cloned = False
+
+    if cloned:
+        shutil.copystat(src,dest)
+    return cloned
+
+def link_file(src, dest, strategy="copy"):
+    """
+    Duplicate a single file with a link strategy (see link_directory), falling back to
+    a copy. Returns the strategy that was used.
+
+    """
+
+    if strategy == "hardlink":
+        try:
+            os.link(src,dest)
+            return "hardlink"
+        except (OSError,AttributeError):
+            pass
+    elif strategy == "reflink":
+        if reflink_file(src,dest):
+            return "reflink"
+    shutil.copy2(src,dest)
+    return "copy"
+
+def link_directory(src, dest, strategy="copy"):
+    """
+    Duplicate an entire directory recursively with a link strategy:
+
+      copy: copy every file (same as copy_directory)
+      hardlink: hard link every file, so no data is duplicated. The files are
+                shared with src, and editing one edits the other.
+      reflink: clone every file copy on write, on filesystems that support it
+      symlink: a single symbolic link to src
+
+    Files that cannot be linked (eg, across devices) are copied.
+
+    """
+
+    if strategy not in get_link_strategies():
+        print("Link strategy must be in %s, will copy." %(",".join(get_link_strategies())))
+        strategy = "copy"
+
+    if os.path.exists(dest):
+        print('Directory not copied. Error: %s exists' %(dest))
+        return
+
+    if strategy == "copy":
+        return copy_directory(src,dest)
+
+    if strategy == "symlink":
+        try:
+            if not os.path.exists(os.path.dirname(os.path.abspath(dest))):
+                os.makedirs(os.path.dirname(os.path.abspath(dest)))
+            os.symlink(os.path.abspath(src),dest)
+            return
+        except (OSError,AttributeError):
+            return copy_directory(src,dest)
+
+    src = os.path.abspath(src)
+    for root, dirnames, filenames in os.walk(src,followlinks=True):
+        dest_root = os.path.join(dest,os.path.relpath(root,src))
+        if not os.path.exists(dest_root):
+            os.makedirs(dest_root)
+        for filename in filenames:
+            link_file(os.path.join(root,filename),os.path.join(dest_root,filename),strategy)
+
 def get_template(template_file):
     """
     get_template: read in and return a template file
@@ -98,11 +225,105 @@ def sub_template(template,template_tag,substitution):
     template = template.replace(template_tag,substitution)
     return template
 
+class CompiledTemplate(object):
+    """
+    A template parsed once into literal and placeholder (tag) segments, so that all
+    substitutions are made in a single join instead of one pass over the template
+    per tag. Tags not given a substitution are left in place.
+
+    """
+
+    def __init__(self,template,tags):
+        tags = sorted(set(tags),key=len,reverse=True)
+        if len(tags) > 0:
+            pattern = re.compile("(%s)" %("|".join([re.escape(tag) for tag in tags])))
+            segments = pattern.split(template)
+        else:
+            segments = [template]
+        # Segments alternate literal, tag, literal, ... and start and end with a literal
+        self.literals = segments[0::2]
+        self.tags = segments[1::2]
+
+    def render(self,substitutions):
+        """
+        render the template
+        :param substitutions: a dictionary of {tag:substitution}, or a list of (tag,substitution) tuples
+        """
+        substitutions = dict(substitutions)
+        rendered = [self.literals[0]]
+        for tag,literal in zip(self.tags,self.literals[1:]):
+            rendered.append(str(substitutions.get(tag,tag)))
+            rendered.append(literal)
+        return "".join(rendered)
+
+
+# Compiled templates read from files, {(template_file,tags):(mtime,size,CompiledTemplate)}
+compiled_templates = dict()
+
+def get_compiled_template(template_file,tags):
+    """
+    get_compiled_template: read and compile a template file for a list of tags. The
+    compiled template is cached, and read again only if the file mtime or size changes
+
+    """
+
+    key = (os.path.abspath(template_file),tuple(sorted(set(tags))))
+    stat = os.stat(template_file)
+    cached = compiled_templates.get(key)
+    if cached != None and cached[0:2] == (stat.st_mtime,stat.st_size):
+        return cached[2]
+    with open(template_file,"r") as filey:
+        compiled = CompiledTemplate(filey.read(),tags)
+    compiled_templates[key] = (stat.st_mtime,stat.st_size,compiled)
+    return compiled
+
+def sub_templates(template,substitutions):
+    """
+    make substitutions for a list of (template_tag,substitution) tuples in a template, in
+    one pass. Unlike chained sub_template calls, substituted text is never searched for tags
+
+    """
+
+    substitutions = list(substitutions)
+    compiled = CompiledTemplate(template,[x[0] for x in substitutions])
+    return compiled.render(substitutions)
+
 def save_template(output_file,html_snippet):
     filey = open(output_file,"w")
     filey.writelines(html_snippet)
     filey.close()
 
+def save_template_if_changed(output_file,html_snippet):
+    """
+    save a template only if the file does not exist or its content differs, returns
+    True if the file was written
+
+    """
+
+    if os.path.exists(output_file):
+        with open(output_file,"r") as filey:
+            if filey.read() == html_snippet:
+                return False
+    save_template(output_file,html_snippet)
+    return True
+
+def save_json_atomic(outfile,myjson):
+    """
+    write json to a temporary file, then rename it to outfile, so readers never
+    see a partially written file
+
+    """
+
+    tmp_file = "%s.%s.tmp" %(outfile,os.getpid())
+    try:
+        with open(tmp_file,"w") as filey:
+            filey.write(json.dumps(myjson,sort_keys=True))
+        os.rename(tmp_file,outfile)
+    except (IOError,OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
 def save_pretty_json(outfile,myjson):
     filey = open(outfile,'wb')
     filey.write(json.dumps(myjson, sort_keys=True,indent=4, separators=(',', ': ')))
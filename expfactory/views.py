@@ -5,12 +5,16 @@ part of the experiment factory package
 functions for developing experiments and batteries, viewing and testing things
 '''
 
-from expfactory.utils import copy_directory, get_installdir, sub_template, get_template, save_pretty_json
-from expfactory.battery import get_experiment_run, generate_local, move_experiments, generate_base
+from expfactory.utils import copy_directory, get_installdir, sub_template, get_template, save_pretty_json, \
+     get_compiled_template
+from expfactory.battery import get_experiment_run, generate_local, generate_local_batch, move_experiments, generate_base
 from expfactory.vm import custom_battery_download, get_stylejs, get_jspsych_init
 from expfactory.experiment import load_experiment, get_experiments
+from expfactory.assets import compress_assets
+from expfactory.webserver import make_server
+from expfactory.results import ResultStore
 from cognitiveatlas.api import get_concept, get_task
-from expfactory.survey import generate_survey
+from expfactory.survey import compile_survey
 from random import choice
 import webbrowser
 import tempfile
@@ -20,13 +24,6 @@ import pandas
 import os
 import re
 
-try:
-    import SimpleHTTPServer
-    import SocketServer
-except:
-    import http.server as SimpleHTTPServer
-    import socketserver
-
 def embed_experiment(folder,url_prefix=""):
     '''embed_experiment
     return an html snippet for embedding into an application. This assumes the same directory structure, that all jspsych files can be found in static/js/jspych, and experiments under static/experiments/[folder]
@@ -37,7 +34,7 @@ def embed_experiment(folder,url_prefix=""):
     return get_experiment_html(experiment,folder,url_prefix=url_prefix)
 
 
-def run_single(exp_id,repo_type,destination=None,source_repo=None,battery_repo=None,port=None,subject_id=None):
+def run_single(exp_id,repo_type,destination=None,source_repo=None,battery_repo=None,port=None,subject_id=None,validation_mode="jquery"):
     '''run_survey runs or previews an entire battery locally with the --run tag. If no experiments are provided, all in the folder will be used.
     :param destination: destination folder for battery. If none provided, tmp directory is used
     :param exp_id: exp_id for survey, experiment, or game to run (unique ID)
@@ -46,6 +43,7 @@ def run_single(exp_id,repo_type,destination=None,source_repo=None,battery_repo=N
     :param subject_id: subject id to embed into result. If none, will be randomly generated
     :param battery_folder: full path to battery folder to use as a template. If none specified, the expfactory-battery repo will be used.
     :param port: the port number, default will be randomly generated between 8000 and 9999
+    :param validation_mode: for a survey, how to validate required questions, "jquery" (default) or "map" (see survey.generate_survey)
     '''
     valid_repos = ["experiments","games","surveys"]
     if repo_type not in valid_repos:
@@ -66,9 +64,12 @@ def run_single(exp_id,repo_type,destination=None,source_repo=None,battery_repo=N
         elif repo_type == "games":
             game_repo = source_repo
 
+    # Only a tmp directory made here is removed when the server stops
+    remove_destination = False
     if destination == None:
         destination = tempfile.mkdtemp()
         shutil.rmtree(destination)
+        remove_destination = True
 
     # We can only generate a battery to a folder that does not exist, to be safe
     if not os.path.exists(destination):
@@ -88,7 +89,7 @@ def run_single(exp_id,repo_type,destination=None,source_repo=None,battery_repo=N
         # Currently only support one survey
         output_folder = "%s/%s" %(base["%s_repo" %(repo_type[:-1])],exp_id)
         if output_folder in base[repo_type]:
-            preview_experiment(folder=output_folder,battery_folder=base["battery_repo"],port=port)
+            preview_experiment(folder=output_folder,battery_folder=base["battery_repo"],port=port,validation_mode=validation_mode)
         else:
             print("Invalid %s %s not found in surveys repo!" %(repo_type[:-1],exp_id))
 
@@ -96,63 +97,97 @@ def run_single(exp_id,repo_type,destination=None,source_repo=None,battery_repo=N
         print("Folder exists at %s, cannot generate." %(destination))
 
 
-def run_battery(destination=None,experiments=None,experiment_folder=None,subject_id=None,battery_folder=None,port=None,time=30):
+def run_battery(destination=None,experiments=None,experiment_folder=None,subject_id=None,battery_folder=None,port=None,time=30,update=False,
+                results=None,subject_ids=None):
     '''run_battery runs or previews an entire battery locally with the --run tag. If no experiments are provided, all in the folder will be used.
-    :param destination: destination folder for battery. If none provided, tmp directory is used
+    :param destination: destination folder for battery, kept when the server stops. If none provided, a tmp directory is used,
+                        and removed when the server stops
     :param experiments: list of experiment tags to add to battery
     :param experiment_folder: the folder of experiments to deploy the battery from.
     :param subject_id: subject id to embed into battery. If none, will be randomly generated
     :param battery_folder: full path to battery folder to use as a template. If none specified, the expfactory-battery repo will be used.
     :param port: the port number, default will be randomly generated between 8000 and 9999
     :param time: total number of minutes for experiments to add to battery
+    :param update: if True, an existing destination is updated in place (only changed experiments are copied)
+    :param results: a folder to save results in. If given, the battery POSTs its data to the server (instead of downloading a csv
+                    in the browser), to save in [results]/[subject_id]/[exp_id].jsonl, see results.ResultStore
+    :param subject_ids: a list of subject ids, to serve an entry page [subject_id].html for each (eg, one per computer in a lab),
+                        see battery.generate_local_batch
     '''
     print("Generating custom battery selecting from experiments for maximum of %s minutes, please wait..." %(time))
 
+    # Only a tmp directory made here is removed when the server stops
+    remove_destination = False
     if destination == None:
         destination = tempfile.mkdtemp()
         shutil.rmtree(destination)
+        remove_destination = True
+
+    deployment = "local"
+    if results != None:
+        deployment = "local-server"
 
     # Deploy experiment with battery to temporary directory   
-    tmpdir = generate_local(battery_dest=destination,
-                            subject_id=subject_id,
-                            battery_repo=battery_folder,
-                            experiment_repo=experiment_folder,
-                            experiments=experiments,
-                            warning=False,
-                            time=time)
+    if subject_ids != None:
+        tmpdir = generate_local_batch(subject_ids=subject_ids,
+                                      battery_dest=destination,
+                                      battery_repo=battery_folder,
+                                      experiment_repo=experiment_folder,
+                                      experiments=experiments,
+                                      warning=False,
+                                      time=time,
+                                      update=update,
+                                      deployment=deployment)
+    else:
+        tmpdir = generate_local(battery_dest=destination,
+                                subject_id=subject_id,
+                                battery_repo=battery_folder,
+                                experiment_repo=experiment_folder,
+                                experiments=experiments,
+                                warning=False,
+                                time=time,
+                                update=update,
+                                deployment=deployment)
+    if tmpdir == None:
+        return None
     os.chdir(tmpdir)
-    
+
+    store = None
+    if results != None:
+        store = ResultStore(os.path.abspath(results))
+        print("Results will be saved in %s" %(store.folder))
+
     try:
-        if port == None:
-            port = choice(range(8000,9999))
-        Handler = SimpleHTTPServer.SimpleHTTPRequestHandler
-        httpd = SocketServer.TCPServer(("", port), Handler)
+        httpd = make_server(port=port,directory=tmpdir,results=store)
+        port = httpd.server_address[1]
         print("Preview experiment at localhost:%s" %port)
         webbrowser.open("http://localhost:%s" %(port))
         httpd.serve_forever()
     except:
         print("Stopping web server...")
         httpd.server_close()
-        shutil.rmtree(tmpdir)
+        if store != None:
+            store.close()
+        if remove_destination == True:
+            shutil.rmtree(tmpdir)
 
     
-def preview_experiment(folder=None,battery_folder=None,port=None):
+def preview_experiment(folder=None,battery_folder=None,port=None,validation_mode="jquery"):
     '''preview_experiment
     preview an experiment locally with the --preview tag (for development)
     :param folder: full path to experiment folder to preview. If none specified, PWD is used
     :param battery_folder: full path to battery folder to use as a template. If none specified, the expfactory-battery repo will be used.
     :param port: the port number, default will be randomly generated between 8000 and 9999
     :param robot: if True, a web server is started as a separate process for a robot to run
+    :param validation_mode: for a survey, how to validate required questions, "jquery" (default) or "map" (see survey.generate_survey)
     '''
 
     # Deploy experiment with battery to temporary directory
-    tmpdir = tmp_experiment(folder,battery_folder)
+    tmpdir = tmp_experiment(folder,battery_folder,validation_mode=validation_mode)
     
     try:
-        if port == None:
-            port = choice(range(8000,9999))
-        Handler = SimpleHTTPServer.SimpleHTTPRequestHandler
-        httpd = SocketServer.TCPServer(("", port), Handler)
+        httpd = make_server(port=port,directory=tmpdir)
+        port = httpd.server_address[1]
         print("Preview experiment at localhost:%s" %port)
         webbrowser.open("http://localhost:%s" %(port))
         httpd.serve_forever()
@@ -163,7 +198,7 @@ def preview_experiment(folder=None,battery_folder=None,port=None):
 
 def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None,games_folder=None,
                             make_table=True,make_index=True,make_experiments=True,make_data=True,
-                            make_surveys=True,make_games=True):
+                            make_surveys=True,make_games=True,link_strategy="copy",compress=False):
     '''get_experiment_table
     Generate a table with links to preview all experiments
     :param experiment_folder: folder with experiments inside
@@ -176,6 +211,8 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
     :param make_data: generate json/tsv data to download 
     :param make_surveys: generate static files for surveys repos 
     :param make_games: generate static files for games repos 
+    :param link_strategy: how to add experiment, survey and game folders, one of "copy" (default), "hardlink", "reflink" or "symlink". See utils.link_directory
+    :param compress: write precompressed .gz (and .br) variants of static files, for the web server to send as is. See assets.compress_assets
     '''
     repos=["experiments","battery"]
     if make_surveys == True:
@@ -191,7 +228,7 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
 
     if experiment_folder == None:
         experiment_folder = "%s/experiments" %tmpdir
-    experiments = get_experiments(experiment_folder,load=True, warning=False)
+    experiments = get_experiments(experiment_folder,load=True,warning=False,index=True)
     experiment_tags = [x[0]["exp_id"] for x in experiments]
     battery_repo = "%s/battery" %(tmpdir)
     if survey_folder == None:
@@ -202,12 +239,12 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
     # If the user wants surveys and/or games, add them on to tasks
     tasks = experiments
     if make_surveys == True:
-        surveys = get_experiments(survey_folder,load=True,warning=False,repo_type="surveys")
+        surveys = get_experiments(survey_folder,load=True,warning=False,repo_type="surveys",index=True)
         survey_tags = [x[0]["exp_id"] for x in surveys]
         tasks = experiments + surveys
 
     if make_games == True:
-        games = get_experiments(games_folder,load=True,warning=False,repo_type="games")
+        games = get_experiments(games_folder,load=True,warning=False,repo_type="games",index=True)
         games_tags = [x[0]["exp_id"] for x in games]
         tasks = tasks + games
 
@@ -244,9 +281,10 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
             nodes.append('{"cluster": 1, "radius": "10", "color": colors[%s], "exp_id": "%s" }' %(choice([0,1,2]),experiment[0]["exp_id"]))
 
         # Generate index page
-        index_template = get_template("%s/templates/expfactory_index.html" %get_installdir())        
-        index_template = index_template.replace("[SUB_NODES_SUB]",",".join(nodes))
-        index_template = index_template.replace("[SUB_TOTAL_SUB]",str(len(nodes)))
+        substitutions = {"[SUB_NODES_SUB]":",".join(nodes),
+                         "[SUB_TOTAL_SUB]":str(len(nodes))}
+        index_template = get_compiled_template("%s/templates/expfactory_index.html" %get_installdir(),substitutions.keys())
+        index_template = index_template.render(substitutions)
         filey = open(output_index,"wb")
         filey.writelines(index_template)
         filey.close()
@@ -275,7 +313,7 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
         if os.path.exists(survey_dir):
             shutil.rmtree(survey_dir)
         valid_surveys = ["%s/%s" %(survey_folder,x[0]["exp_id"]) for x in surveys]
-        move_experiments(valid_surveys,battery_dest=output_dir,repo_type="surveys")
+        move_experiments(valid_surveys,battery_dest=output_dir,repo_type="surveys",link_strategy=link_strategy)
 
     # Clear old surveys, copy updated valid surveys into survey directory
     if make_games == True:
@@ -283,16 +321,16 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
         if os.path.exists(games_dir):
             shutil.rmtree(games_dir)
         valid_games = ["%s/%s" %(games_folder,x[0]["exp_id"]) for x in games]
-        move_experiments(valid_games,battery_dest=output_dir,repo_type="games")
+        move_experiments(valid_games,battery_dest=output_dir,repo_type="games",link_strategy=link_strategy)
 
     # Copy updated valid experiments into our experiment directory
     valid_experiments = ["%s/%s" %(experiment_folder,x[0]["exp_id"]) for x in experiments]
-    move_experiments(valid_experiments,battery_dest=output_dir)
+    move_experiments(valid_experiments,battery_dest=output_dir,link_strategy=link_strategy)
 
     # If the user wants to make a table
     if make_table == True:
 
-        table_template = get_template("%s/templates/table.html" %get_installdir())
+        table_template = get_compiled_template("%s/templates/table.html" %get_installdir(),["[[SUB_TABLE_SUB]]"])
         output_table = os.path.abspath("%s/table.html" %output_dir)
 
         # First prepare rendered table
@@ -310,7 +348,7 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
         table = "%s</tbody></table>\n" %(table)
 
         # Write the new table
-        table_template = table_template.replace("[[SUB_TABLE_SUB]]",table)
+        table_template = table_template.render({"[[SUB_TABLE_SUB]]":table})
         filey = open("%s/table.html" %output_dir,"wb")
         filey.writelines(table_template)
         filey.close()
@@ -365,14 +403,18 @@ def generate_experiment_web(output_dir,experiment_folder=None,survey_folder=None
         valid.to_csv("%s/expfactory-experiments.tsv" %(data_folder),sep="\t",index=None)
         valid.to_pickle("%s/expfactory-experiments.pkl" %(data_folder))
 
+    if compress == True:
+        compress_assets(output_dir)
+
 
-def get_experiment_html(experiment,experiment_folder,url_prefix="",deployment="local"):
+def get_experiment_html(experiment,experiment_folder,url_prefix="",deployment="local",validation_mode="jquery"):
     '''get_experiment_html
     return the html template to test a single experiment
     :param experiment: the loaded config.json for an experiment (json)
     :param experiment_folder: the experiment folder, needed for reading in a survey
     :param url_prefix: prefix to put before paths, in case of custom deployment
     :param deployment: deployment environment, one of docker, docker-preview, or local [default]
+    :param validation_mode: for a survey, how to validate required questions, "jquery" (default) or "map" (see survey.generate_survey)
     '''
 
     css,js = get_stylejs(experiment,url_prefix)
@@ -386,7 +428,8 @@ def get_experiment_html(experiment,experiment_folder,url_prefix="",deployment="l
 
     # HTML survey
     elif experiment[0]["template"] in ["survey"]:
-        html,validation = generate_survey(experiment,experiment_folder)
+        survey = compile_survey(experiment,experiment_folder,validation_mode=validation_mode)
+        html,validation = survey["html"],survey["validation"]
         runcode = ""
         template_base = "survey"
 
@@ -399,15 +442,15 @@ def get_experiment_html(experiment,experiment_folder,url_prefix="",deployment="l
 
     exp_template = "%s/templates/%s.html" %(get_installdir(),template_base)
 
-    # Make substitutions
-    exp_template = "".join(open(exp_template,"r").readlines())
-    exp_template = sub_template(exp_template,"{{js}}",js)
-    exp_template = sub_template(exp_template,"{{css}}",css)
-    exp_template = sub_template(exp_template,"{{run}}",runcode)
-    exp_template = sub_template(exp_template,"{{html}}",html)
-    exp_template = sub_template(exp_template,"{{validation}}",validation)
-    exp_template = sub_template(exp_template,"{{exp_id}}",experiment[0]["exp_id"])
-    return exp_template
+    # Make substitutions, the template is read and parsed once per process
+    substitutions = {"{{js}}":js,
+                     "{{css}}":css,
+                     "{{run}}":runcode,
+                     "{{html}}":html,
+                     "{{validation}}":validation,
+                     "{{exp_id}}":experiment[0]["exp_id"]}
+    exp_template = get_compiled_template(exp_template,substitutions.keys())
+    return exp_template.render(substitutions)
 
 
 def get_cognitiveatlas_hierarchy(experiment_tags=None,get_html=False):
@@ -421,7 +464,7 @@ def get_cognitiveatlas_hierarchy(experiment_tags=None,get_html=False):
 
     tmpdir = custom_battery_download()
     experiment_folder = "%s/experiments" %tmpdir
-    experiments = get_experiments(experiment_folder,load=True,warning=False)
+    experiments = get_experiments(experiment_folder,load=True,warning=False,index=True)
     if experiment_tags != None:
         experiments = [e for e in experiments if e[0]["exp_id"] in experiment_tags]
     
@@ -462,10 +505,11 @@ def get_cognitiveatlas_hierarchy(experiment_tags=None,get_html=False):
         tree = make_tree_from_triples(triples,output_html=False) 
     return tree
 
-def tmp_experiment(folder=None,battery_folder=None):
+def tmp_experiment(folder=None,battery_folder=None,validation_mode="jquery"):
     '''generate temporary directory with experiment
     :param folder: full path to experiment folder to preview (experiment, survey, or game). If none specified, PWD is used
     :param battery_folder: full path to battery folder to use as a template. If none specified, the expfactory-battery repo will be used.
+    :param validation_mode: for a survey, how to validate required questions, "jquery" (default) or "map" (see survey.generate_survey)
     '''
     if folder==None:
         folder=os.path.abspath(os.getcwd())
@@ -496,7 +540,7 @@ def tmp_experiment(folder=None,battery_folder=None):
     index_file = "%s/index.html" %(battery_folder)
         
     # Generate code for js and css
-    exp_template = get_experiment_html(experiment,experiment_folder)
+    exp_template = get_experiment_html(experiment,experiment_folder,validation_mode=validation_mode)
     filey = open(index_file,"w")
     filey.writelines(exp_template)
     filey.close()
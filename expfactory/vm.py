@@ -3,41 +3,355 @@ vm.py: part of expfactory package
 Functions to generate virtual machines to run expfactory batteries
 
 '''
-from expfactory.utils import save_template, clean_fields, copy_directory, get_installdir, sub_template, get_template
-from git import Repo
+from expfactory.utils import save_template, clean_fields, copy_directory, get_installdir, sub_template, get_template, \
+     run_parallel
+from git import Repo, GitCommandError
 import tempfile
+import hashlib
+import tarfile
 import shutil
+import time
 import os
 import re
 
-def download_repo(repo_type,destination):
+repo_types = ["experiments","battery","vm","surveys","games"]
+
+def get_cache_dir():
+    '''get_cache_dir
+    return the folder for the expfactory cache: the EXPFACTORY_CACHE environment variable, or ~/.cache/expfactory
+    '''
+    cache_dir = os.environ.get("EXPFACTORY_CACHE")
+    if cache_dir == None:
+        cache_dir = os.path.join(os.path.expanduser("~"),".cache","expfactory")
+    return cache_dir
+
+
+def get_repo_url(repo_type,remote=None):
+    '''get_repo_url
+    return the url of an expfactory repo, [remote]/expfactory-[repo_type]
+    :param repo_type: can be one of "experiments" "battery" "vm" "surveys" "games"
+    :param remote: the base url (or folder) with the repos. If None, the EXPFACTORY_REMOTE environment variable, or https://github.com/expfactory
+    '''
+    if remote == None:
+        remote = os.environ.get("EXPFACTORY_REMOTE","https://github.com/expfactory")
+    return "%s/expfactory-%s" %(remote.rstrip("/"),repo_type)
+
+
+def get_refresh_policy(refresh=None):
+    '''get_refresh_policy
+    return the maximum age (in seconds) of a mirror before it is fetched again, 0 to always fetch, or None to never fetch
+    :param refresh: "always", "never", or a number of seconds. If None, the EXPFACTORY_REFRESH environment variable, or 3600 (one hour)
+    '''
+    if refresh == None:
+        refresh = os.environ.get("EXPFACTORY_REFRESH",3600)
+    if refresh == "always":
+        return 0
+    if refresh == "never":
+        return None
+    try:
+        return int(refresh)
+    except (TypeError,ValueError):
+        print("WARNING: refresh policy %s is not always, never, or a number of seconds, will use 3600." %(refresh))
+        return 3600
+
+
+def is_offline():
+    '''is_offline
+    return True if the EXPFACTORY_OFFLINE environment variable is set (to 1, true or yes). In offline mode,
+    repos are only taken from the mirror cache or a snapshot, and never fetched.
+    '''
+    return os.environ.get("EXPFACTORY_OFFLINE","").lower() in ["1","true","yes"]
+
+
+def get_snapshot_dir(snapshot=None):
+    '''get_snapshot_dir
+    return the folder with repo mirrors of a snapshot, or None if no snapshot is used. A snapshot tarball is
+    extracted once to [cache]/snapshots.
+    :param snapshot: a snapshot folder or tarball (see export_snapshot). If None, the EXPFACTORY_SNAPSHOT environment variable
+    '''
+    if snapshot == None:
+        snapshot = os.environ.get("EXPFACTORY_SNAPSHOT")
+    if snapshot == None or snapshot == "":
+        return None
+    if os.path.isdir(snapshot):
+        return snapshot
+    if not os.path.exists(snapshot):
+        raise RuntimeError("Snapshot %s does not exist." %(snapshot))
+    stat = os.stat(snapshot)
+    key = "%s:%s:%s" %(os.path.abspath(snapshot),stat.st_mtime,stat.st_size)
+    key = hashlib.sha256(key.encode("utf-8")).hexdigest()[0:16]
+    snapshot_dir = os.path.join(get_cache_dir(),"snapshots",key)
+    if not os.path.exists(snapshot_dir):
+        tmp_dir = "%s.partial" %(snapshot_dir)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        import_snapshot(snapshot,cache_dir=tmp_dir)
+        os.rename(tmp_dir,snapshot_dir)
+    return snapshot_dir
+
+
+def get_mirror(repo_type,remote=None,refresh=None,cache_dir=None):
+    '''get_mirror
+    return the path to a bare mirror of an expfactory repo in the cache, [cache_dir]/expfactory-[repo_type].git.
+    The mirror is cloned if it does not exist, and fetched if it is older than the refresh policy. If a fetch
+    fails (eg, no network), the mirror is used as is. If a snapshot is set (see get_snapshot_dir), the mirror
+    is taken from the snapshot, and is never fetched. In offline mode (see is_offline), the mirror must exist.
+    :param repo_type: can be one of "experiments" "battery" "vm" "surveys" "games"
+    :param remote: the base url of the repos, see get_repo_url
+    :param refresh: when to fetch the mirror again, see get_refresh_policy
+    :param cache_dir: the cache folder. If None, the snapshot folder or get_cache_dir
+    '''
+    snapshot_dir = None
+    if cache_dir == None:
+        snapshot_dir = get_snapshot_dir()
+        cache_dir = snapshot_dir
+    if cache_dir == None:
+        cache_dir = get_cache_dir()
+    url = get_repo_url(repo_type,remote)
+    mirror = os.path.join(cache_dir,"expfactory-%s.git" %(repo_type))
+    stamp = os.path.join(mirror,"expfactory-fetched")
+
+    if snapshot_dir != None or is_offline():
+        if not os.path.exists(mirror):
+            raise RuntimeError("Offline: there is no copy of expfactory-%s in %s. Prepare a snapshot on a computer with internet with expfactory --export-snapshot, and add it with expfactory --import-snapshot." %(repo_type,cache_dir))
+        return mirror
+
+    if not os.path.exists(mirror):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Clone to a temporary folder first, so a failed or concurrent clone does not leave a broken mirror
+        tmp_mirror = tempfile.mkdtemp(prefix="expfactory-%s." %(repo_type),dir=cache_dir)
+        try:
+            Repo.clone_from(url,tmp_mirror,mirror=True)
+            open(os.path.join(tmp_mirror,"expfactory-fetched"),"w").close()
+            if not os.path.exists(mirror):
+                os.rename(tmp_mirror,mirror)
+        finally:
+            if os.path.exists(tmp_mirror):
+                shutil.rmtree(tmp_mirror)
+        return mirror
+
+    max_age = get_refresh_policy(refresh)
+    if max_age != None:
+        if not os.path.exists(stamp) or time.time() - os.path.getmtime(stamp) >= max_age:
+            repo = Repo(mirror)
+            try:
+                repo.git.remote("set-url","origin",url)
+                repo.git.fetch("--prune","origin")
+                open(stamp,"w").close()
+            except GitCommandError as error:
+                print("Cannot update %s, using cached mirror: %s" %(url,error))
+    return mirror
+
+
+def download_repo(repo_type,destination,cache=True,remote=None,refresh=None,paths=None):
     '''download_repo
-    Download a expfactory infrastructure repo "repo_type" to a "destination"
+    Download a expfactory infrastructure repo "repo_type" to a "destination". By default, the repo is cloned
+    from a local mirror (see get_mirror), and only the mirror is fetched over the network.
     :param repo_type: can be one of "experiments" "battery" "vm"
     :param destination: the full path to the destination for the repo
+    :param cache: if True (default), clone from the mirror cache. If False, clone from the remote directly, unless offline
+    :param remote: the base url of the repos, see get_repo_url
+    :param refresh: when to fetch the mirror again, see get_refresh_policy
+    :param paths: if defined, a list of top level folders (eg, exp_ids) to check out, along with files at the base
+                  of the repo. Other folders are not written to disk, see sparse_checkout
     '''
-    acceptable_types = ["experiments","battery","vm","surveys","games"]
-    if repo_type not in acceptable_types:
-        print("repo_type must be in %s" %(",".join(acceptable_types)))
+    if repo_type not in repo_types:
+        print("repo_type must be in %s" %(",".join(repo_types)))
     else:
-        return Repo.clone_from("https://github.com/expfactory/expfactory-%s" %(repo_type), destination)
-
-
-def custom_battery_download(tmpdir=None,repos=["experiments","battery","surveys","games"]):
+        url = get_repo_url(repo_type,remote)
+        if cache == False and not is_offline() and get_snapshot_dir() == None:
+            source = url
+        else:
+            source = get_mirror(repo_type,remote=remote,refresh=refresh)
+        if paths == None:
+            repo = Repo.clone_from(source, destination)
+        else:
+            repo = Repo.clone_from(source, destination, no_checkout=True)
+            sparse_checkout(repo,paths)
+        # The checkout points to the real remote, as if it had been cloned from it
+        repo.git.remote("set-url","origin",url)
+        return repo
+
+
+def sparse_checkout(repo,paths):
+    '''sparse_checkout
+    check out only some top level folders of a repo cloned with no checkout, with a cone mode sparse
+    checkout. Files at the base of the repo are always checked out. If git does not support it (before 2.25),
+    the folders and base files are checked out from HEAD instead, see checkout_paths. Folders not in the repo are ignored.
+    :param repo: a git.Repo, cloned with no_checkout=True
+    :param paths: a list of top level folders to check out
+    '''
+    folders = repo.git.ls_tree("--name-only","-d","HEAD").split("\n")
+    paths = [x for x in paths if x in folders]
+    try:
+        repo.git.sparse_checkout("set","--cone",*paths)
+        repo.git.checkout(repo.active_branch.name)
+    except GitCommandError:
+        checkout_paths(repo,paths)
+    return repo
+
+
+def checkout_paths(repo,paths):
+    '''checkout_paths
+    check out top level folders of a repo cloned with no checkout, along with the files at the base of the
+    repo (as with a cone mode sparse checkout), from HEAD
+    :param repo: a git.Repo, cloned with no_checkout=True
+    :param paths: a list of top level folders in the repo to check out
+    '''
+    folders = repo.git.ls_tree("--name-only","-d","HEAD").split("\n")
+    files = [x for x in repo.git.ls_tree("--name-only","HEAD").split("\n") if x != "" and x not in folders]
+    if len(paths + files) > 0:
+        repo.git.checkout("HEAD","--",*(paths + files))
+    return repo
+
+
+def export_snapshot(output,repos=None,remote=None,refresh=None):
+    '''export_snapshot
+    write a snapshot of the expfactory repos, for computers without internet (see import_snapshot). The snapshot
+    has a bare mirror of each repo, expfactory-[repo_type].git, taken from the mirror cache (see get_mirror).
+    :param output: a tarball (ending in .tar, .tar.gz or .tgz), or a folder that does not exist
+    :param repos: the repos to include. If None, all of repo_types
+    :param remote: the base url of the repos, see get_repo_url
+    :param refresh: when to fetch the mirrors again, see get_refresh_policy
+    '''
+    if repos == None:
+        repos = repo_types
+    mirrors = [get_mirror(repo,remote=remote,refresh=refresh) for repo in repos]
+    if re.search("[.](tar|tar[.]gz|tgz)$",output):
+        mode = "w"
+        if not output.endswith(".tar"):
+            mode = "w:gz"
+        tar = tarfile.open(output,mode)
+        try:
+            for mirror in mirrors:
+                tar.add(mirror,arcname=os.path.basename(mirror))
+        finally:
+            tar.close()
+    elif os.path.exists(output):
+        print("Folder exists at %s, cannot export snapshot." %(output))
+        return None
+    else:
+        for mirror in mirrors:
+            copy_directory(mirror,os.path.join(output,os.path.basename(mirror)))
+    print("Exported snapshot of %s to %s" %(",".join(repos),output))
+    return output
+
+
+def import_snapshot(snapshot,cache_dir=None):
+    '''import_snapshot
+    add the repo mirrors from a snapshot (see export_snapshot) to the mirror cache, replacing any there, and
+    return the list of repos imported
+    :param snapshot: a snapshot folder or tarball
+    :param cache_dir: the cache folder. If None, see get_cache_dir
+    '''
+    if cache_dir == None:
+        cache_dir = get_cache_dir()
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Mirrors are unpacked next to the cache, then moved in one at a time
+    tmpdir = tempfile.mkdtemp(prefix="expfactory-snapshot.",dir=cache_dir)
+    try:
+        if os.path.isdir(snapshot):
+            names = [x for x in os.listdir(snapshot) if re.search("^expfactory-[a-z]+[.]git$",x)]
+            for name in names:
+                copy_directory(os.path.join(snapshot,name),os.path.join(tmpdir,name))
+        else:
+            tar = tarfile.open(snapshot,"r:*")
+            try:
+                members = []
+                for member in tar.getmembers():
+                    name = os.path.normpath(member.name)
+                    if not re.search("^expfactory-[a-z]+[.]git($|/)",name) or ".." in name.split("/"):
+                        raise RuntimeError("%s is not an expfactory snapshot, it contains %s" %(snapshot,member.name))
+                    if member.isfile() or member.isdir():
+                        members.append(member)
+                tar.extractall(tmpdir,members=members)
+            finally:
+                tar.close()
+            names = os.listdir(tmpdir)
+
+        imported = []
+        for name in names:
+            mirror = os.path.join(cache_dir,name)
+            if os.path.exists(mirror):
+                shutil.rmtree(mirror)
+            os.rename(os.path.join(tmpdir,name),mirror)
+            open(os.path.join(mirror,"expfactory-fetched"),"w").close()
+            imported.append(re.sub("^expfactory-|[.]git$","",name))
+    finally:
+        shutil.rmtree(tmpdir)
+    print("Imported %s from snapshot %s" %(",".join(imported),snapshot))
+    return imported
+
+
+def custom_battery_download(tmpdir=None,repos=["experiments","battery","surveys","games"],workers=4,timings=None,tasks=None):
     '''custom_battery_download
-    Download battery and experiment repos to a temporary folder to build a custom battery, return the path to the tmp folders
+    Download battery and experiment repos to a temporary folder to build a custom battery, return the path to the tmp folders.
+    Repos are downloaded at the same time. All repos are required: if any fail, the repos downloaded are removed (and the
+    temporary folder, if it was made here), and a RuntimeError lists every failure.
     :param tmpdir: The directory to download to. If none, a temporary directory will be made
     :param repos: The repositories to download, valid choices are "experiments" "battery" and "vm"
+    :param workers: number of repos to download at the same time (default 4)
+    :param timings: if a dictionary is given, the seconds to download each repo are added to it, with the repo as key
+    :param tasks: if defined, a list of exp_ids: only these folders are checked out from the experiments, surveys and games repos
     '''
     if isinstance(repos,str):
         repos = [repos]
+    made_tmpdir = False
     if not tmpdir:
         tmpdir = tempfile.mkdtemp()
+        made_tmpdir = True
+    paths = None
+    if tasks != None:
+        paths = [os.path.basename(x) for x in tasks]
+    downloads = []
     for repo in repos:
-        download_repo(repo,"%s/%s/" %(tmpdir,repo))
+        if repo in ["experiments","surveys","games"]:
+            downloads.append((repo,"%s/%s/" %(tmpdir,repo),paths))
+        else:
+            downloads.append((repo,"%s/%s/" %(tmpdir,repo),None))
+    results = run_parallel(download_repo_task,downloads,workers=workers)
+
+    errors = []
+    for repo,seconds,error in results:
+        if timings != None:
+            timings[repo] = seconds
+        if error != None:
+            print("Failed to download %s after %.2f seconds" %(repo,seconds))
+            errors.append("%s: %s" %(repo,error))
+        else:
+            print("Downloaded %s in %.2f seconds" %(repo,seconds))
+
+    if len(errors) > 0:
+        if made_tmpdir == True:
+            shutil.rmtree(tmpdir)
+        else:
+            for repo,destination,paths in downloads:
+                if os.path.exists(destination):
+                    shutil.rmtree(destination)
+        raise RuntimeError("Error downloading %s of %s repos:\n%s" %(len(errors),len(repos),"\n".join(errors)))
     return tmpdir
 
 
+def download_repo_task(task):
+    '''download_repo_task
+    a task for custom_battery_download, to download one repo. Returns a tuple with (repo,seconds,error), where
+    error is None if the download succeeded
+    :param task: a tuple with (repo,destination,paths)
+    '''
+    repo,destination,paths = task
+    start = time.time()
+    error = None
+    try:
+        if download_repo(repo,destination,paths=paths) == None:
+            error = "repo_type must be in %s" %(",".join(repo_types))
+    except Exception as exc:
+        error = str(exc).strip()
+    return (repo,time.time() - start,error)
+
+
 def add_custom_logo(battery_repo,logo):
     '''add_custom_logo
     Add a custom logo to the vm battery
@@ -168,7 +482,7 @@ def get_jspsych_init(experiment,deployment="local",finished_message=None):
     '''get_jspsych_init
     return entire jspsych init structure
     :param experiment: the loaded config.json for the experiment
-    :param deployment: specify to deploy local (default), or docker-mturk,docker-local (expfactory-docker). 
+    :param deployment: specify to deploy local (default), local-server (data is POSTed to the local server, see get_results_post), or docker-mturk,docker-local (expfactory-docker). 
     :param finished_message: custom message to show at the end of the experiment with Redo and Next Experiment Buttons
     '''
     jspsych_init = "jsPsych.init({\ntimeline: %s_experiment,\n" %(experiment["exp_id"])
@@ -179,6 +493,10 @@ def get_jspsych_init(experiment,deployment="local",finished_message=None):
     default_inits = dict()
     default_inits["local"] = {"on_finish":["jsPsych.data.localSave('%s_results.csv', 'csv');\nexpfactory_finished = true;" %(experiment["exp_id"])]}
 
+    # Local server, with results saved by expfactory (see webserver.py)
+    subject = 'jsPsych.data.getData().length > 0 && jsPsych.data.getData()[0].subject || "anonymous"'
+    default_inits["local-server"] = {"on_finish":["%s\nexpfactory_finished = true;" %(get_results_post(subject,'"%s"' %(experiment["exp_id"])))]}
+
     # Amazon Mechanical Turk
     default_inits["docker-mturk"] = {"on_finish":["""finished_message = '<div id="finished_message" style="margin:100px"><h1>Experiment Complete</h1><p>%s</p><button id="next_experiment_button" type="button" class="btn btn-success">Next Experiment</button><button type="button" id="redo_experiment_button" class="btn btn-danger">Redo Experiment</button></div>'\nexpfactory.recordTrialData(jsPsych.data.getData());\n$("body").append(finished_message);\n$(".display_stage").hide();\n$(".display_stage_background").hide();\n$("#redo_experiment_button").click( function(){\njavascript:window.location.reload();\n})\n$("#next_experiment_button").click( function(){\nexpfactory.djstatus = "FINISHED";\n$.ajax({ type: "POST",\ncontentType: "application/json",\nurl : "/sync/{{result.id}}/",\ndata : JSON.stringify(expfactory),\ndataType: "json",\nerror: function(error){\nconsole.log(error)\n},\nsuccess: function(data){\nconsole.log("Finished!");\nif (data.finished_battery == "FINISHED"){\n$("#turkey_form").submit()\n} else {\ndocument.location = "{{next_page}}";\n}\n}\n});\n});\n""" %finished_message],
                                "on_data_update":["""expfactory.djstatus = "UPDATE";\n$.ajax({ type: "POST",\ncontentType: "application/json",\nurl : "/sync/{{result.id}}/",\ndata : JSON.stringify(expfactory),\ndataType: "json",\nsuccess: function(data){\nconsole.log("data update called")\n}\n});\n"""]}
@@ -199,7 +517,7 @@ def get_jspsych_init(experiment,deployment="local",finished_message=None):
 
             # Fill user custom variables into data structure
             for jspsych_var,jspsych_val in custom_variables.items():
-                if deployment == "local":            
+                if deployment in ["local","local-server"]:
                     if jspsych_var in default_inits[deployment]:
                          holder = default_inits[deployment][jspsych_var]
                          holder.append(jspsych_val)
@@ -242,3 +560,14 @@ def get_jspsych_init(experiment,deployment="local",finished_message=None):
             jspsych_init = "%s\n});" %(jspsych_init)
 
     return jspsych_init
+
+
+def get_results_post(subject,exp_id,url="results"):
+    '''get_results_post
+    return javascript to POST all jspsych data to the results sink of the local server (see webserver.py), for
+    the local-server deployment. Trials with their own exp_id (eg, in a battery) are saved with that experiment.
+    :param subject: javascript expression for the subject id (eg, '"DNS001"')
+    :param exp_id: javascript expression for the experiment id
+    :param url: the url to POST to, relative to the page (default is results)
+    '''
+    return """var expfactory_result = new XMLHttpRequest();\nexpfactory_result.open("POST", "%s", true);\nexpfactory_result.setRequestHeader("Content-Type", "application/json");\nexpfactory_result.onload = function(){\nconsole.log("Results saved: " + expfactory_result.status);\n};\nexpfactory_result.send(JSON.stringify({subject: %s, exp_id: %s, data: jsPsych.data.getData()}));""" %(url,subject,exp_id)
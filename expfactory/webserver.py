@@ -0,0 +1,287 @@
+'''
+webserver.py: part of expfactory package
+A static file server to run batteries and experiments locally
+
+'''
+
+from expfactory.assets import is_variant_current
+from email.utils import parsedate_tz, mktime_tz
+from threading import Thread
+from random import choice
+import posixpath
+import shutil
+import json
+import os
+import re
+
+try:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+except ImportError:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+
+# Precompressed variants (see assets.compress_assets), in order of preference
+encodings = [("br","br"),("gzip","gz")]
+
+# Largest result (in bytes) that can be POSTed to /results
+max_result_size = 50 * 1024 * 1024
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    '''ThreadingHTTPServer
+    an http server that handles each connection in its own thread, so a slow file or an open keep-alive
+    connection does not block other requests
+    :param directory: the folder to serve. If None, the current working directory (at the time of each request)
+    :param results: a ResultStore (see results.py) to save data POSTed to /results. If None, POST is not allowed
+    The hashes of files with precompressed variants are cached (see experiment.get_file_hash) in hashes.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler, directory=None, results=None):
+        self.directory = directory
+        self.results = results
+        self.hashes = dict()
+        HTTPServer.__init__(self, server_address, handler)
+
+
+class RangeFile(object):
+    '''RangeFile
+    a file opened at the start of a byte range, that reads no further than its end
+    '''
+    def __init__(self, filey, length):
+        self.filey = filey
+        self.length = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.length:
+            size = self.length
+        data = self.filey.read(size)
+        self.length -= len(data)
+        return data
+
+    def close(self):
+        self.filey.close()
+
+
+class StaticFileHandler(SimpleHTTPRequestHandler):
+    '''StaticFileHandler
+    serves files with HTTP/1.1 keep-alive, conditional requests (ETag and Last-Modified), byte ranges
+    (for audio and video stimuli), and precompressed .br and .gz variants of files when the browser accepts them.
+    If the server has a ResultStore, results can be POSTed to /results as JSON, {"subject":..,"exp_id":..,"data":[..]}
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def translate_path(self, path):
+        path = path.split('?',1)[0].split('#',1)[0]
+        trailing_slash = path.rstrip().endswith('/')
+        path = posixpath.normpath(unquote(path))
+        result = self.server.directory
+        if result == None:
+            result = os.getcwd()
+        for word in [x for x in path.split('/') if x]:
+            if os.path.dirname(word) or word in (os.curdir, os.pardir):
+                continue
+            result = os.path.join(result, word)
+        if trailing_slash:
+            result += '/'
+        return result
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not self.path.split('?',1)[0].endswith('/'):
+                self.send_response(301)
+                self.send_header("Location", self.path.split('?',1)[0] + "/")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            for index in ["index.html","index.htm"]:
+                if os.path.exists(os.path.join(path, index)):
+                    path = os.path.join(path, index)
+                    break
+            else:
+                return self.list_directory(path)
+
+        if path.endswith("/") or not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+
+        stat = os.stat(path)
+        etag = '"%x-%x"' %(int(stat.st_mtime), stat.st_size)
+        last_modified = self.date_time_string(int(stat.st_mtime))
+        if self.is_not_modified(etag, stat.st_mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return None
+
+        # Byte ranges are served from the file itself, otherwise a precompressed variant may be sent
+        byte_range = self.get_range(etag, stat.st_size)
+        if byte_range == "invalid":
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%s" %(stat.st_size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        content_type = self.guess_type(path)
+        encoding,variants = None,False
+        for name,extension in encodings:
+            variant = "%s.%s" %(path, extension)
+            if is_variant_current(path, extension, cache=self.server.hashes):
+                variants = True
+                if encoding == None and byte_range == None and self.accepts_encoding(name):
+                    encoding,path = name,variant
+
+        filey = open(path, 'rb')
+        length = os.fstat(filey.fileno()).st_size
+        if byte_range != None:
+            start,end = byte_range
+            filey.seek(start)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" %(start, end, length))
+            length = end - start + 1
+            filey = RangeFile(filey, length)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Cache-Control", "no-cache")
+        if encoding != None:
+            self.send_header("Content-Encoding", encoding)
+            etag = '%s-%s"' %(etag[:-1], encoding)
+        if variants == True:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return filey
+
+    def is_not_modified(self, etag, mtime):
+        '''is_not_modified
+        return True if the request has an If-None-Match with the etag (of the file, or any of its variants),
+        or else an If-Modified-Since that is not older than the file
+        '''
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match != None:
+            tags = [re.sub('-(br|gzip)"$','"',x.strip()) for x in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since != None:
+            date = parsedate_tz(if_modified_since)
+            if date != None:
+                return int(mtime) <= mktime_tz(date)
+        return False
+
+    def get_range(self, etag, size):
+        '''get_range
+        return the (start,end) bytes of a Range request, None to send the whole file, or "invalid" when the
+        range cannot be satisfied. Only single ranges are supported, others get the whole file.
+        '''
+        header = self.headers.get("Range")
+        if header == None:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range != None and if_range.strip() != etag:
+            return None
+        match = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+        if match == None or match.groups() == ("",""):
+            return None
+        start,end = match.groups()
+        if start == "":
+            start,end = max(size - int(end), 0),size - 1
+        else:
+            start = int(start)
+            end = size - 1 if end == "" else min(int(end), size - 1)
+        if start >= size or start > end:
+            return "invalid"
+        return (start,end)
+
+    def accepts_encoding(self, name):
+        accept_encoding = self.headers.get("Accept-Encoding","")
+        for value in accept_encoding.split(","):
+            parts = [x.strip() for x in value.split(";")]
+            if parts[0] == name:
+                return not any([re.match(r"^q=0(\.0*)?$", x) for x in parts[1:]])
+        return False
+
+    def copyfile(self, source, outputfile):
+        shutil.copyfileobj(source, outputfile, 64 * 1024)
+
+    def do_POST(self):
+        results = getattr(self.server, "results", None)
+        if results == None or self.path.split('?',1)[0].rstrip("/") != "/results":
+            self.close_connection = True
+            self.send_error(405, "Method not allowed")
+            return
+
+        length = self.headers.get("Content-Length")
+        if length == None or not length.isdigit():
+            self.close_connection = True
+            self.send_error(411, "Length required")
+            return
+        if int(length) > max_result_size:
+            self.close_connection = True
+            self.send_error(413, "Result too large")
+            return
+
+        body = self.rfile.read(int(length))
+        try:
+            result = json.loads(body.decode("utf-8"))
+            if not isinstance(result, dict):
+                raise ValueError("result must be an object")
+            count = results.add(result.get("subject"), result.get("exp_id"), result.get("data"))
+        except ValueError as error:
+            self.send_json(400, {"error":str(error)})
+            return
+        except (IOError, OSError) as error:
+            print("Error writing results: %s" %(error))
+            self.send_json(500, {"error":"cannot write results: %s" %(error)})
+            return
+        self.send_json(200, {"saved":count})
+
+    def send_json(self, status, data):
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def make_server(port=None,directory=None,handler=StaticFileHandler,host="",results=None):
+    '''make_server
+    return a threaded static file server, see StaticFileHandler
+    :param port: the port for the server. If None, one is chosen randomly between 8000 and 9999
+    :param directory: the folder to serve. If None, the current working directory
+    :param handler: the request handler class
+    :param host: the host to listen on (default is all)
+    :param results: a ResultStore to save results POSTed to /results, see results.py
+    '''
+    if port == None:
+        port = choice(range(8000,9999))
+    return ThreadingHTTPServer((host, port), handler, directory=directory, results=results)
+
+
+def start_server(port=None,directory=None,handler=StaticFileHandler,results=None):
+    '''start_server
+    start a static file server in a background thread, and return (httpd,port)
+    :param port: the port for the server. If None, one is chosen randomly between 8000 and 9999
+    :param directory: the folder to serve. If None, the current working directory
+    :param handler: the request handler class
+    :param results: a ResultStore to save results POSTed to /results, see results.py
+    '''
+    httpd = make_server(port=port,directory=directory,handler=handler,results=results)
+    server = Thread(target=httpd.serve_forever)
+    server.daemon = True
+    server.start()
+    return httpd,httpd.server_address[1]
@@ -0,0 +1,108 @@
+'''
+workspace.py: part of expfactory package
+Functions to give each battery build its own folder, over a shared catalog of repos
+
+'''
+
+from expfactory.utils import link_directory
+import threading
+import tempfile
+import shutil
+import time
+import uuid
+import os
+
+
+class Workspace(object):
+    '''Workspace
+    a folder for one battery build. Folders from the catalog are added with hard links (see
+    WorkspaceManager.create), so they cost no copying, and files must be unshared before writing to them.
+    The workspace is removed when its last reference is released.
+    :param path: full path to the workspace folder
+    :param manager: the WorkspaceManager that made the workspace
+    '''
+    def __init__(self,path,manager):
+        self.id = os.path.basename(path)
+        self.path = path
+        self.manager = manager
+        self.refs = 1
+        self.job = None
+        self.created = time.time()
+
+    def unshare(self,relpath):
+        '''unshare
+        make a file in the workspace safe to write: if it is a hard link shared with the catalog, it is
+        replaced with a copy. Returns the full path to the file.
+        :param relpath: path of the file, relative to the workspace
+        '''
+        filename = os.path.join(self.path,relpath)
+        if os.path.exists(filename) and os.stat(filename).st_nlink > 1:
+            tmp_file = "%s.tmp" %(filename)
+            shutil.copy2(filename,tmp_file)
+            os.rename(tmp_file,filename)
+        return filename
+
+    def acquire(self):
+        with self.manager.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        '''release
+        release a reference to the workspace, and remove it if it was the last one
+        '''
+        with self.manager.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            del self.manager.workspaces[self.id]
+        shutil.rmtree(self.path,ignore_errors=True)
+
+
+class WorkspaceManager(object):
+    '''WorkspaceManager
+    makes workspaces over a catalog folder (eg, with experiments, battery and vm repos), which is only read from
+    :param catalog: full path to the catalog folder
+    :param root: folder to make workspaces in. If None, a temporary folder is made. For hard links to
+                 work, it should be on the same file system as the catalog
+    '''
+    def __init__(self,catalog,root=None):
+        if root == None:
+            root = tempfile.mkdtemp()
+        self.catalog = catalog
+        self.root = root
+        self.workspaces = dict()
+        self.lock = threading.Lock()
+
+    def create(self,folders=None):
+        '''create
+        make a new workspace, with one reference, and hard linked copies of folders from the catalog
+        :param folders: a list of catalog folders to add to the workspace (eg, ["battery"])
+        '''
+        path = os.path.join(self.root,str(uuid.uuid4()))
+        os.makedirs(path)
+        if folders != None:
+            for folder in folders:
+                link_directory("%s/%s" %(self.catalog,folder),"%s/%s" %(path,folder),strategy="hardlink")
+        workspace = Workspace(path,manager=self)
+        with self.lock:
+            self.workspaces[workspace.id] = workspace
+        return workspace
+
+    def get(self,workspace_id):
+        '''get
+        return a workspace by its id, or None if it does not exist (or was removed)
+        '''
+        return self.workspaces.get(workspace_id)
+
+    def expire(self,max_age=86400):
+        '''expire
+        release workspaces older than max_age seconds that were never given to a job (see Workspace.job), eg
+        when a user does not finish selecting experiments
+        :param max_age: the age in seconds (default one day)
+        '''
+        now = time.time()
+        for workspace in list(self.workspaces.values()):
+            if workspace.job == None and now - workspace.created > max_age:
+                workspace.job = "expired"
+                workspace.release()
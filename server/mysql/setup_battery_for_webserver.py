@@ -1,4 +1,5 @@
 from expfactory.battery import *
+from expfactory.assets import compress_assets
 from expfactory.utils import copy_directory
 from expfactory.vm import download_repo
 import argparse
@@ -13,6 +14,7 @@ import tempfile
 parser = argparse.ArgumentParser()
 parser.add_argument('--output', dest="output", help='Battery output directory.')
 parser.add_argument('--experiments', dest="experiments", help='Experiment(s) to use in the battery, separated by commas.')
+parser.add_argument('--compress', dest="compress", help='Write precompressed .gz (and .br) copies of static files, for nginx gzip_static or brotli_static.', default=False, action='store_true')
 parser.add_argument('--workingdir', dest="workingdir", help='Working directory, existing GIT repos are used if present and are not removed after execution.',default=None)
 
 try:
@@ -96,6 +98,9 @@ for add_file in add_files:
 
 # Cleanup
 shutil.rmtree("%s/.git" %(battery_dest)) # Remove git data from the battery
+
+if args.compress:
+    compress_assets(battery_dest)
 if is_temp_working_dir:
     shutil.rmtree(working_dir)
 
@@ -1,14 +1,19 @@
 from setuptools import setup, find_packages
+import re
 import os
 
 here = os.path.abspath(os.path.dirname(__file__))
 
+# The version is kept in expfactory/__init__.py, so the installed package reports the same version
+with open(os.path.join(here,"expfactory","__init__.py"),"r") as filey:
+    version = re.search(r'^__version__ = [\'"]([^\'"]+)[\'"]',filey.read(),re.M).group(1)
+
 setup(
     # Application name:
     name="expfactory",
 
     # Version number (initial):
-    version="2.5.47",
+    version=version,
 
     # Application author details:
     author="Vanessa Sochat",
@@ -28,7 +33,7 @@ setup(
     description="Python module for managing experiment factory experiments, for deployment to a psiturk battery or docker container.",
     keywords='psiturk behavior neuroscience experiment factory docker',
 
-    install_requires = ['requests','Flask>=1.0.2','gitpython','Flask-RESTful==0.3.6','selenium>=2.53.6','cognitiveatlas>=0.1.9'],
+    install_requires = ['requests','Flask>=1.0.2','gitpython','Flask-RESTful==0.3.6','selenium>=2.53.6','cognitiveatlas>=0.1.9','numpy','pandas'],
 
     entry_points = {
         'console_scripts': [